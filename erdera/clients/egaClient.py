@@ -3,27 +3,174 @@ This script queries the EGA API to retrieve the dataset information
 according to an endpoint the user can specify.
 """
 
+import codecs
+import json
 import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterator
 import requests
 from os import environ
 
 from dotenv import load_dotenv
 
+from erdera.clients.session import create_session
+from erdera.utils.index import TokenBucket
+
 load_dotenv()
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("API fetcher")
 
+# characters that change the nesting of an array item, outside and inside strings
+STRUCTURE = re.compile(r'[\[\]{}",]')
+STRING_END = re.compile(r'["\\]')
+
+
+class ItemScanner:
+    """Find the end of a JSON array item of which the text arrives in chunks. The
+    brackets and strings of the item are scanned once, the scan of the next chunk
+    continues with the nesting where the previous chunk ended."""
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def find_end(self, text: str, start: int = 0) -> int | None:
+        """Position of the separator or closing bracket that ends the item, or None
+        if the item continues in the next chunk"""
+        pos = start
+        if self.escaped:
+            if pos == len(text):
+                return None
+            self.escaped = False
+            pos += 1
+        while True:
+            match = (STRING_END if self.in_string else STRUCTURE).search(text, pos)
+            if match is None:
+                return None
+            character, index = match.group(), match.start()
+            pos = index + 1
+            if self.in_string:
+                if character == '\\':
+                    if pos == len(text):
+                        self.escaped = True  # the escaped character is in the next chunk
+                        return None
+                    pos += 1
+                else:
+                    self.in_string = False
+            elif character == '"':
+                self.in_string = True
+            elif character in '[{':
+                self.depth += 1
+            elif self.depth and character in ']}':
+                self.depth -= 1
+            elif not self.depth and character in ',]':
+                return index
+
+
+def iter_json_array(chunks: Iterator[bytes]) -> Iterator:
+    """Incrementally parse a JSON array from a stream of bytes and yield its
+    items one by one, so the full response text is never held in memory.
+    A response that is not an array is yielded as a single item.
+
+    Items within a chunk are decoded directly. The chunks of an item that spans
+    chunks are collected and only scanned (see ItemScanner), the item is decoded
+    once its end is found, so the time to parse an item is linear in its size."""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    pieces: list[str] = []  # the text of an item that spans chunks
+    scanner = None
+    in_array = None  # unknown until the first character
+    for chunk in chunks:
+        text = text_decoder.decode(chunk)
+        if in_array is False:
+            pieces.append(text)  # not an array, parsed as a whole at the end
+            continue
+
+        if scanner is not None:
+            end = scanner.find_end(text)
+            if end is None:
+                pieces.append(text)
+                continue
+            yield json.loads(''.join(pieces) + text[:end])
+            pieces, scanner = [], None
+            buffer, pos = text, end
+        else:
+            buffer, pos = buffer[pos:] + text, 0
+
+        while True:
+            # skip whitespace and item separators before the next item
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if in_array is None:
+                in_array = buffer[pos] == '['
+                if not in_array:
+                    pieces.append(buffer[pos:])
+                    buffer, pos = '', 0
+                    break
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                end = None
+            # a number (e.g. '-0.' of '-0.5') may continue in the next chunk
+            if end is not None and (isinstance(item, (dict, list))
+                                    or (end < len(buffer) and buffer[end] in ' \t\r\n,]')):
+                yield item
+                pos = end
+                continue
+
+            scanner = ItemScanner()
+            end = scanner.find_end(buffer, pos)
+            if end is None:
+                pieces.append(buffer[pos:])  # the item continues in the next chunk
+                buffer, pos = '', 0
+                break
+            # not valid JSON, raises an error
+            scanner = None
+            yield json.loads(buffer[pos:end])
+            pos = end
+
+    remainder = (''.join(pieces) + buffer[pos:] + text_decoder.decode(b'', final=True)).strip()
+    if in_array:
+        raise json.JSONDecodeError('Unterminated JSON array', remainder, len(remainder))
+    if remainder:
+        yield json.loads(remainder)
+
+
 # set authorization token
 class EGASubmissionsClient:
     """
     Retrieve metadata from the EGA public API
     """
-    def __init__(self):
-        self.session = requests.Session()
+    def __init__(self, pool_size: int = 10, timeout: tuple[float, float] = (10.0, 120.0)):
+        """Initialize the EGA client and retrieve the authentication tokens
+
+        :param pool_size: number of connections kept alive
+        :type pool_size: int (default: 10)
+
+        :param timeout: connect and read timeout in seconds
+        :type timeout: tuple[float, float] (default: (10.0, 120.0))
+        """
+        self.session = create_session(pool_size=pool_size,
+                                      connect_timeout=timeout[0],
+                                      read_timeout=timeout[1])
         self.api_url = environ['API_URL']
         self.access_token = None
         self.refresh_token = None
+        self._token_lock = threading.Lock()
         # initialize token creation
         self.get_tokens()
 
@@ -35,7 +182,7 @@ class EGASubmissionsClient:
             'username': environ['USERNAME'],
             'password': environ['PASSWORD']
         }
-        response = requests.post(environ['TOKEN_URL'], data=data)
+        response = self.session.post(environ['TOKEN_URL'], data=data)
         response.raise_for_status()
         tokens = response.json()
         self.access_token = tokens['access_token']
@@ -48,38 +195,55 @@ class EGASubmissionsClient:
             'client_id': environ['CLIENT_ID'],
             'refresh_token': self.refresh_token
         }
-        response = requests.post(environ['TOKEN_URL'], data=data)
+        response = self.session.post(environ['TOKEN_URL'], data=data)
         response.raise_for_status()
         tokens = response.json()
         self.access_token = tokens['access_token']
         self.refresh_token = tokens['refresh_token']
 
-    def get(self, url: str = None, include_headers: bool = True):
-        """wrapper around session.get"""
+    def refresh_expired_token(self, expired_token: str):
+        """Refresh the tokens once when used by multiple threads: only the first
+        thread that reports the expired token refreshes it, the others reuse the
+        new token"""
+        with self._token_lock:
+            if self.access_token == expired_token:
+                logger.info('Refreshing authentication tokens')
+                self.refresh_access_token()
+
+    def get(self, url: str = None, include_headers: bool = True, params: dict = None, stream: bool = False):
+        """wrapper around session.get
+
+        :param params: query parameters (e.g., skip and limit)
+        :type params: dict
+
+        :param stream: if True, the data is an iterator over the records, which are
+            parsed while the response is downloaded, instead of loading the full
+            response text first. Errors in the body are raised while iterating
+        :type stream: bool (default: False)
+        """
         output = {
             'data': [],
             'errors': [] ,
             'errorCount': 0,
         }
         # set the header with the token
-        headers = {'Authorization': f'Bearer {self.access_token}'}
+        access_token = self.access_token
+        headers = {'Authorization': f'Bearer {access_token}'}
         try:
             if include_headers:
-                response = self.session.get(url, headers=headers)
+                response = self.session.get(url, headers=headers, params=params, stream=stream)
             else: 
-                response = self.session.get(url)
+                response = self.session.get(url, params=params, stream=stream)
             response.raise_for_status() # so the error is thrown
-            output['data'] = response.json()
+            output['data'] = self._parse_response(response, stream)
             return output
         except requests.exceptions.HTTPError as error:
             if response.status_code == 401: # if token is expired
-                print('refreshing tokens')
-                logger.info('Refreshing authentication tokens')
-                self.refresh_access_token()
+                self.refresh_expired_token(access_token)
                 # set header with refreshed token
                 headers = {'Authorization': f'Bearer {self.access_token}'}     
-                response = self.session.get(url, headers=headers)
-                output['data'] = response.json()
+                response = self.session.get(url, headers=headers, params=params, stream=stream)
+                output['data'] = self._parse_response(response, stream)
                 return output
             else:
                 page_error = {
@@ -93,6 +257,72 @@ class EGASubmissionsClient:
 
                 return output
             
+    def _parse_response(self, response: requests.Response, stream: bool = False):
+        """Parse the JSON response, incrementally if it was requested as a stream"""
+        if not stream:
+            return response.json()
+        return iter_json_array(response.iter_content(chunk_size=64 * 1024))
+
+    def iter_endpoint_dataset(self, provisional_id: str, endpoint: str, include_headers: bool = True,
+                              page_size: int = 1000, rate_limiter: TokenBucket = None) -> Iterator[dict]:
+        """Iterate over the pages of a dataset endpoint using the skip and limit
+        query parameters. Each response is parsed incrementally and yielded in pages
+        of at most page_size records (also if the server ignores the limit), so
+        memory use depends on the page size rather than the size of the endpoint.
+
+        :param provisional_id: the EGA provisional ID of the dataset
+        :type provisional_id: str
+
+        :param endpoint: the dataset endpoint (e.g., 'files', 'mappings/sample_file')
+        :type endpoint: str
+
+        :param page_size: number of records per request
+        :type page_size: int (default: 1000)
+
+        :param rate_limiter: limits the number of requests per second
+        :type rate_limiter: TokenBucket
+
+        :returns: the output (data, errors and error count) of each page
+        :rtype: Iterator[dict]
+        """
+        url = f'{self.api_url}/datasets/{provisional_id}/{endpoint}'
+        skip = 0
+        first_record = None
+        while True:
+            if rate_limiter:
+                rate_limiter.acquire()
+            output = self.get(url=url, include_headers=include_headers,
+                              params={'skip': skip, 'limit': page_size}, stream=True)
+            if output['errorCount']:
+                yield output
+                return
+            records = iter(output['data'])
+            page = list(islice(records, page_size))
+
+            # a server that ignores the skip parameter returns the same page again,
+            # the records after the first page cannot be retrieved
+            if skip and page and page[0] == first_record:
+                page_error = {
+                    'type': 'Pagination',
+                    'message': f"Unable to get EGA data from {endpoint} of {provisional_id}: the server "
+                               f"ignores the skip parameter, only the first {skip} records were retrieved"
+                }
+                logger.warning(page_error['message'])
+                yield {'data': [], 'errors': [page_error], 'errorCount': 1}
+                return
+            first_record = page[0] if page else None
+
+            record_count = 0
+            while page:
+                yield {'data': page, 'errors': [], 'errorCount': 0}
+                record_count += len(page)
+                page = list(islice(records, page_size))
+
+            # the last page is reached (or the server does not paginate and returned everything)
+            if record_count != page_size:
+                return
+            skip += page_size
+
     def get_endpoint_dataset(self, provisional_id: str, endpoint: str = None, include_headers: bool = True):
         """Get the dataset information with a user-specified endpoint. If no endpoint is given, the generic
         dataset endpoint is called."""
@@ -101,6 +331,88 @@ class EGASubmissionsClient:
             url += f'/{endpoint}'
         return self.get(url=url, include_headers=include_headers)
         
+    def get_endpoints_dataset(self, provisional_id: str, endpoints: list[str],
+                              exclude_headers: list[str] = None, max_workers: int = 4,
+                              rate_limiter: TokenBucket = None, page_size: int = None,
+                              write_page: Callable[[str, list[dict]], None] = None) -> dict[str, dict]:
+        """Get the dataset information of multiple endpoints in parallel. The workers
+        share the authentication token and the rate limit.
+
+        :param provisional_id: the EGA provisional ID of the dataset
+        :type provisional_id: str
+
+        :param endpoints: the dataset endpoints to retrieve (e.g., 'studies', 'mappings/sample_file')
+        :type endpoints: list[str]
+
+        :param exclude_headers: endpoints that are requested without authorization header
+        :type exclude_headers: list[str]
+
+        :param max_workers: number of endpoints to request in parallel
+        :type max_workers: int (default: 4)
+
+        :param rate_limiter: limits the number of requests per second across all workers
+        :type rate_limiter: TokenBucket
+
+        :param page_size: if provided, the endpoints are retrieved in pages of this
+            size (see iter_endpoint_dataset)
+        :type page_size: int
+
+        :param write_page: if provided, the records are passed to this function
+            (with the endpoint) as soon as a page is retrieved, instead of being
+            collected in the output; it is called from multiple threads
+        :type write_page: Callable[[str, list[dict]], None]
+
+        :returns: the output of each endpoint (see get), without data if write_page
+            is provided; an endpoint that could not be retrieved has an error
+        :rtype: dict[str, dict]
+        """
+        exclude_headers = exclude_headers or []
+
+        def fetch_endpoint(endpoint: str) -> dict:
+            logger.info('Fetching data from %s', endpoint)
+            # an endpoint that fails is reported as an error, so the other endpoints of the dataset are kept
+            try:
+                return fetch_pages(endpoint)
+            except (requests.exceptions.RequestException, ValueError) as error:
+                endpoint_error = {
+                    'type': type(error).__name__,
+                    'message': f"Unable to get EGA data from {endpoint} of {provisional_id}: {error}"
+                }
+                logger.warning(endpoint_error['message'])
+                return {'data': [], 'errors': [endpoint_error], 'errorCount': 1}
+
+        def fetch_pages(endpoint: str) -> dict:
+            if not page_size:
+                if rate_limiter:
+                    rate_limiter.acquire()
+                output = self.get_endpoint_dataset(provisional_id=provisional_id,
+                                                   endpoint=endpoint,
+                                                   include_headers=endpoint not in exclude_headers)
+                if write_page:
+                    if output['data']:
+                        data = output['data']
+                        write_page(endpoint, data if isinstance(data, list) else [data])
+                    output['data'] = []
+                return output
+
+            output = {'data': [], 'errors': [], 'errorCount': 0}
+            for page in self.iter_endpoint_dataset(provisional_id=provisional_id,
+                                                   endpoint=endpoint,
+                                                   include_headers=endpoint not in exclude_headers,
+                                                   page_size=page_size,
+                                                   rate_limiter=rate_limiter):
+                if write_page:
+                    if page['data']:
+                        write_page(endpoint, page['data'])
+                else:
+                    output['data'].extend(page['data'])
+                output['errors'].extend(page['errors'])
+                output['errorCount'] += page['errorCount']
+            return output
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(endpoints, executor.map(fetch_endpoint, endpoints)))
+
     def get_endpoint_studies(self, study_id: str, endpoint: str = None):
         """Get the studies information with a user-specified endpoint. If no endpoint is given, the generic 
         studies endpoint is called."""
@@ -1,18 +1,33 @@
 """GPAP API """
 
 import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from typing import Iterable, Iterator
 import requests
 import erdera.clients.gpap.gpap_client_types as gpapTypes
+from erdera.clients.session import create_session
+from erdera.utils.index import TokenBucket
 
 # logging.getLogger("requests").setLevel(logging.WARNING)
 logging.captureWarnings(True)
 log = logging.getLogger("Molgenis GPAP Pyclient")
 
+# responses that are worth retrying (rate limited or server errors)
+RETRY_STATUS_CODES: set[int] = {429, 500, 502, 503, 504}
+
 
 class GpapClient:
     """Client for the GPAP API"""
 
-    def __init__(self, api_url: str, token: str, api_page_size: int = 100):
+    def __init__(self, api_url: str, token: str, api_page_size: int = 100,
+                 max_retries: int = 5, backoff_factor: float = 1.0, max_backoff: float = 60.0,
+                 pool_size: int = 10, timeout: tuple[float, float] = (10.0, 120.0)):
         """Initialize the GPAP client
 
         :param api_url: root API endpoint
@@ -24,34 +39,105 @@ class GpapClient:
         :param api_page_size: number of records to return in an API request
         :type api_page_size: int (default: 100)
 
+        :param max_retries: number of times a failed request is retried (connection
+            errors, 429 and 5xx responses)
+        :type max_retries: int (default: 5)
+
+        :param backoff_factor: base delay in seconds, doubled after every attempt
+        :type backoff_factor: float (default: 1.0)
+
+        :param max_backoff: maximum delay in seconds between two attempts
+        :type max_backoff: float (default: 60.0)
+
+        :param pool_size: number of connections kept alive, at least the number
+            of concurrent workers
+        :type pool_size: int (default: 10)
+
+        :param timeout: connect and read timeout in seconds
+        :type timeout: tuple[float, float] (default: (10.0, 120.0))
+
         """
-        self.session = requests.Session()
+        self.session = create_session(pool_size=pool_size,
+                                      connect_timeout=timeout[0],
+                                      read_timeout=timeout[1])
         self.api_url: str = f"{api_url}/" if api_url.endswith(
             '/') is False else api_url
         self.token: str = token
         self.api_page_size = api_page_size
         self.fields: type.ApiRequestFields = {
             'participants': [], 'experiments': []}
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retries: dict[str, int] = {}
+        self._retries_lock = threading.Lock()
+
+    @property
+    def retry_count(self) -> int:
+        """Total number of retried requests"""
+        return sum(self.retries.values())
+
+    def _get_backoff(self, attempt: int, response: requests.Response = None) -> float:
+        """Delay before the next attempt: the Retry-After header if the server sent
+        one, otherwise exponential backoff with full jitter"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(retry_after)
+                    return min(max(retry_at.timestamp() - time.time(), 0), self.max_backoff)
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def _request(self, method: str, url: str, headers: gpapTypes.ApiHeaders = None,
+                 body: gpapTypes.ApiBody = None) -> requests.Response:
+        """Send a request and retry on connection errors, 429 and 5xx responses"""
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = self.session.request(method, url, headers=headers, json=body)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                reason = str(response.status_code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                if attempt == self.max_retries:
+                    raise
+                reason = type(err).__name__
+
+            if attempt == self.max_retries:
+                return response
+
+            delay = self._get_backoff(attempt, response)
+            with self._retries_lock:
+                self.retries[reason] = self.retries.get(reason, 0) + 1
+            log.warning("Request to %s failed (%s), retrying in %.1fs (attempt %s of %s)",
+                        url, reason, delay, attempt + 1, self.max_retries)
+            time.sleep(delay)
+
+        return response
 
     def _post(self, url: str, headers: gpapTypes.ApiHeaders = None, body: gpapTypes.ApiBody = None):
         """Send a POST request to the GPAP API"""
-        response = self.session.post(url, headers=headers, json=body)
+        response = self._request('POST', url, headers=headers, body=body)
 
         if response.status_code != 200:
             msg: str = f"Failed to fetch data from GPAP API: {response.status_code}-{response.text}"
             log.error(msg)
-            raise requests.HTTPError(msg)
+            raise requests.HTTPError(msg, response=response)
 
         return response.json()
 
     def _get(self, url: str, headers: gpapTypes.ApiHeaders = None):
         """Send a GET request"""
-        response = self.session.get(url, headers=headers)
+        response = self._request('GET', url, headers=headers)
 
         if response.status_code != 200:
             msg: str = f"Failed to fetch data from GPAP API: {response.status_code}-{response.text}"
             log.error(msg)
-            raise requests.HTTPError(msg)
+            raise requests.HTTPError(msg, response=response)
 
         return response.json()
 
@@ -117,6 +203,71 @@ class GpapClient:
         url: str = f"{self.api_url}datamanagement_service/api/experimentsview/"
         return self._post(url=url, headers=headers, body=body)
 
+    def get_page(self, meta_type: gpapTypes.MetadataTypes, page: int = 1) -> list[dict]:
+        """Get the rows of a single participants or experiments page
+
+        :param meta_type: API metadata type to retrieve, 'participants' or 'experiments'
+        :type meta_type: str
+
+        :param page: a number indicating which page to retrieve data from
+        :type page: int
+
+        :returns: records of the requested page
+        :rtype: list[dict]
+        """
+        if meta_type == 'participants':
+            return self.get_participants(page=page)['rows']
+        if meta_type == 'experiments':
+            return self.get_experiments(page=page)['items']
+        raise ValueError(f"Metadata type {meta_type} is not recognised")
+
+    def iter_pages(self, meta_type: gpapTypes.MetadataTypes, total_pages: int = None,
+                   max_workers: int = 1, rate_limiter: TokenBucket = None,
+                   pages: Iterable[int] = None) -> Iterator[gpapTypes.PageResult]:
+        """Iterate over all pages of participants or experiments. Pages are
+        requested concurrently, but yielded in page order. At most two pages per
+        worker are held in memory at any time.
+
+        :param meta_type: API metadata type to retrieve, 'participants' or 'experiments'
+        :type meta_type: str
+
+        :param total_pages: total number of pages to retrieve
+        :type total_pages: int
+
+        :param max_workers: number of pages to request in parallel
+        :type max_workers: int (default: 1)
+
+        :param rate_limiter: limits the number of requests per second across all workers
+        :type rate_limiter: TokenBucket
+
+        :param pages: page numbers to retrieve, instead of all pages up to total_pages
+        :type pages: Iterable[int]
+
+        :returns: the rows of each page, or the error raised while retrieving it
+        :rtype: Iterator[PageResult]
+        """
+        def fetch_page(page: int) -> gpapTypes.PageResult:
+            if rate_limiter:
+                rate_limiter.acquire()
+            result: gpapTypes.PageResult = {'page': page, 'rows': [], 'error': None}
+            try:
+                log.info('Retrieving %s from page %s', meta_type, page)
+                result['rows'] = self.get_page(meta_type=meta_type, page=page)
+            except (requests.exceptions.RequestException, KeyError) as err:
+                result['error'] = err
+            return result
+
+        pages = iter(pages if pages is not None else range(1, int(total_pages) + 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = deque(executor.submit(fetch_page, page)
+                              for page in islice(pages, max_workers * 2))
+            while in_flight:
+                result = in_flight.popleft().result()
+                next_page = next(pages, None)
+                if next_page is not None:
+                    in_flight.append(executor.submit(fetch_page, next_page))
+                yield result
+
     def get_ref_erns(self) -> list[gpapTypes.NameValue]:
         """Retrieve ERN reference list"""
         return self.get_ref_list('ernlist')
@@ -1,6 +1,7 @@
 """Types for GPAP Production API Client"""
 from typing import TypedDict
 from enum import Enum
+from pandas import Timestamp
 
 ApiHeaders = TypedDict(
     'ApiHeaders', {'Content-Type': str, 'Authorization': str})
@@ -79,6 +80,17 @@ class JobOutput(TypedDict):
     data: list[dict]
     errors: list[JobErrors]
     errorCount: int
+    rowCount: int
+    newCount: int
+    updatedCount: int
+    lastModified: Timestamp | None
+    superseded: list[dict]
+
+class PageResult(TypedDict):
+    """A single page retrieved from the API"""
+    page: int
+    rows: list[dict]
+    error: Exception | None
 
 JobsGpapApi = TypedDict(
     'JobsGpapApi',
@@ -92,6 +104,8 @@ JobsGpapApi = TypedDict(
         'total number of experiments': int,
         'number of new experiments': int,
         'number of updated experiments': int,
+        'last modification date': str,
+        'number of retries': int,
         'number of errors': int
     }
 )
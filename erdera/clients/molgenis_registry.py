@@ -0,0 +1,70 @@
+"""Shared MOLGENIS clients
+Creating a molgenis_emx2_pyclient Client validates the host and retrieves the
+schemas, so every new client costs a few requests and a new connection. The
+registry creates one client per host and hands out a copy per schema that
+shares its session, i.e. the token and the open connections.
+"""
+
+import copy
+import logging
+import threading
+from os import environ
+
+from molgenis_emx2_pyclient.client import Client
+
+log = logging.getLogger("MOLGENIS clients")
+
+
+class ClientRegistry:
+    """One authenticated client per host and schema. Use the registry as a context
+    manager (or call close) to close the connections at the end of a run. The
+    clients should not be used as context managers themselves, as that closes
+    the shared session.
+    """
+
+    def __init__(self, host: str = None, token: str = None):
+        self._host = host
+        self._token = token
+        self._hosts: dict[str, Client] = {}
+        self._clients: dict[tuple[str, str | None], Client] = {}
+        self._lock = threading.Lock()
+
+    def get(self, schema: str = None, host: str = None) -> Client:
+        """Get the client of a host with schema as its default schema
+
+        :param schema: name of the default schema of the client
+        :type schema: str
+
+        :param host: MOLGENIS host (default: MOLGENIS_HOST)
+        :type host: str
+
+        :returns: an authenticated client
+        :rtype: Client
+        """
+        host = host or self._host or environ['MOLGENIS_HOST']
+        with self._lock:
+            if (host, schema) not in self._clients:
+                if host not in self._hosts:
+                    log.info("Connecting to %s", host)
+                    self._hosts[host] = Client(host, token=self._token or environ['MOLGENIS_TOKEN'])
+                client = copy.copy(self._hosts[host])
+                client.set_schema(schema)
+                self._clients[(host, schema)] = client
+            return self._clients[(host, schema)]
+
+    def close(self):
+        """Close the sessions of all clients"""
+        with self._lock:
+            for client in self._hosts.values():
+                client.session.close()
+            self._hosts.clear()
+            self._clients.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+molgenis_clients = ClientRegistry()
@@ -0,0 +1,161 @@
+"""Local cache of MOLGENIS ontology tables
+Ontology tables (e.g. Phenotypes, Diseases, Tissue types) are large and rarely
+change. Tables are stored on disk per schema and are only downloaded again if
+the number of rows or the latest modification date in MOLGENIS has changed.
+Tables of which the modification date cannot be retrieved are not cached.
+If ONTOLOGY_SNAPSHOT_PATH is set, the ontology tables in this snapshot (see
+ontology_snapshot) are used as they are, without contacting MOLGENIS. Tables of
+other schemas are always retrieved from MOLGENIS, even if an older snapshot
+contains them.
+"""
+
+import json
+import logging
+import os
+import re
+from os import environ
+
+import pandas as pd
+from molgenis_emx2_pyclient.client import Client
+
+from erdera.clients.molgenis_registry import molgenis_clients
+from erdera.clients.ontology_snapshot import OntologySnapshot, snapshot_schemas
+
+log = logging.getLogger("Ontology cache")
+
+
+def get_table_fingerprint(client: Client, table: str, schema: str) -> dict | None:
+    """Retrieve the number of rows and the latest modification date of a table,
+    which change whenever a record is inserted, updated or deleted.
+
+    :param client: an authenticated MOLGENIS client
+    :type client: Client
+
+    :param table: name of the table
+    :type table: str
+
+    :param schema: name of the schema
+    :type schema: str
+
+    :returns: the row count and latest modification date, or None if they could
+        not be retrieved; the row count alone does not change when a record is
+        updated (e.g. a curator fills in a new value), so it is not a fingerprint
+    :rtype: dict | None
+    """
+    try:
+        table_id = client.get_schema_metadata(name=schema).get_table(by='name', value=table).id
+    except Exception as err:
+        log.warning("Could not retrieve the metadata of %s::%s: %s", schema, table, err)
+        return None
+
+    query = f'{{ {table_id}_agg {{ count }} {table_id}(orderby: {{mg_updatedOn: DESC}}, limit: 1) {{ mg_updatedOn }} }}'
+    response = client.session.post(url=f'{client.url}/{schema}/graphql', json={'query': query})
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if not response.ok or 'errors' in body or 'data' not in body:
+        log.warning("Could not retrieve the modification date of %s::%s", schema, table)
+        return None
+
+    data = body['data']
+    count = data[f'{table_id}_agg']['count']
+    updated_on = (data.get(table_id) or [{}])[0].get('mg_updatedOn')
+    if count and updated_on is None:
+        log.warning("%s::%s has no modification date", schema, table)
+        return None
+    return {'count': count, 'updatedOn': updated_on}
+
+
+class OntologyCache:
+    """Tables are stored as `<path>/<schema>/<table>.pkl`, with the host and the
+    fingerprint of the table at the time of download in `<table>.json`
+    """
+
+    def __init__(self, path: str = None, snapshot_path: str = None):
+        self._path = path
+        self._snapshot_path = snapshot_path
+        self._snapshots: dict[str, OntologySnapshot] = {}
+
+    @property
+    def path(self) -> str:
+        """Cache directory; defaults to ONTOLOGY_CACHE_PATH, read when first used
+        so it can be set in the .env file"""
+        return self._path or environ.get('ONTOLOGY_CACHE_PATH', '.cache/ontologies')
+
+    @property
+    def snapshot(self) -> OntologySnapshot | None:
+        """Snapshot to load the tables from; defaults to ONTOLOGY_SNAPSHOT_PATH"""
+        path = self._snapshot_path or environ.get('ONTOLOGY_SNAPSHOT_PATH')
+        if not path:
+            return None
+        if path not in self._snapshots:
+            self._snapshots[path] = OntologySnapshot(path)
+        return self._snapshots[path]
+
+    def _file_path(self, schema: str, table: str, extension: str) -> str:
+        name = re.sub(r'[^\w\-]', '_', table)
+        return os.path.join(self.path, re.sub(r'[^\w\-]', '_', schema), f'{name}.{extension}')
+
+    def get(self, table: str, schema: str, client: Client = None) -> pd.DataFrame:
+        """Retrieve an ontology table from the snapshot, or a table from the cache if
+        it is unchanged in MOLGENIS, otherwise download it and update the cache
+
+        :param table: name of the table
+        :type table: str
+
+        :param schema: name of the schema
+        :type schema: str
+
+        :param client: an authenticated MOLGENIS client; only created if the table is
+            not in the snapshot
+        :type client: Client (default: the shared client of the schema)
+
+        :returns: the table data
+        :rtype: pd.DataFrame
+        """
+        snapshot = self.snapshot
+        if snapshot is not None and schema in snapshot_schemas():
+            data = snapshot.get(table=table, schema=schema)
+            if data is not None:
+                log.info("Loading %s::%s from the snapshot", schema, table)
+                return data
+            log.warning("%s::%s is not in the snapshot, retrieving it from MOLGENIS", schema, table)
+
+        client = client or molgenis_clients.get(schema=schema)
+        data_path = self._file_path(schema, table, 'pkl')
+        meta_path = self._file_path(schema, table, 'json')
+
+        fingerprint = get_table_fingerprint(client=client, table=table, schema=schema)
+        if fingerprint is not None:
+            fingerprint['host'] = client.url
+
+        if fingerprint is not None and os.path.exists(data_path) and os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as file:
+                cached = json.load(file)
+            if cached == fingerprint:
+                log.info("Loading %s::%s from the cache", schema, table)
+                return pd.read_pickle(data_path)
+
+        data = client.get(table=table, schema=schema, as_df=True)
+
+        # the table cannot be validated without a fingerprint, so it is not cached
+        if fingerprint is not None:
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            data.to_pickle(f'{data_path}.tmp')
+            os.replace(f'{data_path}.tmp', data_path)
+            with open(f'{meta_path}.tmp', 'w', encoding='utf-8') as file:
+                json.dump(fingerprint, file)
+            os.replace(f'{meta_path}.tmp', meta_path)
+
+        return data
+
+    def clear(self):
+        """Remove all cached tables"""
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(('.pkl', '.json')):
+                    os.remove(os.path.join(root, name))
+
+
+ontology_cache = OntologyCache()
@@ -0,0 +1,159 @@
+"""Snapshot of the reference tables of the mapping scripts
+The ontology tables that the mapping scripts look up are exported to a local
+bundle of Arrow IPC (Feather) files.
+The files are not compressed, so they are memory-mapped when they are loaded.
+With ONTOLOGY_SNAPSHOT_PATH set, these tables are read from the bundle instead
+of MOLGENIS, e.g. to rerun a mapping locally, to test a mapping against a fixed
+set of reference data or to map on a machine with a slow connection to the server.
+The ontology mappings and quality control tables are not part of the snapshot:
+the mapping scripts upload new entries to them, so they are always read from
+MOLGENIS.
+
+Create (or refresh) a snapshot with `python -m erdera.clients.ontology_snapshot`;
+the bundle is written to ONTOLOGY_SNAPSHOT_PATH (default: `.cache/snapshot`).
+Reading and writing a snapshot requires pyarrow.
+"""
+
+import json
+import logging
+import os
+import re
+from datetime import datetime, timezone
+from os import environ
+
+import pandas as pd
+from dotenv import load_dotenv
+from molgenis_emx2_pyclient.client import Client
+
+from erdera.clients.molgenis_registry import molgenis_clients
+
+log = logging.getLogger("Ontology snapshot")
+
+# the tables the mapping scripts look up, per environment variable of the schema
+SNAPSHOT_TABLES = {
+    'SCHEMA_ONTOLOGIES': ['Phenotypes', 'Diseases', 'Organisations', 'Tissue type']
+}
+
+
+def snapshot_schemas() -> set[str]:
+    """Names of the schemas that are read from a snapshot
+
+    :returns: the schemas of SNAPSHOT_TABLES that are set in the environment
+    :rtype: set[str]
+    """
+    return {environ[variable] for variable in SNAPSHOT_TABLES if variable in environ}
+
+
+class OntologySnapshot:
+    """Tables are stored as `<path>/<schema>/<table>.arrow` and are listed in
+    `<path>/manifest.json`, together with the host and the time of the export
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._manifest = None
+
+    @property
+    def manifest(self) -> dict:
+        """Contents of the manifest; empty if there is no snapshot yet"""
+        if self._manifest is None:
+            manifest_path = os.path.join(self.path, 'manifest.json')
+            if os.path.exists(manifest_path):
+                with open(manifest_path, encoding='utf-8') as file:
+                    self._manifest = json.load(file)
+            else:
+                self._manifest = {'tables': {}}
+        return self._manifest
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        schema, table = key
+        return table in self.manifest['tables'].get(schema, {})
+
+    def get(self, table: str, schema: str) -> pd.DataFrame | None:
+        """Load a table from the snapshot
+
+        :param table: name of the table
+        :type table: str
+
+        :param schema: name of the schema
+        :type schema: str
+
+        :returns: the table data, or None if the table is not in the snapshot
+        :rtype: pd.DataFrame | None
+        """
+        if (schema, table) not in self:
+            return None
+        from pyarrow import feather
+
+        entry = self.manifest['tables'][schema][table]
+        return feather.read_table(os.path.join(self.path, entry['file']), memory_map=True).to_pandas()
+
+    def write(self, table: str, schema: str, data: pd.DataFrame, host: str = None):
+        """Add a table to the snapshot, or replace it
+
+        :param table: name of the table
+        :type table: str
+
+        :param schema: name of the schema
+        :type schema: str
+
+        :param data: the table data
+        :type data: pd.DataFrame
+
+        :param host: MOLGENIS host the table was retrieved from
+        :type host: str
+        """
+        from pyarrow import feather
+
+        file_name = os.path.join(re.sub(r'[^\w\-]', '_', schema), f"{re.sub(r'[^\w\-]', '_', table)}.arrow")
+        file_path = os.path.join(self.path, file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        # uncompressed, so the file can be memory-mapped
+        feather.write_feather(data.reset_index(drop=True), f'{file_path}.tmp', compression='uncompressed')
+        os.replace(f'{file_path}.tmp', file_path)
+
+        self.manifest['tables'].setdefault(schema, {})[table] = {
+            'file': file_name,
+            'rows': data.shape[0],
+            'host': host,
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds')
+        }
+        manifest_path = os.path.join(self.path, 'manifest.json')
+        with open(f'{manifest_path}.tmp', 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+def create_snapshot(client: Client, path: str, tables: dict[str, list[str]] = None) -> OntologySnapshot:
+    """Export the reference tables of the mapping scripts from MOLGENIS
+
+    :param client: an authenticated MOLGENIS client
+    :type client: Client
+
+    :param path: directory of the snapshot
+    :type path: str
+
+    :param tables: the tables to export, per environment variable of the schema
+    :type tables: dict[str, list[str]] (default: SNAPSHOT_TABLES)
+
+    :returns: the snapshot
+    :rtype: OntologySnapshot
+    """
+    snapshot = OntologySnapshot(path)
+    for schema_variable, table_names in (tables or SNAPSHOT_TABLES).items():
+        schema = environ[schema_variable]
+        for table in table_names:
+            log.info("Exporting %s::%s", schema, table)
+            data = client.get(table=table, schema=schema, as_df=True)
+            snapshot.write(table=table, schema=schema, data=data, host=client.url)
+    return snapshot
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.basicConfig(level='INFO')
+
+    with molgenis_clients:
+        create_snapshot(client=molgenis_clients.get(),
+                        path=environ.get('ONTOLOGY_SNAPSHOT_PATH', '.cache/snapshot'))
@@ -0,0 +1,57 @@
+"""Shared HTTP transport for the API clients"""
+
+import importlib.util
+import requests
+from requests.adapters import HTTPAdapter
+
+# only advertise brotli if urllib3 is able to decode it
+ACCEPT_ENCODING: str = 'gzip, deflate, br' if (
+    importlib.util.find_spec('brotli') or importlib.util.find_spec('brotlicffi')
+) else 'gzip, deflate'
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP adapter that applies a default timeout to every request"""
+
+    def __init__(self, *args, timeout: tuple[float, float] = None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def create_session(pool_size: int = 10, connect_timeout: float = 10.0,
+                   read_timeout: float = 120.0) -> requests.Session:
+    """Create a requests session with a connection pool that is shared by all
+    requests of a client. Connections are kept alive and responses are compressed.
+
+    :param pool_size: maximum number of connections kept open per host; should be at
+        least the number of threads using the session
+    :type pool_size: int (default: 10)
+
+    :param connect_timeout: seconds to wait for a connection to be established
+    :type connect_timeout: float (default: 10.0)
+
+    :param read_timeout: seconds to wait for the server to send a response
+    :type read_timeout: float (default: 120.0)
+
+    :returns: a configured session
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(
+        timeout=(connect_timeout, read_timeout),
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        pool_block=True
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept-Encoding': ACCEPT_ENCODING,
+        'Connection': 'keep-alive'
+    })
+    return session
@@ -0,0 +1,194 @@
+"""Local columnar cache of staging area tables
+The records of a staging area table are added by fetch jobs, which write their
+run id to the 'added by job' column. A table is stored on disk per job as an
+uncompressed Arrow IPC (Feather) file, with repetitive string columns
+dictionary-encoded, and is only downloaded again when a new job has added
+records to the table (or records of a job were removed). Repeated mapping and
+debugging runs, and the mapping scripts that use the same table, then read the
+table from disk instead of downloading and parsing the CSV export.
+
+The cache is used if STAGING_CACHE_PATH is set; it requires pyarrow.
+"""
+
+import json
+import logging
+import os
+import re
+from os import environ
+
+import pandas as pd
+from molgenis_emx2_pyclient.client import Client
+
+from erdera.clients.molgenis_registry import molgenis_clients
+
+log = logging.getLogger("Staging cache")
+
+
+def get_job_fingerprint(client: Client, table: str, schema: str,
+                        job_column: str = 'added by job') -> dict | None:
+    """Retrieve the number of records per job of a staging area table
+
+    :param client: an authenticated MOLGENIS client
+    :type client: Client
+
+    :param table: name of the table
+    :type table: str
+
+    :param schema: name of the schema
+    :type schema: str
+
+    :param job_column: column with the run id of the job that added the record
+    :type job_column: str (default: 'added by job')
+
+    :returns: the number of records per job id, or None if they could not be retrieved
+    :rtype: dict | None
+    """
+    try:
+        table_meta = client.get_schema_metadata(name=schema).get_table(by='name', value=table)
+        column_id = table_meta.get_column(by='name', value=job_column).id
+    except Exception as err:
+        log.warning("Could not retrieve the metadata of %s::%s: %s", schema, table, err)
+        return None
+
+    query = f'{{ {table_meta.id}_groupBy {{ count {column_id} {{ id }} }} }}'
+    response = client.session.post(url=f'{client.url}/{schema}/graphql', json={'query': query})
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if not response.ok or 'errors' in body or 'data' not in body:
+        log.warning("Could not retrieve the jobs of %s::%s", schema, table)
+        return None
+
+    return {
+        (group.get(column_id) or {}).get('id'): group['count']
+        for group in body['data'][f'{table_meta.id}_groupBy'] or []
+    }
+
+
+def dictionary_encode(data: pd.DataFrame, max_ratio: float = 0.5):
+    """Convert a table to Arrow with the string columns of which the values repeat
+    (e.g. the job, the project or yes/no answers) dictionary-encoded
+
+    :param data: the table data
+    :type data: pd.DataFrame
+
+    :param max_ratio: maximum ratio of unique values to rows of an encoded column
+    :type max_ratio: float (default: 0.5)
+
+    :returns: the table
+    :rtype: pyarrow.Table
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    table = pa.Table.from_pandas(data.reset_index(drop=True), preserve_index=False)
+    for i, field in enumerate(table.schema):
+        column = table.column(i)
+        if not (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)) or len(column) == 0:
+            continue
+        if pc.count_distinct(column).as_py() <= max_ratio * len(column):
+            table = table.set_column(i, field.name, pc.dictionary_encode(column))
+    return table
+
+
+def dictionary_decode(table):
+    """Convert the dictionary-encoded columns of an Arrow table back to their values
+
+    :param table: the table
+    :type table: pyarrow.Table
+
+    :returns: the table without dictionary-encoded columns
+    :rtype: pyarrow.Table
+    """
+    import pyarrow as pa
+
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+    return table
+
+
+class StagingCache:
+    """Tables are stored as `<path>/<schema>/<table>/<job id>.arrow` with the number
+    of records per job in `<job id>.json`, where job id is the most recent job that
+    added records to the table
+    """
+
+    def __init__(self, path: str = None):
+        self._path = path
+
+    @property
+    def path(self) -> str | None:
+        """Cache directory; defaults to STAGING_CACHE_PATH, read when first used so it
+        can be set in the .env file. The cache is disabled if there is no path."""
+        return self._path or environ.get('STAGING_CACHE_PATH')
+
+    def _file_path(self, schema: str, table: str, job: str, extension: str) -> str:
+        return os.path.join(self.path, re.sub(r'[^\w\-]', '_', schema), re.sub(r'[^\w\-]', '_', table),
+                            f"{re.sub(r'[^\w\-]', '_', job)}.{extension}")
+
+    def get(self, table: str, schema: str, client: Client = None) -> pd.DataFrame:
+        """Retrieve a staging area table from the cache if no job has changed its
+        records since it was cached, otherwise download it and update the cache
+
+        :param table: name of the table
+        :type table: str
+
+        :param schema: name of the schema
+        :type schema: str
+
+        :param client: an authenticated MOLGENIS client
+        :type client: Client (default: the shared client)
+
+        :returns: the table data
+        :rtype: pd.DataFrame
+        """
+        client = client or molgenis_clients.get()
+        if not self.path:
+            return client.get(table=table, schema=schema, as_df=True)
+
+        from pyarrow import feather
+
+        jobs = get_job_fingerprint(client=client, table=table, schema=schema)
+        if not jobs:
+            return client.get(table=table, schema=schema, as_df=True)
+
+        # job ids start with the date and time of the run, so the last one is the most recent
+        latest_job = max(str(job) for job in jobs)
+        data_path = self._file_path(schema, table, latest_job, 'arrow')
+        meta_path = self._file_path(schema, table, latest_job, 'json')
+
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as file:
+                cached = json.load(file)
+            if cached == {str(job): count for job, count in jobs.items()}:
+                log.info("Loading %s::%s (job %s) from the cache", schema, table, latest_job)
+                return dictionary_decode(feather.read_table(data_path, memory_map=True)).to_pandas()
+
+        data = client.get(table=table, schema=schema, as_df=True)
+        try:
+            encoded = dictionary_encode(data)
+        except Exception as err:
+            log.warning("Could not cache %s::%s: %s", schema, table, err)
+            return data
+
+        # remove the tables of previous jobs
+        table_dir = os.path.dirname(data_path)
+        os.makedirs(table_dir, exist_ok=True)
+        for name in os.listdir(table_dir):
+            if name.endswith(('.arrow', '.json')):
+                os.remove(os.path.join(table_dir, name))
+
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        feather.write_feather(encoded, f'{data_path}{tmp_suffix}', compression='uncompressed')
+        os.replace(f'{data_path}{tmp_suffix}', data_path)
+        with open(f'{meta_path}{tmp_suffix}', 'w', encoding='utf-8') as file:
+            json.dump({str(job): count for job, count in jobs.items()}, file)
+        os.replace(f'{meta_path}{tmp_suffix}', meta_path)
+
+        # return the data as it is read from the cache, so every run gets the same types
+        return dictionary_decode(encoded).to_pandas()
+
+
+staging_cache = StagingCache()
@@ -9,8 +9,8 @@ import logging
 import math
 import os
 import shutil
-import time
 import zipfile
+from typing import Iterator, TextIO
 from zipfile import ZipFile
 
 import pandas as pd
@@ -20,7 +20,7 @@ from dotenv import load_dotenv
 from molgenis_emx2_pyclient import Client
 from erdera.clients.gpap.gpap_client_prod import GpapClient
 import erdera.clients.gpap.gpap_client_types as types
-from erdera.utils.index import date_now, date_today
+from erdera.utils.index import TokenBucket, date_now, date_today, open_zip_csv
 
 load_dotenv()
 
@@ -28,11 +28,173 @@ logging.basicConfig(level=logging.INFO)
 logging.captureWarnings(True)
 log = logging.getLogger("GPAP API")
 
+# primary key of each metadata type in the staging area
+STAGING_AREA_KEYS: dict[str, str] = {
+    'participants': 'report_id',
+    'experiments': 'id'
+}
+
+
+class PageCheckpoint:
+    """Store successfully retrieved pages on disk, so a failed run can be
+    resumed without retrieving the same pages again. Pages are saved as JSON
+    files in <path>/<run id>/<metadata type>/<page>.json"""
+
+    def __init__(self, path: str, run_id: str):
+        """Initialize the checkpoint store
+
+        :param path: root directory of the checkpoints
+        :type path: str
+
+        :param run_id: identifier of the run, used to resume the run
+        :type run_id: str
+        """
+        self.run_path: str = os.path.join(path, run_id)
+
+    def _page_path(self, meta_type: types.MetadataTypes, page: int) -> str:
+        return os.path.join(self.run_path, meta_type, f'{page}.json')
+
+    def pages(self, meta_type: types.MetadataTypes) -> set[int]:
+        """Page numbers that were saved for a metadata type"""
+        meta_path = os.path.join(self.run_path, meta_type)
+        if not os.path.exists(meta_path):
+            return set()
+        return {int(file_name.removesuffix('.json'))
+                for file_name in os.listdir(meta_path) if file_name.endswith('.json')}
+
+    def load(self, meta_type: types.MetadataTypes, page: int) -> list[dict]:
+        """Load the rows of a saved page"""
+        with open(self._page_path(meta_type, page), mode='r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def save(self, meta_type: types.MetadataTypes, page: int, rows: list[dict]):
+        """Save the rows of a page. The file is written under a temporary name
+        first, so an interrupted write never leaves a partial page behind."""
+        page_path = self._page_path(meta_type, page)
+        os.makedirs(os.path.dirname(page_path), exist_ok=True)
+        with open(f'{page_path}.tmp', mode='w', encoding='utf-8') as file:
+            json.dump(rows, file)
+        os.replace(f'{page_path}.tmp', page_path)
+
+    def clear(self):
+        """Remove all pages of the run"""
+        shutil.rmtree(self.run_path, ignore_errors=True)
+
+
+def iter_checkpointed_pages(
+    client, meta_type: types.MetadataTypes, total_pages: int,
+    checkpoint: PageCheckpoint, max_workers: int = 1, rate_limiter: TokenBucket = None
+) -> Iterator[types.PageResult]:
+    """Iterate over all pages in page order. Pages found in the checkpoint are
+    loaded from disk, the remaining pages are retrieved from the API and saved
+    to the checkpoint.
+
+    :param client: a GPAP API instance
+
+    :param meta_type: API metadata type to retrieve, 'participants' or 'experiments'
+    :type meta_type: str
+
+    :param total_pages: total number of pages to retrieve
+    :type total_pages: int
+
+    :param checkpoint: checkpoint store of the current run
+    :type checkpoint: PageCheckpoint
+
+    :returns: the rows of each page, or the error raised while retrieving it
+    :rtype: Iterator[PageResult]
+    """
+    saved_pages = checkpoint.pages(meta_type)
+    missing_pages = [page for page in range(1, int(total_pages) + 1) if page not in saved_pages]
+    if saved_pages:
+        log.info('Resuming %s: %s pages found in checkpoint, %s pages to retrieve',
+                 meta_type, len(saved_pages), len(missing_pages))
+
+    fetched_pages = client.iter_pages(meta_type=meta_type, pages=missing_pages,
+                                      max_workers=max_workers, rate_limiter=rate_limiter)
+    for page in range(1, int(total_pages) + 1):
+        if page in saved_pages:
+            yield {'page': page, 'rows': checkpoint.load(meta_type, page), 'error': None}
+            continue
+
+        result = next(fetched_pages)
+        if result['error'] is None:
+            checkpoint.save(meta_type, page, result['rows'])
+        yield result
+
+
+def init_job_output() -> types.JobOutput:
+    """Create an empty job output object"""
+    return {
+        'data': [],
+        'errors': [],
+        'errorCount': 0,
+        'rowCount': 0,
+        'newCount': 0,
+        'updatedCount': 0,
+        'lastModified': None,
+        'superseded': [],
+    }
+
+
+def page_to_job_output(page: types.PageResult) -> types.JobOutput:
+    """Convert a page retrieved from the GPAP API into a job output object
+
+    :param page: a page as yielded by GpapClient.iter_pages
+    :type page: PageResult
+
+    :returns: object containing successfully retrieved data, statuses, and error count
+    :rtype: AllMetadataOutput
+    """
+    output: types.JobOutput = init_job_output()
+
+    page_num = page['page']
+    err = page['error']
+
+    if isinstance(err, requests.exceptions.HTTPError):
+        page_error = {
+            'type': f'HTTP: {err.response.status_code}',
+            'message': f"Unable to process page {page_num} {err} (HTTP: {err.response.status_code})"
+        }
+
+        output['errorCount'] += 1
+        output['errors'].append(page_error)
+        log.warning(page_error['message'])
+
+    elif isinstance(err, requests.exceptions.RequestException):
+        page_error = {
+            'type': type(err).__name__,
+            'message': f"Unable to process page {page_num} {err} (retries exhausted)"
+        }
+
+        output['errorCount'] += 1
+        output['errors'].append(page_error)
+        log.warning(page_error['message'])
+
+    elif isinstance(err, KeyError):
+        page_error = {'type': 'KeyError', 'message': ''}
+        if err == 'rows':
+            page_error['message'] = f"No data found on page {page_num} ('rows' not found)"
+        else:
+            page_error['message'] = f"Key '{err}' not found"
+
+        output['errorCount'] += 1
+        output['errors'].append(page_error)
+        log.warning(page_error['message'])
+
+    for page_row in page['rows']:
+        if isinstance(page_row, dict):
+            output['data'].append(page_row)
+
+    output['rowCount'] = len(output['data'])
+    return output
+
 
 def get_all_metadata(
-    client, meta_type: types.MetadataTypes, total_pages: int
+    client, meta_type: types.MetadataTypes, total_pages: int,
+    max_workers: int = 1, rate_limiter: TokenBucket = None
 ) -> types.JobOutput:
-    """Retrieve all participant or experiment metadata in batches
+    """Retrieve all participant or experiment metadata in batches. Pages are
+    requested concurrently and reassembled in page order.
 
     :param client: a GPAP API instance
 
@@ -42,61 +204,300 @@ def get_all_metadata(
     :param total_pages: total number of pages to retrieve
     :type total_pages: int
 
+    :param max_workers: number of pages to request in parallel
+    :type max_workers: int (default: 1)
+
+    :param rate_limiter: limits the number of requests per second across all
+        workers (default: 5 requests per second)
+    :type rate_limiter: TokenBucket
+
     :returns: object containing successfully retrieved data, statuses, and error count
     :rtype: AllMetadataOutput
     """
-    output: types.JobOutput = {
-        'data': [],
-        'errors': [],
-        'errorCount': 0,
-    }
+    output: types.JobOutput = init_job_output()
 
-    for page in range(0, total_pages, 1):
-        page_num = page+1
-        try:
-            log.info('Retrieving data from page %s', page_num)
-            page_data_rows: list[dict] = []
-
-            if meta_type == 'participants':
-                page_data = client.get_participants(page=page_num)
-                page_data_rows = page_data['rows']
-            elif meta_type == 'experiments':
-                page_data = client.get_experiments(page=page_num)
-                page_data_rows = page_data['items']
-            else:
-                log.error("Metadata type %s is not recognised", meta_type)
-                break
-
-            for page_row in page_data_rows:
-                if isinstance(page_row, dict):
-                    output['data'].append(page_row)
-
-        except requests.exceptions.HTTPError as err:
-            page_error = {
-                'type': f'HTTP: {err.response.status_code}',
-                'message': f"Unable to process page {page_num} {err} (HTTP: {err.response.status_code})"
-            }
-
-            output['errorCount'] += 1
-            output['errors'].append(page_error)
-            log.warning(page_error['message'])
-
-        except KeyError as err:
-            page_error = {'type': 'KeyError', 'message': ''}
-            if err == 'rows':
-                page_error['message'] = f"No data found on page {page_num} ('rows' not found)"
-            else:
-                page_error['message'] = f"Key '{err}' not found"
-
-            output['errorCount'] += 1
-            output['errors'].append(page_error)
-            log.warning(page_error['message'])
-
-        time.sleep(0.200)
+    if meta_type not in ['participants', 'experiments']:
+        log.error("Metadata type %s is not recognised", meta_type)
+        return output
+
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(rate=5)
+
+    for page in client.iter_pages(meta_type=meta_type, total_pages=total_pages,
+                                  max_workers=max_workers, rate_limiter=rate_limiter):
+        page_output = page_to_job_output(page)
+        output['data'].extend(page_output['data'])
+        output['errors'].extend(page_output['errors'])
+        output['errorCount'] += page_output['errorCount']
+        output['rowCount'] += page_output['rowCount']
 
     return output
 
 
+def write_metadata_csv(
+    client, meta_type: types.MetadataTypes, total_pages: int, file: TextIO,
+    job_id: str, max_workers: int = 1, rate_limiter: TokenBucket = None,
+    existing_ids: dict = None, modified_since: pd.Timestamp = None,
+    incremental: bool = False, checkpoint: PageCheckpoint = None
+) -> types.JobOutput:
+    """Retrieve all participant or experiment metadata and stream each page into
+    a CSV file. Only one batch of pages is kept in memory at a time, so memory use
+    depends on the page size rather than the size of the dataset. The file can be
+    a member of a zip archive (see open_zip_csv).
+
+    :param client: a GPAP API instance
+
+    :param meta_type: API metadata type to retrieve, 'participants' or 'experiments'
+    :type meta_type: str
+
+    :param total_pages: total number of pages to retrieve
+    :type total_pages: int
+
+    :param file: a text stream opened for writing
+    :type file: TextIO
+
+    :param job_id: identifier of the current run, written to the 'added by job' column
+    :type job_id: str
+
+    :param max_workers: number of pages to request in parallel
+    :type max_workers: int (default: 1)
+
+    :param rate_limiter: limits the number of requests per second across all
+        workers (default: 5 requests per second)
+    :type rate_limiter: TokenBucket
+
+    :param existing_ids: identifiers of the records currently in the staging area
+        and the job that added them, used to count new and updated records
+    :type existing_ids: dict
+
+    :param modified_since: high-water mark of the previous run; records with a later
+        last_modification_date are considered updated
+    :type modified_since: pd.Timestamp
+
+    :param incremental: if True, only new and updated records are written, and the
+        staging area rows they replace are listed in the 'superseded' output
+    :type incremental: bool (default: False)
+
+    :param checkpoint: if provided, pages are saved to and resumed from this store
+    :type checkpoint: PageCheckpoint
+
+    :returns: object containing statuses, error count, the number of rows written,
+        new and updated records, and the latest modification date (the data itself
+        is not returned)
+    :rtype: AllMetadataOutput
+    """
+    output: types.JobOutput = init_job_output()
+
+    if meta_type not in ['participants', 'experiments']:
+        log.error("Metadata type %s is not recognised", meta_type)
+        return output
+
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(rate=5)
+
+    # use the requested API fields as header so all pages share the same columns
+    columns: list[str] = list(client.fields[meta_type])
+
+    if checkpoint:
+        pages = iter_checkpointed_pages(client=client, meta_type=meta_type,
+                                        total_pages=total_pages, checkpoint=checkpoint,
+                                        max_workers=max_workers, rate_limiter=rate_limiter)
+    else:
+        pages = client.iter_pages(meta_type=meta_type, total_pages=total_pages,
+                                  max_workers=max_workers, rate_limiter=rate_limiter)
+
+    for page in pages:
+        page_output = page_to_job_output(page)
+        output['errors'].extend(page_output['errors'])
+        output['errorCount'] += page_output['errorCount']
+
+        if not page_output['data']:
+            continue
+
+        page_df = pd.DataFrame(page_output['data'])
+        if not columns:
+            columns = page_df.columns.tolist()
+        page_df = page_df.reindex(columns=columns)
+        page_df = filter_changed_records(page_df=page_df,
+                                         meta_type=meta_type,
+                                         output=output,
+                                         existing_ids=existing_ids,
+                                         modified_since=modified_since,
+                                         incremental=incremental,
+                                         job_id=job_id)
+        if page_df.empty:
+            continue
+
+        page_df['added by job'] = job_id
+        page_df = serialise_nested_values(page_df)
+        page_df.to_csv(file, header=output['rowCount'] == 0, index=False)
+        output['rowCount'] += page_df.shape[0]
+
+    # always write the header so an empty run still produces a valid file
+    if output['rowCount'] == 0:
+        pd.DataFrame(columns=columns + ['added by job']).to_csv(file, index=False)
+
+    return output
+
+
+def serialise_nested_values(page_df: pd.DataFrame) -> pd.DataFrame:
+    """Convert nested values (e.g. features, diagnosis) to JSON, so they are stored
+    in the staging area as JSON rather than as their Python representation
+
+    :param page_df: records of one page
+    :type page_df: pd.DataFrame
+
+    :returns: the records with lists and dictionaries serialised as JSON
+    :rtype: pd.DataFrame
+    """
+    for column in page_df.columns[page_df.dtypes == object]:
+        nested = page_df[column].map(lambda value: isinstance(value, (list, dict)))
+        if nested.any():
+            page_df.loc[nested, column] = page_df.loc[nested, column].map(json.dumps)
+    return page_df
+
+
+def filter_changed_records(
+    page_df: pd.DataFrame, meta_type: types.MetadataTypes, output: types.JobOutput,
+    existing_ids: dict = None, modified_since: pd.Timestamp = None,
+    incremental: bool = False, job_id: str = None
+) -> pd.DataFrame:
+    """Count the new and updated records of a page and, in incremental mode, drop
+    the records that did not change since the previous run. Records are new if
+    their key is not in the staging area, and updated if their last_modification_date
+    is later than the previous high-water mark (or unknown). Experiments do not have
+    a modification date, so only new experiments are detected.
+
+    'added by job' is part of the key of the staging area tables, so an updated
+    record that is written with the current job is added next to its previous
+    version instead of replacing it. In incremental mode, the key and job of the
+    previous versions are added to output['superseded'], so they can be deleted
+    before the records are uploaded.
+
+    :param page_df: a page of participant or experiment metadata
+    :type page_df: pd.DataFrame
+
+    :param meta_type: API metadata type, 'participants' or 'experiments'
+    :type meta_type: str
+
+    :param output: job output object that keeps track of the counts
+    :type output: JobOutput
+
+    :param existing_ids: identifiers of the records in the staging area and the job
+        that added them
+    :type existing_ids: dict
+
+    :param job_id: identifier of the current run
+    :type job_id: str
+
+    :returns: the records that should be written to the staging area
+    :rtype: pd.DataFrame
+    """
+    changed = pd.Series(False, index=page_df.index)
+
+    if 'last_modification_date' in page_df.columns:
+        modification_dates = pd.to_datetime(page_df['last_modification_date'],
+                                            errors='coerce', utc=True, format='mixed')
+        page_latest = modification_dates.max()
+        if pd.notna(page_latest) and (output['lastModified'] is None
+                                      or page_latest > output['lastModified']):
+            output['lastModified'] = page_latest
+
+        if modified_since is not None:
+            changed = (modification_dates > modified_since) | modification_dates.isna()
+        else:
+            changed = pd.Series(True, index=page_df.index)
+
+    if existing_ids is None:
+        return page_df
+
+    key = STAGING_AREA_KEYS[meta_type]
+    previous_jobs = page_df[key].map(existing_ids.get)
+    is_new = previous_jobs.isna()
+    is_updated = changed & ~is_new
+    output['newCount'] += int(is_new.sum())
+    output['updatedCount'] += int(is_updated.sum())
+
+    if incremental:
+        # records that are written again by the same (resumed) run are upserted
+        superseded = is_updated & previous_jobs.ne(job_id)
+        output['superseded'].extend(
+            {key: record_id, 'added by job': previous_job}
+            for record_id, previous_job in zip(page_df.loc[superseded, key], previous_jobs[superseded])
+        )
+        return page_df[is_new | is_updated]
+    return page_df
+
+
+def get_previous_high_water_mark(client: Client) -> pd.Timestamp | None:
+    """Retrieve the latest participant modification date recorded by a previous
+    successful run (Jobs Gpap Api)
+
+    :param client: an authenticated MOLGENIS client
+
+    :returns: the high-water mark or None if there is no previous successful run
+    :rtype: pd.Timestamp | None
+    """
+    jobs = client.get(table='Jobs Gpap Api', schema=os.getenv('SCHEMA_JOBS'), as_df=True)
+    if jobs.empty or 'last modification date' not in jobs.columns:
+        return None
+
+    successful_jobs = jobs[jobs['ok'].eq(True)]
+    high_water_marks = pd.to_datetime(successful_jobs['last modification date'],
+                                      errors='coerce', utc=True).dropna()
+    if high_water_marks.empty:
+        return None
+    return high_water_marks.max()
+
+
+def get_staging_area_ids(client: Client, table: str, key: str,
+                         job_column: str = 'added by job', page_size: int = 10000) -> dict:
+    """Retrieve the identifiers of the records currently in the GPAP staging area
+    and the job that added them. Only these two columns are queried (GraphQL), in
+    pages of page_size records.
+
+    :param client: an authenticated MOLGENIS client
+
+    :param table: name of the staging area table, 'Participants' or 'Experiments'
+    :type table: str
+
+    :param key: name of the identifier column
+    :type key: str
+
+    :param job_column: column with the run id of the job that added the record
+    :type job_column: str (default: 'added by job')
+
+    :param page_size: number of records per query
+    :type page_size: int (default: 10000)
+
+    :returns: the job id per identifier of the records in the staging area
+    :rtype: dict
+    """
+    schema = os.getenv('SCHEMA_GPAP_SOURCE')
+    table_meta = client.get_schema_metadata(name=schema).get_table(by='name', value=table)
+    key_id = table_meta.get_column(by='name', value=key).id
+    job_id = table_meta.get_column(by='name', value=job_column).id
+
+    ids = {}
+    offset = 0
+    while True:
+        query = (f'{{ {table_meta.id}(limit: {page_size}, offset: {offset}) '
+                 f'{{ {key_id} {job_id} {{ id }} }} }}')
+        response = client.session.post(url=f'{client.url}/{schema}/graphql', json={'query': query})
+        response.raise_for_status()
+        body = response.json()
+        if 'errors' in body:
+            raise ValueError(f"Could not retrieve the identifiers of {schema}::{table}: {body['errors']}")
+
+        records = body['data'][table_meta.id] or []
+        for record in records:
+            if record.get(key_id) is not None:
+                ids[record[key_id]] = (record.get(job_id) or {}).get('id')
+        if len(records) < page_size:
+            return ids
+        offset += page_size
+
+
 def prepare_run_metadata() -> types.JobsGpapApi:
     """Prepare run metadata object
     :returns: metadata object for importing into the staging area
@@ -112,38 +513,46 @@ def prepare_run_metadata() -> types.JobsGpapApi:
         'total number of experiments': 0,
         'number of new experiments': 0,
         'number of updated experiments': 0,
+        'last modification date': None,
+        'number of retries': 0,
         'number of errors': 0
     }
 
-async def upload_staging_area_data(participants: pd.DataFrame, experiments: pd.DataFrame, client: Client):
+async def upload_staging_area_data(zip_file_name: str, client: Client, truncate: bool = True,
+                                   superseded: dict[str, list[dict]] = None):
     """Upload the participant and experiment metadata to the 
     GPAP staging area. Upload with a zipped file because the data is too large 
-    to upload otherwise."""
+    to upload otherwise.
+
+    :param zip_file_name: location of the zip archive containing Participants.csv
+        and Experiments.csv
+    :type zip_file_name: str
+
+    :param truncate: if True, the current data is deleted first. Otherwise, the
+        records are upserted (incremental runs)
+    :type truncate: bool (default: True)
+
+    :param superseded: the key and 'added by job' of the records that are replaced
+        by an updated version, per table; deleted first if the data is not truncated
+    :type superseded: dict[str, list[dict]]
+    """
 
     # first, delete the current data 
-    client.truncate(table='Participants', schema=os.getenv('SCHEMA_GPAP_SOURCE'))
-    client.truncate(table='Experiments', schema=os.getenv('SCHEMA_GPAP_SOURCE'))
+    if truncate:
+        client.truncate(table='Participants', schema=os.getenv('SCHEMA_GPAP_SOURCE'))
+        client.truncate(table='Experiments', schema=os.getenv('SCHEMA_GPAP_SOURCE'))
+    else:
+        # 'added by job' is part of the key, so the previous versions of updated
+        # records are not replaced by the upload
+        for table, records in (superseded or {}).items():
+            if records:
+                log.info("Deleting %s superseded records of %s", len(records), table)
+                client.delete_records(table=table, schema=os.getenv('SCHEMA_GPAP_SOURCE'),
+                                      data=pd.DataFrame(records))
 
-    # create a tmp directory to save the files
-    tmp_output_path = f'{os.getenv('OUTPUT_PATH')}tmp'
-    if not os.path.exists(tmp_output_path):
-        os.makedirs(tmp_output_path)
-    participants.to_csv(f'{tmp_output_path}/participants.csv', index=False)
-    experiments.to_csv(f'{tmp_output_path}/experiments.csv', index=False)
-    
-    # initialise an archive 
-    zip_file_name=f'{tmp_output_path}/archive.zip'
-
-    # zip the data
-    with ZipFile(zip_file_name, 'w', zipfile.ZIP_DEFLATED) as my_zip:
-        my_zip.write(f'{tmp_output_path}/Participants.csv', 'Participants.csv')
-        my_zip.write(f'{tmp_output_path}/Experiments.csv', 'Experiments.csv')
     # upload the zipped file
     await client.upload_file(schema=os.getenv('SCHEMA_GPAP_SOURCE'), file_path=zip_file_name)
 
-    # delete the tmp folder and its contents
-    shutil.rmtree(tmp_output_path)
-
 if __name__ == "__main__":
 
     # load api fields
@@ -151,14 +560,54 @@ if __name__ == "__main__":
         fields = json.load(file)
         file.close()
 
+    # concurrency settings: number of parallel page requests and requests per second
+    max_workers = int(os.getenv('GPAP_API_MAX_WORKERS', '4'))
+    rate_limiter = TokenBucket(rate=float(os.getenv('GPAP_API_REQUESTS_PER_SECOND', '5')))
+
     # init client
     gpap = GpapClient(
         api_url=os.getenv("GPAP_PROD_API_URL"),
-        token=os.getenv('GPAP_API_TOKEN')
+        token=os.getenv('GPAP_API_TOKEN'),
+        max_retries=int(os.getenv('GPAP_API_MAX_RETRIES', '5')),
+        pool_size=max_workers
     )
     gpap.api_page_size = 1000
     gpap.fields = fields
 
+    # prepare job metadata
+    api_run_meta = prepare_run_metadata()
+
+    # resume a failed run by setting GPAP_RESUME_RUN_ID to its run id: pages
+    # that were retrieved before are loaded from the checkpoint
+    if os.getenv('GPAP_RESUME_RUN_ID'):
+        api_run_meta['id'] = os.getenv('GPAP_RESUME_RUN_ID')
+    checkpoint = PageCheckpoint(path=f'{os.getenv('OUTPUT_PATH')}checkpoints',
+                                run_id=api_run_meta['id'])
+
+    # sync mode: 'full' replaces the staging area, 'incremental' only upserts
+    # the records that were added or modified since the previous run
+    incremental = os.getenv('GPAP_SYNC_MODE', 'full') == 'incremental'
+
+    # retrieve the state of the staging area to detect new and updated records
+    with Client(url=os.getenv('MOLGENIS_HOST'),
+                token=os.getenv('MOLGENIS_TOKEN')) as molgenis:
+        modified_since = get_previous_high_water_mark(molgenis)
+        existing_participants = get_staging_area_ids(molgenis, 'Participants', 'report_id')
+        existing_experiments = get_staging_area_ids(molgenis, 'Experiments', 'id')
+
+    log.info("Running %s sync (participants modified since %s)",
+             'incremental' if incremental else 'full', modified_since)
+
+    # create a tmp directory for the archive the data is streamed into
+    tmp_output_path = f'{os.getenv('OUTPUT_PATH')}tmp'
+    if not os.path.exists(tmp_output_path):
+        os.makedirs(tmp_output_path)
+
+    # initialise an archive; the compression level trades CPU time for upload size
+    zip_file_name = f'{tmp_output_path}/archive.zip'
+    archive = ZipFile(zip_file_name, 'w', zipfile.ZIP_DEFLATED,
+                      compresslevel=int(os.getenv('GPAP_UPLOAD_COMPRESSION_LEVEL', '6')))
+
     # retrieve all participants
     participants: types.ParticipantsResponse = gpap.get_participants()
 
@@ -171,11 +620,20 @@ if __name__ == "__main__":
     log.info("Fetching participant metadata (%s records over %s pages)",
              participants['total'], total_api_pages)
 
-    all_participants = get_all_metadata(
-        client=gpap,
-        meta_type='participants',
-        total_pages=total_api_pages
-    )
+    with open_zip_csv(archive, 'Participants.csv') as file:
+        all_participants = write_metadata_csv(
+            client=gpap,
+            meta_type='participants',
+            total_pages=total_api_pages,
+            file=file,
+            job_id=api_run_meta['id'],
+            max_workers=max_workers,
+            rate_limiter=rate_limiter,
+            existing_ids=existing_participants,
+            modified_since=modified_since,
+            incremental=incremental,
+            checkpoint=checkpoint
+        )
 
     # retrieve all experiments
     experiments: types.ExperimentsResponse = gpap.get_experiments()
@@ -183,25 +641,39 @@ if __name__ == "__main__":
              experiments['_meta']['total_items'],
              experiments['_meta']['total_pages'])
 
-    all_experiments = get_all_metadata(
-        client=gpap,
-        meta_type='experiments',
-        total_pages=experiments['_meta']['total_pages']
-    )
-
-    # prepare exports and job metadata
-    api_run_meta = prepare_run_metadata()
-
-    participants_df = pd.DataFrame(all_participants['data'])
-    experiments_df = pd.DataFrame(all_experiments['data'])
-
-    participants_df['added by job'] = api_run_meta['id']
-    experiments_df['added by job'] = api_run_meta['id']
-
-    api_run_meta['total number of participants'] = participants_df.shape[0]
-    api_run_meta['total number of experiments'] = experiments_df.shape[0]
+    with open_zip_csv(archive, 'Experiments.csv') as file:
+        all_experiments = write_metadata_csv(
+            client=gpap,
+            meta_type='experiments',
+            total_pages=experiments['_meta']['total_pages'],
+            file=file,
+            job_id=api_run_meta['id'],
+            max_workers=max_workers,
+            rate_limiter=rate_limiter,
+            existing_ids=existing_experiments,
+            incremental=incremental,
+            checkpoint=checkpoint
+        )
+    archive.close()
+
+    # summarise the run
+    api_run_meta['total number of participants'] = all_participants['rowCount']
+    api_run_meta['total number of experiments'] = all_experiments['rowCount']
+    api_run_meta['number of new participants'] = all_participants['newCount']
+    api_run_meta['number of updated participants'] = all_participants['updatedCount']
+    api_run_meta['number of new experiments'] = all_experiments['newCount']
+    api_run_meta['number of updated experiments'] = all_experiments['updatedCount']
+
+    # keep the previous high-water mark if no modification dates were retrieved
+    last_modified = all_participants['lastModified'] or modified_since
+    if last_modified is not None:
+        api_run_meta['last modification date'] = last_modified.strftime('%Y-%m-%dT%H:%M:%S')
     api_run_meta['number of errors'] = len(all_participants['errors']) + \
         len(all_experiments['errors'])
+    api_run_meta['number of retries'] = gpap.retry_count
+
+    if gpap.retry_count:
+        log.info('Retried %s requests %s', gpap.retry_count, gpap.retries)
 
     if api_run_meta['number of errors'] == 0:
         log.info('No errors detected')
@@ -244,7 +716,17 @@ if __name__ == "__main__":
                 schema= os.getenv('SCHEMA_GPAP_SOURCE'),
                 token=os.getenv('MOLGENIS_TOKEN')) as molgenis:
 
-        asyncio.run(upload_staging_area_data(participants=participants_df,
-                                             experiments=experiments_df,
-                                             client=molgenis))
+        asyncio.run(upload_staging_area_data(zip_file_name=zip_file_name,
+                                             client=molgenis,
+                                             truncate=not incremental,
+                                             superseded={
+                                                 'Participants': all_participants['superseded'],
+                                                 'Experiments': all_experiments['superseded']
+                                             }))
+
+    # delete the tmp folder and its contents
+    shutil.rmtree(tmp_output_path)
+
+    # the data is uploaded, the run no longer needs to be resumed
+    checkpoint.clear()
     
\ No newline at end of file
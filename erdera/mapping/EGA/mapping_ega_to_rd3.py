@@ -3,15 +3,18 @@
 import asyncio
 import re
 import os
+import sys
 import logging
 import shutil
-import zipfile
-from zipfile import ZipFile
 
 import pandas as pd
 from dotenv import load_dotenv
 
 from molgenis_emx2_pyclient.client import Client
+from erdera.clients.molgenis_registry import molgenis_clients
+from erdera.clients.staging_cache import staging_cache
+from erdera.utils.pipeline import Pipeline, Stage
+from erdera.utils.index import write_zip_archive
 
 load_dotenv()
 
@@ -21,12 +24,10 @@ log = logging.getLogger("Staging Area Mapping")
 def get_staging_area_data(endpoint: str):
     """Retrieve metadata from the staging area (/<staging area>/<endpoint>)"""
     logging.info(f'Retrieving {endpoint} EGA information from staging area')
-    with Client(os.environ['MOLGENIS_HOST'], token=os.environ['MOLGENIS_TOKEN']) as client_ind:
-        return client_ind.get(
-            table=endpoint,
-            schema=os.environ['SCHEMA_EGA_SOURCE'],
-            as_df=True
-        )
+    return staging_cache.get(
+        table=endpoint,
+        schema=os.environ['SCHEMA_EGA_SOURCE']
+    )
     
 def add_collections(client: Client): 
     """Create collections table based on datasets and studies from the EGA."""
@@ -78,6 +79,14 @@ def add_collections(client: Client):
     return {'dataset_id': dataset_accession_id,
             'study_id': study_accession_id} # return accession IDs
 
+def get_accession_ids() -> dict:
+    """Accession IDs of the EGA dataset and study in the staging area, as returned by
+    add_collections, e.g. to map the files without mapping the collections again"""
+    dataset = get_staging_area_data(endpoint='dataset')
+    study = get_staging_area_data(endpoint='studies')
+    return {'dataset_id': dataset['accession_id'].iloc[0],
+            'study_id': study['accession_id'].iloc[0]}
+
 async def upload_files(client: Client, accession_ids: str):
     """Zip the files and upload to RD3"""
     # get the files df
@@ -87,14 +96,11 @@ async def upload_files(client: Client, accession_ids: str):
     tmp_output_path = f'{os.environ['OUTPUT_PATH']}tmp'
     if not os.path.exists(tmp_output_path):
         os.makedirs(tmp_output_path)
-    files.to_csv(f'{tmp_output_path}/Files.csv', index=False)
-    
-    # initialise an archive 
+
+    # write the data straight into the archive
     zip_file_name=f'{tmp_output_path}/archive.zip'
+    write_zip_archive(frames={'Files': files}, file_path=zip_file_name)
 
-    # zip the data
-    with ZipFile(zip_file_name, 'w', zipfile.ZIP_DEFLATED) as my_zip:
-        my_zip.write(f'{tmp_output_path}/Files.csv', 'Files.csv')
     # upload the zipped file
     await client.upload_file(schema=os.environ['MOLGENIS_HOST_SCHEMA_TARGET'], file_path=zip_file_name)
 
@@ -196,13 +202,33 @@ def ega_to_files(client: Client, accession_ids: str):
     # return 
     return files
     
+def build_pipeline(client: Client) -> Pipeline:
+    """Define the mapping of the EGA data to RD3 as stages with their dependencies"""
+    def files():
+        # the collections are not mapped if only the files are (re-)run
+        if 'collections' in pipeline.results:
+            accession_ids = pipeline.result('collections')
+        else:
+            accession_ids = get_accession_ids()
+        return asyncio.run(upload_files(client=client, accession_ids=accession_ids))
+
+    pipeline = Pipeline([
+        Stage('collections', lambda: add_collections(client)),
+        Stage('files', files, depends_on=['collections'])
+    ])
+    return pipeline
+
 if __name__ == "__main__":
 
-    db = Client(
-        os.environ['MOLGENIS_HOST'],
-        schema=os.environ['MOLGENIS_HOST_SCHEMA_TARGET'],
-        token=os.environ['MOLGENIS_TOKEN']
-    )
+    db = molgenis_clients.get(schema=os.environ['MOLGENIS_HOST_SCHEMA_TARGET'])
+
+    # map the collections and files, or only the (comma separated) stages in MAPPING_STAGES
+    pipeline = build_pipeline(client=db)
+    stages = os.environ.get('MAPPING_STAGES')
+    pipeline.run(only=stages.split(',') if stages else None,
+                 max_workers=int(os.environ.get('MAPPING_MAX_WORKERS', 4)))
+
+    molgenis_clients.close()
 
-    accession_ids = add_collections(db)
-    asyncio.run(upload_files(client=db, accession_ids=accession_ids))
+    if pipeline.failed:
+        sys.exit(f'The following stages did not succeed: {pipeline.failed}')
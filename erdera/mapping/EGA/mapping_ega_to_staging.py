@@ -3,17 +3,23 @@ Fetch EGA data using the egaClient
 This script logs into the EGA API and fetches the metadata belonging to an EGA dataset (with provisional ID)
 """
 
+import json
 import os
 import logging
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 from datetime import datetime
-import time
 
 import pandas as pd
 from dotenv import load_dotenv
 
 from molgenis_emx2_pyclient import Client
+from molgenis_emx2_pyclient.utils import data_to_csv
 from erdera.clients.egaClient import EGASubmissionsClient
+from erdera.utils.index import TokenBucket
 
 load_dotenv()
 
@@ -66,48 +72,195 @@ def prepare_run_metadata():
         'number of errors': 0,
     }
 
-if __name__ == "__main__":
+# EGA dataset endpoints imported into the staging area
+ENDPOINTS: list[str] = ['studies', 'samples', 'analyses', 'files', 'mappings/sample_file', 'mappings/analysis_sample', \
+                        'mappings/study_analysis_sample', 'experiments', 'runs', 'mappings/run_sample',
+                        'mappings/study_experiment_run_sample']
 
-    # retrieve the data
-    ega_output_data = {}
-    endpoints = ['studies', 'samples', 'analyses', 'files', 'mappings/sample_file', 'mappings/analysis_sample', \
-                 'mappings/study_analysis_sample', 'experiments', 'runs', 'mappings/run_sample', 'mappings/study_experiment_run_sample']
-    client = EGASubmissionsClient()
-    provisional_id = environ['PROVISIONAL_ID']
+class PageSpool:
+    """Write the pages of the EGA endpoints to disk as they are retrieved, one
+    JSON lines file per staging area table, so the records of all endpoints and
+    datasets are not kept in memory until they are uploaded. Pages are written
+    from multiple threads."""
 
-    api_run_errors = []
-    api_run_meta = prepare_run_metadata()
-    ega_output_data = {}
-    for endpoint in endpoints:
-        try:
-            logging.info(f'Fetching data from {endpoint}')
-            endpoint_clean = endpoint.replace('mappings/', '')
-            include_headers = True
-            if endpoint == 'files':
-                include_headers = False
-            response = client.get_endpoint_dataset(provisional_id=provisional_id, endpoint=endpoint, include_headers=include_headers)
-            dataset = pd.DataFrame(response.get('data'))
-            dataset['added by job'] = api_run_meta['id']   
-            ega_output_data[endpoint_clean] = dataset
-            api_run_meta[f'total number of {endpoint_clean}'] = dataset.shape[0]
-        
-            if response.get('errors'):
-                api_run_errors.extend(response.errors)
-                api_run_meta['number of errors'] += response.get('errorCount')
-            time.sleep(0.4)
-        except Exception as error:
-            logging.error(f'Error in processing endpoint {endpoint}')
+    def __init__(self, path: str):
+        """
+        :param path: directory of the files
+        :type path: str
+        """
+        self.path = path
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _file_path(self, table: str) -> str:
+        return os.path.join(self.path, f'{table}.jsonl')
+
+    @property
+    def tables(self) -> list[str]:
+        """Names of the tables of which records were written"""
+        return list(self._locks)
+
+    def write(self, table: str, rows: list[dict]):
+        """Append records to a table"""
+        with self._lock:
+            lock = self._locks.setdefault(table, threading.Lock())
+        with lock, open(self._file_path(table), mode='a', encoding='utf-8') as file:
+            for row in rows:
+                file.write(json.dumps(row))
+                file.write('\n')
+
+    def read(self, table: str) -> pd.DataFrame:
+        """Read the records of a table"""
+        with open(self._file_path(table), mode='r', encoding='utf-8') as file:
+            return pd.DataFrame([json.loads(line) for line in file])
+
+
+def fetch_dataset(client: EGASubmissionsClient, provisional_id: str, spool: PageSpool,
+                  max_workers: int = 4, rate_limiter: TokenBucket = None, page_size: int = None):
+    """Fetch all endpoints of an EGA dataset and write their records to the spool,
+    per staging area table
+
+    :param client: an authenticated EGA client
+    :param provisional_id: the EGA provisional ID of the dataset
+    :param spool: the records are written to this spool as they are retrieved
+
+    :returns: the errors and error count
+    :rtype: dict
+    """
+    output = {
+        'errors': [],
+        'errorCount': 0,
+    }
+
+    def write_page(endpoint: str, rows: list[dict]):
+        spool.write(endpoint.replace('mappings/', ''), rows)
+
+    # the endpoints are independent, so they are fetched in parallel
+    responses = client.get_endpoints_dataset(provisional_id=provisional_id,
+                                             endpoints=ENDPOINTS,
+                                             exclude_headers=['files'],
+                                             max_workers=max_workers,
+                                             rate_limiter=rate_limiter,
+                                             page_size=page_size,
+                                             write_page=write_page)
+    for response in responses.values():
+        if response.get('errors'):
+            output['errors'].extend(response.get('errors'))
+            output['errorCount'] += response.get('errorCount')
 
     # fetching the information from the datasets endpoint
-    logging.info('Fetching data from datasets')
+    logging.info(f'Fetching data from datasets ({provisional_id})')
+    if rate_limiter:
+        rate_limiter.acquire()
     response = client.get_endpoint_dataset(provisional_id=provisional_id, include_headers=False)
-    dataset = pd.DataFrame([response.get('data')])
-    dataset['added by job'] = api_run_meta['id']
-    ega_output_data['dataset'] = dataset
+    if response.get('data'):
+        spool.write('dataset', [response.get('data')])
     if response.get('errors'):
-        api_run_errors.extend(response.errors)
-        api_run_meta['number of errors'] += response.get('errorCount')
-    api_run_meta['total number of datasets'] = dataset.shape[0]
+        output['errors'].extend(response.get('errors'))
+        output['errorCount'] += response.get('errorCount')
+
+    return output
+
+def fetch_datasets(client: EGASubmissionsClient, provisional_ids: list[str], spool: PageSpool,
+                   dataset_workers: int = 2, max_workers: int = 4,
+                   rate_limiter: TokenBucket = None, page_size: int = None):
+    """Fetch multiple EGA datasets in parallel and write their records to the spool,
+    per staging area table. All workers share the EGA client (and its token) and the
+    rate limit.
+
+    :param client: an authenticated EGA client
+    :param provisional_ids: the EGA provisional IDs of the datasets
+    :param spool: the records are written to this spool as they are retrieved
+    :param dataset_workers: number of datasets fetched in parallel
+
+    :returns: the errors and error count
+    :rtype: dict
+    """
+    output = {
+        'errors': [],
+        'errorCount': 0,
+    }
+
+    def fetch(provisional_id: str):
+        return fetch_dataset(client=client, provisional_id=provisional_id, spool=spool,
+                             max_workers=max_workers, rate_limiter=rate_limiter, page_size=page_size)
+
+    with ThreadPoolExecutor(max_workers=dataset_workers) as executor:
+        for dataset_output in executor.map(fetch, provisional_ids):
+            output['errors'].extend(dataset_output['errors'])
+            output['errorCount'] += dataset_output['errorCount']
+
+    return output
+
+def get_provisional_ids() -> list[str]:
+    """EGA provisional IDs of the datasets to import, from PROVISIONAL_IDS (a
+    comma-separated list) or PROVISIONAL_ID
+
+    :returns: the provisional IDs, empty if neither variable is set
+    :rtype: list[str]
+    """
+    provisional_ids = environ.get('PROVISIONAL_IDS', environ.get('PROVISIONAL_ID', ''))
+    return [provisional_id.strip() for provisional_id in provisional_ids.split(',') if provisional_id.strip()]
+
+def load_staging_table(spool: PageSpool, table: str, job_id: str) -> pd.DataFrame:
+    """Combine the records of a staging area table of all datasets
+
+    :param spool: the spool the records were written to
+    :param table: name of the staging area table
+    :param job_id: identifier of the current run, written to the 'added by job' column
+
+    :returns: the records of the table
+    :rtype: pd.DataFrame
+    """
+    data = spool.read(table)
+    data['added by job'] = job_id
+    # datasets can share records (e.g., the same study), keep them once;
+    # compare as text, since some columns hold lists or dicts
+    return data[~data.astype(str).duplicated()]
+
+if __name__ == "__main__":
+
+    # datasets to import: a comma-separated list of EGA provisional IDs
+    provisional_ids = get_provisional_ids()
+    if not provisional_ids:
+        sys.exit('No datasets to import: set PROVISIONAL_IDS or PROVISIONAL_ID')
+
+    # concurrency settings: number of parallel datasets, parallel requests per dataset, and requests per second
+    dataset_workers = int(os.getenv('EGA_DATASET_MAX_WORKERS', '2'))
+    max_workers = int(os.getenv('EGA_API_MAX_WORKERS', '4'))
+    rate_limiter = TokenBucket(rate=float(os.getenv('EGA_API_REQUESTS_PER_SECOND', '2.5')))
+
+    client = EGASubmissionsClient(pool_size=dataset_workers * max_workers)
+
+    api_run_errors = []
+    api_run_meta = prepare_run_metadata()
+
+    # the retrieved records are written to a temporary spool, and prepared for
+    # the upload one table at a time
+    spool_dir = tempfile.TemporaryDirectory()
+    spool = PageSpool(spool_dir.name)
+
+    # retrieve the data
+    ega_output = fetch_datasets(client=client,
+                                provisional_ids=provisional_ids,
+                                spool=spool,
+                                dataset_workers=dataset_workers,
+                                max_workers=max_workers,
+                                rate_limiter=rate_limiter,
+                                page_size=int(os.getenv('EGA_API_PAGE_SIZE', '1000')))
+    api_run_errors.extend(ega_output['errors'])
+    api_run_meta['number of errors'] += ega_output['errorCount']
+
+    staging_files = {}
+    for table in spool.tables:
+        dataset = load_staging_table(spool=spool, table=table, job_id=api_run_meta['id'])
+        if table == 'dataset':
+            api_run_meta['total number of datasets'] = dataset.shape[0]
+        else:
+            api_run_meta[f'total number of {table}'] = dataset.shape[0]
+        staging_files[table] = os.path.join(spool_dir.name, f'{table}.csv')
+        data_to_csv(dataset, staging_files[table])
+        del dataset
         
     if api_run_errors:
         api_run_errors = pd.DataFrame(api_run_errors)
@@ -120,22 +273,19 @@ if __name__ == "__main__":
     api_run_meta_df = pd.DataFrame([api_run_meta])
     api_run_meta_df['ok'] = api_run_meta_df['ok'].replace({True:'true', False: 'false'})
 
-    # upload the data
+    # upload the data using a single session
     with Client(url=os.getenv('MOLGENIS_HOST'),
                 schema= os.getenv('SCHEMA_JOBS'),
                 token=os.getenv('MOLGENIS_TOKEN')) as molgenis:
 
         molgenis.save_schema(table='Jobs Ega Api', data=api_run_meta_df)
 
-        if api_run_errors:
+        if len(api_run_errors):
             molgenis.save_schema(
                 table='Job errors', data=api_run_errors)
     
-    for key in ega_output_data.keys():        
-        # import into the staging area 
-        with Client(url=os.getenv('MOLGENIS_HOST'),
-                    schema= os.getenv('SCHEMA_EGA_SOURCE'),
-                    token=os.getenv('MOLGENIS_TOKEN')) as molgenis:
+        # import into the staging area, one upload per table
+        for key, file_path in staging_files.items():
+            molgenis.save_schema(table=key, name=os.getenv('SCHEMA_EGA_SOURCE'), file=file_path)
 
-            molgenis.save_schema(table=key, data=ega_output_data[key])
-    
+    spool_dir.cleanup()
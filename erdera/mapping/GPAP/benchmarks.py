@@ -0,0 +1,373 @@
+"""Benchmarks of the GPAP to RD3 mapping functions.
+Every benchmark compares the current implementation to the previous
+(row-by-row) implementation on synthetic staging area data, checks that both
+produce the same output and reports the timings.
+
+Run with `python -m erdera.mapping.GPAP.benchmarks`; the number of synthetic
+participants and experiments is set with BENCHMARK_PARTICIPANTS and
+BENCHMARK_EXPERIMENTS (default: 20000).
+"""
+import logging
+import random
+import timeit
+import tracemalloc
+from os import environ
+
+import numpy as np
+import pandas as pd
+
+from erdera.mapping.GPAP import mapping_cnag_to_rd3
+from erdera.mapping.GPAP.mapping_cnag_to_rd3 import (
+    get_missing_entries, get_quality_control_mismatches, get_term_matches, parse_entries,
+    parse_phenotype_observations)
+from erdera.mapping.GPAP.mapping_cnag_experiments_to_rd3 import (
+    get_affiliated_organisations, get_included_in_resources)
+from erdera.utils.model_types import apply_model_dtypes
+from erdera.utils.ontology_index import OntologyIndex, normalise_code, normalise_codes
+
+
+def legacy_phenotype_observations(data: pd.DataFrame, id_map: pd.Series):
+    """Previous implementation of the phenotype observations parsing (iterrows)"""
+    phen_observations = data[['features', 'report_id']].rename(columns={'features': 'type'})
+
+    pheno_observations2 = []
+    observations = set()
+    for _, pheno_obs in phen_observations.iterrows():
+        id = id_map.get(pheno_obs['report_id'])
+        if pd.isna(id):
+            continue
+
+        for observation in parse_entries(pheno_obs.get('type')):
+            name = observation.get('name')
+            if name is None:
+                continue
+
+            pheno_observations2.append({
+                'part of clinical observation': id,
+                'type': name,
+                'excluded': not observation.get('observed'),
+                'phenotype code': observation.get('id')
+            })
+            observations.add((name, observation.get('id')))
+
+    return pd.DataFrame(pheno_observations2), observations
+
+
+def legacy_included_in_resources(srDNA: pd.DataFrame) -> pd.Series:
+    """Previous implementation of the included in resources column (apply per row)"""
+    return srDNA[['tmp', 'tmp2', 'subproject']].apply(lambda x: ','.join(pd.unique(x.dropna())), axis=1)
+
+
+def legacy_affiliated_organisations(srDNA: pd.DataFrame) -> pd.Series:
+    """Previous implementation of the affiliated organisations column (iterrows)"""
+    srDNA = srDNA.copy()
+    srDNA['affiliated organisations'] = None
+    for index, row in srDNA.iterrows():
+        erns = row['erns']
+        owner = row['Owner']
+        if not pd.isna(erns):
+            srDNA.loc[index, 'affiliated organisations'] = ','.join(str(field) for field in [erns, owner] if pd.notna(field))
+    return srDNA['affiliated organisations']
+
+
+def legacy_quality_control_filter(quality_control_upload: pd.DataFrame, mapping: dict) -> pd.DataFrame:
+    """Previous filter of the mismatches with a mapping (tuple per row)"""
+    return quality_control_upload[~quality_control_upload[['GPAP name', 'GPAP code']] \
+    .apply(tuple, axis=1).isin(set(mapping))]
+
+
+def legacy_missing_entries(rd3_data: set, non_matches: set, new_value: pd.DataFrame) -> pd.DataFrame:
+    """Previous implementation of the missing entries (sets and a merge with indicator)"""
+    missing_codes = set([i[1] for i in non_matches]) - set([i[1] for i in rd3_data])
+    non_matches_dict = {y: x for x,y in non_matches}
+    missing_df = pd.DataFrame({
+        'source': 'phenostore_service/api/participants_by_exp/features',
+        'incoming value': non_matches_dict.get(code),
+        'incoming code': code
+    }
+    for code in missing_codes)
+    return (missing_df.merge(new_value[['source', 'incoming value', 'incoming code']].drop_duplicates(),
+            on=['source', 'incoming value', 'incoming code'],
+            how='left',
+            indicator=True)
+            .query("_merge == 'left_only'")
+            .drop(columns='_merge'))
+
+
+def generate_ontology_fixture(n_terms: int = 18000, n_observed: int = 8000, seed: int = 42):
+    """Generate an HPO-sized RD3 ontology and GPAP observations of which a part
+    differs from RD3 in case and prefix only, on the name, on the code or is missing
+    in RD3.
+
+    :param n_terms: number of terms in the RD3 ontology (HPO has ~18k terms)
+    :type n_terms: int
+
+    :param n_observed: number of distinct (name, code) pairs in GPAP
+    :type n_observed: int
+
+    :param seed: seed of the random generator
+    :type seed: int
+
+    :returns: the RD3 pairs, the non-matching GPAP pairs, the QC mapping and the
+        ontology mappings with a new value
+    :rtype: tuple[set, set, dict, pd.DataFrame]
+    """
+    rng = random.Random(seed)
+    rd3_data = {(f'Phenotype {i}', f'HP:{i:07d}') for i in range(n_terms)}
+
+    non_matches = set()
+    for i in rng.sample(range(n_terms), n_observed):
+        case = rng.random()
+        if case < 0.2:
+            non_matches.add((f'phenotype  {i}', f'{i:07d}'))  # case, whitespace and prefix
+        elif case < 0.4:
+            non_matches.add((f'Phenotype {i} of the skin', f'HP:{i:07d}'))  # name mismatch
+        elif case < 0.8:
+            non_matches.add((f'Phenotype {i}', f'HP:{i + n_terms:07d}'))  # code mismatch
+        else:
+            non_matches.add((f'Phenotype {i + n_terms}', f'HP:{i + 2 * n_terms:07d}'))  # missing in RD3
+
+    mapping = {pair: pair[0].capitalize() for pair in rng.sample(sorted(non_matches), len(non_matches) // 10)}
+    corrected = rng.sample(sorted(non_matches), len(non_matches) // 10)
+    new_value = pd.DataFrame({
+        'source': 'phenostore_service/api/participants_by_exp/features',
+        'incoming value': [name for name, _ in corrected],
+        'incoming code': [code for _, code in corrected],
+        'new value': [name for name, _ in corrected]
+    })
+    return rd3_data, non_matches, mapping, new_value
+
+
+def generate_participants(n: int, seed: int = 42) -> pd.DataFrame:
+    """Generate synthetic staging area participants.
+
+    :param n: number of participants
+    :type n: int
+
+    :param seed: seed of the random generator
+    :type seed: int
+
+    :returns: participants with the columns as in the GPAP staging area
+    :rtype: pd.DataFrame
+    """
+    rng = random.Random(seed)
+    participants = []
+    for i in range(n):
+        features = [{
+            'name': f'Phenotype {rng.randint(1, 500)}',
+            'observed': rng.choice([True, False]),
+            'id': rng.choice([f'HP:{rng.randint(1, 99999):07d}', None])
+        } for _ in range(rng.randint(0, 8))]
+
+        participants.append({
+            'report_id': f'P{i:07d}',
+            'features': str(features) if features else rng.choice([None, '[]']),
+        })
+    return pd.DataFrame(participants)
+
+
+def generate_staging_participants(participants: pd.DataFrame, seed: int = 42) -> pd.DataFrame:
+    """Add the low-cardinality columns of the GPAP staging area to synthetic
+    participants, with the dtypes as retrieved with the pyclient (strings, stored
+    as Python objects as without pyarrow, so tracemalloc measures their memory)
+
+    :param participants: synthetic participants (see generate_participants)
+    :type participants: pd.DataFrame
+
+    :param seed: seed of the random generator
+    :type seed: int
+
+    :returns: participants with the columns used by the participant mapping
+    :rtype: pd.DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    n = len(participants)
+    return participants.assign(
+        id=[f'ID{i:07d}' for i in range(n)],
+        famid=[f'F{i // 3:07d}' for i in range(n)],
+        family_id=[f'FAM{i // 3:07d}' for i in range(n)],
+        index=rng.choice(['Yes', 'No'], size=n),
+        sex=rng.choice(['M', 'F', None], size=n),
+        lifeStatus=rng.choice(['Alive', 'Deceased', None], size=n),
+        affectedStatus=rng.choice(['Affected', 'Unaffected', None], size=n),
+        solved=rng.choice(['Solved', 'Unsolved', None], size=n),
+        consanguinity=rng.choice(['Yes', 'No', None], size=n),
+        otheraffected=rng.choice(['Yes', 'No', None], size=n),
+        mme=rng.choice(['Yes', 'No', None], size=n),
+        onset=rng.choice(['HP:0011463', 'HP:0003577', 'HP:0003621', 'Unknown', None], size=n),
+        baselineage=rng.choice(['12', '40', '3', None], size=n),
+        report_date=None,
+        last_modification_date=None
+    ).astype(pd.StringDtype('python'))
+
+
+class NullClient:
+    """Discard the uploads of a mapping"""
+    def get(self, *args, **kwargs):
+        return pd.DataFrame()
+
+    def save_schema(self, *args, **kwargs):
+        pass
+
+    save_table = delete_records = save_schema
+
+
+def generate_experiments(n: int, seed: int = 42) -> pd.DataFrame:
+    """Generate synthetic experiments, after the project and ERN mapping.
+
+    :param n: number of experiments
+    :type n: int
+
+    :param seed: seed of the random generator
+    :type seed: int
+
+    :returns: experiments with the project, subproject, erns and Owner columns
+    :rtype: pd.DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    experiments = pd.DataFrame({
+        'project': rng.choice(['Solve-RD', 'ERDERA', 'Solve-RD,ERDERA', None], size=n),
+        'subproject': rng.choice(['ERDERA_PF1', 'ERDERA_PF2', 'Solve-RD', None], size=n),
+        'erns': rng.choice(['ERN-RND', 'ERN-ITHACA', 'ERN-EURO-NMD', None], size=n),
+        'Owner': rng.choice(['CNAG', 'Radboudumc', 'UKT', None], size=n)
+    })
+    experiments['tmp'] = np.where(experiments['project'].str.contains('Solve-RD', na=False), 'Solve-RD', pd.NA)
+    experiments['tmp2'] = np.where(experiments['project'].str.contains('ERDERA', na=False), 'ERDERA', pd.NA)
+    return experiments
+
+
+def benchmark(name: str, current, legacy, number: int = 3):
+    """Time the current and the legacy implementation and print the speed-up"""
+    current_time = min(timeit.repeat(current, number=1, repeat=number))
+    legacy_time = min(timeit.repeat(legacy, number=1, repeat=number))
+    print(f'{name}: {legacy_time:.3f}s -> {current_time:.3f}s ({legacy_time / current_time:.1f}x)')
+
+
+def benchmark_phenotype_observations(participants: pd.DataFrame):
+    """Compare the vectorized phenotype observations parsing to the iterrows loop"""
+    # leave some individuals without a clinical observation
+    id_map = pd.Series(range(len(participants)), index=participants['report_id']).sample(frac=0.95, random_state=1)
+
+    current, current_obs = parse_phenotype_observations(data=participants, id_map=id_map)
+    legacy, legacy_obs = legacy_phenotype_observations(data=participants, id_map=id_map)
+    # features without an id have None as code, the legacy frame infers NaN from the None of its rows
+    pd.testing.assert_frame_equal(current.fillna({'phenotype code': ''}), legacy.fillna({'phenotype code': ''}),
+                                  check_dtype=False)
+    assert current_obs == legacy_obs
+
+    benchmark('Phenotype observations',
+              lambda: parse_phenotype_observations(data=participants, id_map=id_map),
+              lambda: legacy_phenotype_observations(data=participants, id_map=id_map))
+
+
+def benchmark_experiments(experiments: pd.DataFrame):
+    """Compare the column-wise included in resources and affiliated organisations to
+    the row-wise implementations"""
+    resources = get_included_in_resources(experiments['tmp'], experiments['tmp2'], experiments['subproject'])
+    assert resources.tolist() == legacy_included_in_resources(experiments).tolist()
+
+    organisations = get_affiliated_organisations(experiments['erns'], experiments['Owner'])
+    assert organisations.tolist() == legacy_affiliated_organisations(experiments).tolist()
+
+    benchmark('Included in resources',
+              lambda: get_included_in_resources(experiments['tmp'], experiments['tmp2'], experiments['subproject']),
+              lambda: legacy_included_in_resources(experiments))
+    benchmark('Affiliated organisations',
+              lambda: get_affiliated_organisations(experiments['erns'], experiments['Owner']),
+              lambda: legacy_affiliated_organisations(experiments),
+              number=1)
+
+
+def benchmark_mismatch_detection(rd3_data: set, non_matches: set, mapping: dict, new_value: pd.DataFrame):
+    """Compare the keyed (MultiIndex) mapping filter to the tuple based version, and the
+    missing entries (an anti-join on the normalised codes) to the previous version with
+    a merge"""
+    def sort(data: pd.DataFrame) -> pd.DataFrame:
+        return data.sort_values(list(data.columns)).reset_index(drop=True)
+
+    # the mismatches are detected the same way, only the mapping filter differs
+    index = OntologyIndex(pd.DataFrame(list(rd3_data), columns=['name', 'code']))
+    matches = get_term_matches(index=index, non_matches=non_matches)
+    quality_control = get_quality_control_mismatches(matches=matches, mapping={})
+    pd.testing.assert_frame_equal(
+        sort(quality_control[~pd.MultiIndex.from_frame(quality_control[['GPAP name', 'GPAP code']]).isin(list(mapping))]),
+        sort(legacy_quality_control_filter(quality_control, mapping)))
+
+    # the previous version compared the codes with their prefix, e.g. '0001250' was
+    # missing if RD3 has 'HP:0001250'; the normalised RD3 codes are computed once per ontology
+    rd3_codes = normalise_codes(pd.Series([code for _, code in rd3_data]))
+    legacy_missing = legacy_missing_entries(rd3_data=rd3_data, non_matches=non_matches, new_value=new_value)
+    pd.testing.assert_frame_equal(
+        sort(get_missing_entries(rd3_codes=rd3_codes, non_matches=non_matches, new_value=new_value)),
+        sort(legacy_missing[~legacy_missing['incoming code'].map(normalise_code).isin(set(rd3_codes))]),
+        check_dtype=False)
+
+    benchmark('Quality control mapping filter',
+              lambda: quality_control[~pd.MultiIndex.from_frame(
+                  quality_control[['GPAP name', 'GPAP code']]).isin(list(mapping))],
+              lambda: legacy_quality_control_filter(quality_control, mapping))
+    benchmark('Missing entries',
+              lambda: get_missing_entries(rd3_codes=rd3_codes, non_matches=non_matches, new_value=new_value),
+              lambda: legacy_missing_entries(rd3_data=rd3_data, non_matches=non_matches, new_value=new_value))
+
+
+def benchmark_term_matching(rd3_data: set, non_matches: set):
+    """Time building the ontology index and matching the GPAP entries to it"""
+    ontology = pd.DataFrame(list(rd3_data), columns=['name', 'code'])
+    build_time = min(timeit.repeat(lambda: OntologyIndex(ontology), number=1, repeat=3))
+
+    index = OntologyIndex(ontology)
+    matches = get_term_matches(index=index, non_matches=non_matches)
+    trivial = {(name, code) for name, code in non_matches if name.startswith('phenotype  ')}
+    normalised = matches[matches['type of mismatch'] == 'normalised']
+    assert set(zip(normalised['GPAP name'], normalised['GPAP code'])) == trivial
+
+    match_time = min(timeit.repeat(lambda: get_term_matches(index=index, non_matches=non_matches),
+                                   number=1, repeat=3))
+    print(f'Ontology index of {len(index)} terms: built in {build_time:.3f}s, '
+          f'{len(non_matches) / match_time:.0f} terms/s '
+          f'({matches["type of mismatch"].value_counts().to_dict()})')
+
+
+def benchmark_typed_loading(participants: pd.DataFrame):
+    """Compare the memory of the participants and the peak memory of the mapping
+    of the individuals, pedigree, clinical observations and consent with the dtypes of
+    the model (categoricals) to the strings as retrieved with the pyclient"""
+    environ.setdefault('MOLGENIS_HOST_SCHEMA_TARGET', 'rd3')
+    typed = apply_model_dtypes(participants, schema='staging_area_gpap', table='Participants')
+
+    def peak_memory(build, data: pd.DataFrame) -> float:
+        tracemalloc.start()
+        build(client=NullClient(), data=data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak / 1e6
+
+    memory, typed_memory = participants.memory_usage(deep=True).sum() / 1e6, typed.memory_usage(deep=True).sum() / 1e6
+    print(f'Participants memory: {memory:.1f}MB -> {typed_memory:.1f}MB ({memory / typed_memory:.1f}x)')
+    for build in [mapping_cnag_to_rd3.build_import_individuals_table, mapping_cnag_to_rd3.build_import_pedigree_table,
+                  mapping_cnag_to_rd3.build_import_clinical_observations, mapping_cnag_to_rd3.build_import_consent]:
+        peak, typed_peak = peak_memory(build, participants), peak_memory(build, typed)
+        print(f'{build.__name__} peak memory: {peak:.2f}MB -> {typed_peak:.2f}MB ({peak / typed_peak:.1f}x)')
+
+
+if __name__ == '__main__':
+    # the warnings on the synthetic data (e.g. missing clinical observations) are expected
+    logging.disable(logging.WARNING)
+
+    participants = generate_participants(int(environ.get('BENCHMARK_PARTICIPANTS', 20000)))
+
+    benchmark_phenotype_observations(participants)
+
+    experiments = generate_experiments(int(environ.get('BENCHMARK_EXPERIMENTS', 20000)))
+
+    benchmark_experiments(experiments)
+
+    rd3_data, non_matches, mapping, new_value = generate_ontology_fixture()
+
+    benchmark_mismatch_detection(rd3_data, non_matches, mapping, new_value)
+
+    benchmark_term_matching(rd3_data, non_matches)
+
+    # last, as tracemalloc slows down the code that runs while it traces
+    benchmark_typed_loading(generate_staging_participants(participants))
@@ -1,6 +1,9 @@
 """RD3 Staging area mapping script: mapping experiments from GPAP to RD3
 """
 import logging
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 
 import pandas as pd
@@ -8,6 +11,12 @@ import numpy as np
 from dotenv import load_dotenv
 
 from molgenis_emx2_pyclient.client import Client
+from erdera.clients.molgenis_registry import molgenis_clients
+from erdera.clients.ontology_cache import ontology_cache
+from erdera.clients.staging_cache import staging_cache
+from erdera.utils.model_types import apply_model_dtypes
+from erdera.utils.ontology_index import CONFIDENCE, OntologyIndex
+from erdera.utils.pipeline import Pipeline, Stage
 
 load_dotenv()
 
@@ -15,14 +24,14 @@ logging.captureWarnings(True)
 log = logging.getLogger("Staging Area Mapping")
 
 def get_staging_area_experiments():
-    """Retrieve metadata from /<staging area>/Experiments"""
+    """Retrieve metadata from /<staging area>/Experiments, with the dtypes of the
+    staging area model (e.g. categoricals for library_strategy, tissue and erns)"""
     logging.info('Retrieving required metadata')
-    with Client(environ['MOLGENIS_HOST'], token=environ['MOLGENIS_TOKEN']) as client_ind:
-        return client_ind.get(
-            table='Experiments',
-            schema=environ['SCHEMA_GPAP_SOURCE'],
-            as_df=True
-        )
+    experiments = staging_cache.get(
+        table='Experiments',
+        schema=environ['SCHEMA_GPAP_SOURCE']
+    )
+    return apply_model_dtypes(experiments, schema='staging_area_gpap', table='Experiments')
     
 def add_collections(client: Client):
     """Adding ERDERA and EMX2 API as collections to RD3. This function should be a part of a setting up script"""
@@ -50,53 +59,87 @@ def get_data(rd3_name: str):
     '''Get the mappings data'''
     mappings_name = get_mappings_name(rd3_name)[0]
    
-    with Client(environ['MOLGENIS_HOST'], token=environ['MOLGENIS_TOKEN']) as client_ind:
-        return client_ind.get(
-            table=mappings_name,
-            schema=environ['SCHEMA_ONTOLOGY_MAPPINGS'],
-            as_df=True
-        )
-
-def match_ontology(gpap_data: list):
-    """Match the GPAP ontology with the RD3's.
-        
-        gpap_data = the GPAP ontology list
-        """
-    # get the mappings data (mapping gpap ontology values to RD3)
-    mappings = get_data(gpap_data.name)
-
-    # create a dictionary of the incoming value and the new (rd3) value
-    mappings_dict = dict(zip(mappings['incoming value'], mappings['new value']))
-
-    # get the unmatched ones
-    unique_values = gpap_data.unique()
-    unmatched = [x for x in unique_values if x not in mappings_dict]
-    unmatched_df = pd.DataFrame({'incoming value': unmatched})
-    unmatched_df['source'] = f'datamanagement_service/api/experimentsview/{get_mappings_name(gpap_data.name)[1]}'
-
-    molgenis = Client(
-        environ['MOLGENIS_HOST'],
-        schema=environ['SCHEMA_ONTOLOGY_MAPPINGS'],
-        token=environ['MOLGENIS_TOKEN']
+    return ontology_cache.get(
+        table=mappings_name,
+        schema=environ['SCHEMA_ONTOLOGY_MAPPINGS']
     )
 
-    # upload the values without a match to the ontology mappings schema
-    molgenis.save_schema(table=get_mappings_name(gpap_data.name)[0], data=unmatched_df)
-    
-    return mappings_dict, unmatched
+class OntologyMatcher:
+    """Match GPAP values to RD3 with the mapping tables in the ontology mappings schema.
+    The mapping tables of all fields are retrieved together and the values without
+    a mapping are collected, so they can be uploaded with one save per table.
+
+    :param fields: RD3 field names to match (see get_mappings_name)
+    :type fields: list[str]
+
+    :param ontologies: RD3 ontology per field; values without a mapping that only differ
+        from a term of the ontology in case, whitespace or punctuation (or that are a
+        synonym of the term) are mapped to this term
+    :type ontologies: dict[str, str]
+    """
+
+    def __init__(self, fields: list[str], ontologies: dict[str, str] = None):
+        self.fields = fields
+        self.ontologies = ontologies or {}
+        self.mappings: dict[str, dict] = {}
+        self.indices: dict[str, OntologyIndex] = {}
+        self.unmatched: dict[str, set] = {field: set() for field in fields}
+
+    def load(self):
+        """Retrieve the mapping tables of all fields in parallel"""
+        with ThreadPoolExecutor(max_workers=len(self.fields)) as executor:
+            for field, mappings in zip(self.fields, executor.map(get_data, self.fields)):
+                # create a dictionary of the incoming value and the new (rd3) value
+                self.mappings[field] = dict(zip(mappings['incoming value'], mappings['new value']))
+
+        for field, ontology_name in self.ontologies.items():
+            self.indices[field] = OntologyIndex(ontology_cache.get(table=ontology_name,
+                                                                   schema=environ['SCHEMA_ONTOLOGIES']))
+
+    def match(self, gpap_data: pd.Series) -> tuple[pd.Series, pd.Series]:
+        """Map the GPAP values of a field to RD3. The field is derived from the name
+        of the series.
+
+        :param gpap_data: the GPAP values
+        :type gpap_data: pd.Series
+
+        :returns: the RD3 values and a mask of the values that have a mapping
+        :rtype: tuple[pd.Series, pd.Series]
+        """
+        if not self.mappings:
+            self.load()
+        mappings = self.mappings[gpap_data.name]
+
+        matched = gpap_data.isin(mappings.keys())
+        if gpap_data.name in self.indices and not matched.all():
+            index = self.indices[gpap_data.name]
+            for value in gpap_data[~matched].dropna().unique():
+                term = index.lookup(value)
+                if term is not None and term.confidence >= CONFIDENCE['synonym']:
+                    mappings[value] = term.name
+            matched = gpap_data.isin(mappings.keys())
+        self.unmatched[gpap_data.name].update(gpap_data[~matched].dropna().unique())
+
+        return gpap_data.map(mappings), matched
+
+    def upload_unmatched(self):
+        """Upload the values without a match to the ontology mappings schema"""
+        molgenis = molgenis_clients.get(schema=environ['SCHEMA_ONTOLOGY_MAPPINGS'])
+        for field, unmatched in self.unmatched.items():
+            if not unmatched:
+                continue
+            mappings_name, gpap_field_name = get_mappings_name(field)
+            unmatched_df = pd.DataFrame({'incoming value': sorted(unmatched)})
+            unmatched_df['source'] = f'datamanagement_service/api/experimentsview/{gpap_field_name}'
+            molgenis.save_schema(table=mappings_name, data=unmatched_df)
 
 def map_owner_to_organisation(owners: list):
     """Upload the GPAP owners as organisations in CatalogueOntologies"""
-    ontologies_client = Client(
-        environ['MOLGENIS_HOST'],
-        schema=environ['SCHEMA_ONTOLOGIES'],
-        token=environ['MOLGENIS_TOKEN']
-    )
+    ontologies_client = molgenis_clients.get(schema=environ['SCHEMA_ONTOLOGIES'])
 
-    organisations = ontologies_client.get(
+    organisations = ontology_cache.get(
         table='Organisations', 
-        schema=environ['SCHEMA_ONTOLOGIES'],
-        as_df=True)
+        schema=environ['SCHEMA_ONTOLOGIES'])
     
     # get the new organisations 
     new_organisations = [owner for owner in owners if owner not in organisations['name'].to_list()]
@@ -107,7 +150,7 @@ def map_owner_to_organisation(owners: list):
     ontologies_client.save_schema(table='Organisations', 
                                   data=new_organisations_df)
     
-def upload_samples(client: Client, data: pd.DataFrame):
+def upload_samples(client: Client, data: pd.DataFrame, matcher: OntologyMatcher):
     """Build and import the sample metadata based on GPAP's experiments. """
 
     samples_srDNA = data[['tissue', 'Sample_ID', 'Participant_ID', 'ExperimentID']]\
@@ -119,18 +162,60 @@ def upload_samples(client: Client, data: pd.DataFrame):
 
     ## map tissue type
     field_name = 'tissue type'
-    matches, unmatched = match_ontology(gpap_data=samples_srDNA[field_name])
-    samples_srDNA[field_name] = samples_srDNA[field_name].replace(matches)
-
-    tmp = samples_srDNA.loc[samples_srDNA[field_name].isin(
-        unmatched)].index  # get the indices of the rows to remove (no match)
+    samples_srDNA[field_name], matched = matcher.match(samples_srDNA[field_name])
     # remove rows without a RD3 ontology term equivalent
-    samples_srDNA = samples_srDNA.drop(tmp, axis=0)
+    samples_srDNA = samples_srDNA[matched]
 
     # upload samples
     client.save_schema(table='Samples srDNA', data=samples_srDNA)
     
-def upload_srDNA_experiments(client: Client, data: pd.DataFrame):
+def rename_subproject(subproject):
+    """Rename a GPAP subproject to the data freeze it is part of. Mapped per value, so
+    a categorical subproject is renamed per category."""
+    if not isinstance(subproject, str):
+        return subproject
+    if 'ERDERA_PF1' in subproject:
+        return 'ERDERA_PF1'
+    if re.search(r"ERDERA_PF2|TOPFANA_01|TOPFANA_02|TOPFANA_03|TOPFANA_04", subproject):
+        return 'ERDERA_PF2'
+    return subproject
+
+def join_columns(*columns: pd.Series, unique: bool = True) -> pd.Series:
+    """Join the non-empty values of each row with a comma. The values are
+    concatenated column by column instead of row by row.
+
+    :param columns: columns to join, in order
+    :type columns: pd.Series
+
+    :param unique: if True, values that are repeated within a row are joined once
+    :type unique: bool (default: True)
+
+    :returns: the joined values; an empty string if all values of a row are empty
+    :rtype: pd.Series
+    """
+    joined = pd.Series('', index=columns[0].index, dtype=object)
+    previous = []
+    for column in columns:
+        values = column.astype(object).where(column.notna())
+        if unique:
+            # skip values that are already present in an earlier column of the same row
+            for earlier in previous:
+                values = values.where(values != earlier)
+            previous.append(values)
+        joined = joined + (values.astype(str) + ',').where(values.notna(), '')
+    return joined.str[:-1]
+
+def get_included_in_resources(solve_rd: pd.Series, erdera: pd.Series, subproject: pd.Series) -> pd.Series:
+    """Combine the projects (Solve-RD, ERDERA) and the (renamed) subproject of each
+    experiment into the resources it is included in"""
+    return join_columns(solve_rd, erdera, subproject)
+
+def get_affiliated_organisations(erns: pd.Series, owners: pd.Series) -> pd.Series:
+    """Combine the ERN and the owner of each experiment into its affiliated
+    organisations; experiments without an ERN have no affiliated organisations"""
+    return join_columns(erns, owners, unique=False).astype(object).where(erns.notna(), None)
+
+def upload_srDNA_experiments(client: Client, data: pd.DataFrame, matcher: OntologyMatcher):
     """This function maps GPAP experiments to srDNA experiments in RD3"""
     srDNA = data[['ExperimentID', 'LocalExperimentID', 
                            'kit', 
@@ -158,55 +243,29 @@ def upload_srDNA_experiments(client: Client, data: pd.DataFrame):
     srDNA['tmp'] = np.where(srDNA['project'].str.contains('Solve-RD', na=False), 'Solve-RD', pd.NA) # capture the Solve-RD experiments
     srDNA['tmp2'] = np.where(srDNA['project'].str.contains('ERDERA', na=False), 'ERDERA', pd.NA) # capture the ERDERA experiments
     # rename the freeze information 
-    srDNA.loc[srDNA['subproject'].str.contains('ERDERA_PF1'), 'subproject'] = 'ERDERA_PF1'
-    srDNA.loc[srDNA['subproject'].str.contains(r"ERDERA_PF2|TOPFANA_01|TOPFANA_02|TOPFANA_03|TOPFANA_04"), 'subproject'] = 'ERDERA_PF2'
+    srDNA['subproject'] = srDNA['subproject'].map(rename_subproject)
 
     # merge project and subproject
-    srDNA['included in resources'] = srDNA[['tmp', 'tmp2', 'subproject']].apply(
-        lambda x: ','.join(pd.unique(x.dropna())), axis=1
-        )
+    srDNA['included in resources'] = get_included_in_resources(srDNA['tmp'], srDNA['tmp2'], srDNA['subproject'])
     # drop the unused columns
     srDNA = srDNA.drop(columns=['project', 'subproject', 'tmp', 'tmp2'])
 
-    ## map library strategy
-    field_name = 'library strategy'
-    matches, unmatched = match_ontology(gpap_data=srDNA[field_name])
-    srDNA[field_name] = srDNA[field_name].replace(matches)
-
-    tmp = srDNA.loc[srDNA[field_name].isin(
-        unmatched)].index  # get the indices of the rows to remove (no match)
-    # remove rows without a RD3 ontology term equivalent
-    srDNA = srDNA.drop(tmp, axis=0)
-
-    ## map library source
-    field_name = 'library source'
-    matches, unmatched = match_ontology(gpap_data=srDNA[field_name])
-    srDNA[field_name] = srDNA[field_name].replace(matches)
-    
-    tmp = srDNA.loc[srDNA[field_name].isin(
-        unmatched)].index  # get the indices of the rows to remove (no match)
-    # remove rows without a RD3 ontology term equivalent
-    srDNA = srDNA.drop(tmp, axis=0)
+    ## map library strategy and library source
+    for field_name in ['library strategy', 'library source']:
+        srDNA[field_name], matched = matcher.match(srDNA[field_name])
+        # remove rows without a RD3 ontology term equivalent
+        srDNA = srDNA[matched]
 
     ## map affiliated organisations based on erns and owner columns
     owners = srDNA['Owner'].unique().tolist() # gather all unique owners as a list 
     map_owner_to_organisation(owners=owners) # upload the owners as organisations
 
     field_name = 'erns'
-    matches, unmatched = match_ontology(gpap_data=srDNA[field_name])
-    srDNA[field_name] = srDNA[field_name].replace(matches)
-    
-    tmp = srDNA.loc[srDNA[field_name].isin(
-        unmatched)].index  # get the indices of the rows to remove (no match)
+    srDNA[field_name], matched = matcher.match(srDNA[field_name])
     # remove rows without a RD3 ontology term equivalent
-    srDNA = srDNA.drop(tmp, axis=0)
-
-    srDNA['affiliated organisations'] = None
-    for index, row in srDNA.iterrows():
-        erns = row['erns']
-        owner = row['Owner']
-        if not pd.isna(erns):
-            srDNA.loc[index, 'affiliated organisations'] = ','.join(str(field) for field in [erns, owner] if pd.notna(field))
+    srDNA = srDNA[matched]
+
+    srDNA['affiliated organisations'] = get_affiliated_organisations(srDNA['erns'], srDNA['Owner'])
     add_organisations_to_individuals(client=client, ind_org_dict=dict(zip(srDNA['individuals'], srDNA['affiliated organisations'])))
 
     # remove erns and owner columns
@@ -227,16 +286,34 @@ def add_organisations_to_individuals(client: Client, ind_org_dict: dict):
     individuals['affiliated organisations'] = individuals['id'].map(ind_org_dict)
     client.save_schema(table='Individuals', data=individuals)
 
+def build_pipeline(client: Client, data: pd.DataFrame) -> Pipeline:
+    """Define the mapping of the experiments to RD3 as stages with their dependencies"""
+    matcher = OntologyMatcher(fields=['tissue type', 'library strategy', 'library source', 'erns'],
+                              ontologies={'tissue type': 'Tissue type'})
+    return Pipeline([
+        Stage('ontology mappings', matcher.load),
+        Stage('samples', lambda: upload_samples(client=client, data=data, matcher=matcher),
+              depends_on=['ontology mappings']),
+        Stage('srDNA experiments', lambda: upload_srDNA_experiments(client=client, data=data, matcher=matcher),
+              depends_on=['samples']),
+        Stage('unmatched ontology values', matcher.upload_unmatched,
+              depends_on=['samples', 'srDNA experiments'])
+    ])
+
 if __name__ == "__main__":
 
     experiments = get_staging_area_experiments()
 
-    db = Client(
-        environ['MOLGENIS_HOST'],
-        schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'],
-        token=environ['MOLGENIS_TOKEN']
-    )
+    db = molgenis_clients.get(schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])
+
+    # build and import srDNA experiments and samples, or only the (comma separated)
+    # stages in MAPPING_STAGES
+    pipeline = build_pipeline(client=db, data=experiments)
+    stages = environ.get('MAPPING_STAGES')
+    pipeline.run(only=stages.split(',') if stages else None,
+                 max_workers=int(environ.get('MAPPING_MAX_WORKERS', 4)))
+
+    molgenis_clients.close()
 
-    # build and import srDNA experiments and samples
-    upload_samples(client=db, data=experiments)
-    upload_srDNA_experiments(client=db, data=experiments)
\ No newline at end of file
+    if pipeline.failed:
+        sys.exit(f'The following stages did not succeed: {pipeline.failed}')
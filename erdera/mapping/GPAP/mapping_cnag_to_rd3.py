@@ -1,13 +1,23 @@
 """Mapping GPAP participants data to RD3"""
 import logging
+import sys
 from os import environ
+from functools import lru_cache
 import ast
+import json
 
 import pandas as pd
 import numpy as np
 from dotenv import load_dotenv
 
 from molgenis_emx2_pyclient.client import Client
+from erdera.clients.molgenis_registry import molgenis_clients
+from erdera.clients.ontology_cache import ontology_cache
+from erdera.clients.staging_cache import staging_cache
+from erdera.utils.model_types import apply_model_dtypes, map_categories
+from erdera.utils.ontology_index import OntologyIndex, normalise_codes
+from erdera.utils.pipeline import Pipeline, Stage
+from erdera.utils.table_diff import save_table_diff
 
 load_dotenv()
 
@@ -15,14 +25,46 @@ logging.captureWarnings(True)
 log = logging.getLogger("Staging Area Mapping")
 
 def get_staging_area_participants():
-    """Retrieve metadata from /<staging area>/Participants"""
+    """Retrieve metadata from /<staging area>/Participants, with the dtypes of the
+    staging area model (e.g. categoricals for sex, solved and onset)"""
     logging.info('Retrieving required metadata')
-    with Client(environ['MOLGENIS_HOST'], token=environ['MOLGENIS_TOKEN']) as client_ind:
-        return client_ind.get(
-            table='Participants',
-            schema=environ['SCHEMA_GPAP_SOURCE'],
-            as_df=True
-        )
+    participants = staging_cache.get(
+        table='Participants',
+        schema=environ['SCHEMA_GPAP_SOURCE']
+    )
+    return apply_model_dtypes(participants, schema='staging_area_gpap', table='Participants')
+
+def join_distinct(values: pd.Series, groups: np.ndarray, n_groups: int) -> np.ndarray:
+    """Join the distinct values of each group, sorted and separated by a comma. The
+    values are sorted on their group instead of grouped, so no Series is created per group.
+
+    :param values: the values, e.g. the alternate IDs of the members of the families
+    :type values: pd.Series
+
+    :param groups: the group of each value as a code from 0 to n_groups (see pd.factorize)
+    :type groups: np.ndarray
+
+    :param n_groups: number of groups
+    :type n_groups: int
+
+    :returns: the joined values per group, None for the groups without a value
+    :rtype: np.ndarray
+    """
+    known = values.notna().to_numpy()
+    values, groups = values.to_numpy(dtype=object)[known], groups[known]
+    # sort on the value, then (stable) on the group, and drop the repeated values of a group
+    order = np.argsort(values, kind='stable')
+    order = order[np.argsort(groups[order], kind='stable')]
+    values, groups = values[order], groups[order]
+    distinct = np.ones(len(values), dtype=bool)
+    distinct[1:] = (groups[1:] != groups[:-1]) | (values[1:] != values[:-1])
+    values, groups = values[distinct], groups[distinct]
+
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else np.array([], dtype=int)
+    ends = np.r_[starts[1:], len(values)]
+    joined = np.full(n_groups, None, dtype=object)
+    joined[groups[starts]] = [','.join(values[start:end]) for start, end in zip(starts.tolist(), ends.tolist())]
+    return joined
     
 def build_import_pedigree_table(client, data: pd.DataFrame):
     """Map staging area data into the Pedigree table format"""
@@ -30,45 +72,30 @@ def build_import_pedigree_table(client, data: pd.DataFrame):
     # current_pedigrees = client.get(table='Pedigree', as_df=True) 
 
     # get the pedigree information with family_id (a.k.a alternate ids) and the others affacted info
-    pedigree = (data[['famid', 'family_id', 'otheraffected']].rename(columns={
-        'famid': 'id',
-        'family_id':'alternate ids',
-        'otheraffected': 'others affected'
-    })
-    .dropna(subset = ['id'])
-    )
+    members = data[['famid', 'family_id', 'otheraffected']].dropna(subset=['famid'])
+
+    # the families are hashed once, the fields of their members are aggregated on the
+    # codes of the families (without a groupby, which hashes the codes again per field)
+    family, families = pd.factorize(members['famid'])
 
     others_affected_dict = {
         'Yes': True,
         'No': False
     }
-    pedigree['others affected'] = pedigree['others affected'].map(
-        others_affected_dict)
-
-    # gather and set the alternate IDs of the families
-    alt_ids = (
-        pedigree
-        .dropna(subset=['alternate ids'])
-        .groupby('id')['alternate ids']
-        .agg(lambda x: ','.join(sorted(set(x))))
-        )
+    others_affected = members['otheraffected'].map(others_affected_dict).astype('boolean')
 
     # gather and set the 'others affected' field. 
-    others = (
-        pedigree
-        .dropna(subset=['others affected'])
-        .groupby('id')['others affected']
-        # if a True is present for the family, set the field of the whole family to True
-        .any()
-        )
-    
-    # merge the to DFs together
-    pedigree = (
-        pedigree[['id']]
-        .drop_duplicates()
-        .merge(alt_ids, on='id', how='left')
-        .merge(others, on='id', how='left')
-        )
+    # if a True is present for the family, set the field of the whole family to True
+    has_true = np.bincount(family[others_affected.fillna(False).to_numpy(dtype=bool)],
+                           minlength=len(families)) > 0
+    has_value = np.bincount(family[others_affected.notna().to_numpy()], minlength=len(families)) > 0
+
+    pedigree = pd.DataFrame({
+        'id': families,
+        # gather and set the alternate IDs of the families
+        'alternate ids': join_distinct(members['family_id'], groups=family, n_groups=len(families)),
+        'others affected': np.where(has_true, True, np.where(has_value, False, None))
+    })
             
     # upload
     client.save_schema(table='Pedigree', data=pedigree)
@@ -90,8 +117,9 @@ def build_import_individuals_table(client, data: pd.DataFrame):
     individual_status_dict = {
         'Deceased': 'Dead'
     }
-    individuals['individual status'] = individuals['individual status'].replace(
-        individual_status_dict)
+    # mapped instead of replaced, as the status may be a categorical
+    individuals['individual status'] = individuals['individual status'].map(
+        lambda status: individual_status_dict.get(status, status))
 
     # TODO: retrieve this from mappings schema
     gender_dict = {
@@ -101,9 +129,10 @@ def build_import_individuals_table(client, data: pd.DataFrame):
     individuals['gender at birth'] = individuals['gender at birth'].map(
         gender_dict)
 
-    # map age group
-    age = pd.to_numeric(individuals['age at enrolment'], errors='coerce')
-    individuals['age at enrolment'] = "P" + age.astype('Int64').astype('string') + "Y"
+    # map age group, per distinct age if the ages are a categorical
+    individuals['age at enrolment'] = map_categories(
+        individuals['age at enrolment'],
+        lambda ages: "P" + pd.to_numeric(ages, errors='coerce').astype('Int64').astype('string') + "Y")
 
     # upload individuals data to RD3
     client.save_schema(table='Individuals', data=individuals)
@@ -171,13 +200,26 @@ def build_import_pedigree_members(client: Client, data: pd.DataFrame):
     # upload
     client.save_schema(table = 'Pedigree members', data = pedigree_members)
 
+def clinical_observation_ids(report_ids: pd.Series) -> pd.Series:
+    """Identifiers of the clinical observations of individuals. The identifiers are
+    derived from the report_id, so the tables that refer to the clinical observations
+    can be built without retrieving the identifiers from RD3"""
+    return report_ids.astype('string') + '-CO'
+
+def get_clinical_observation_ids(data: pd.DataFrame) -> pd.Series:
+    """Map each individual (report_id) to the identifier of its clinical observation"""
+    report_ids = data['report_id'].dropna().drop_duplicates()
+    return pd.Series(clinical_observation_ids(report_ids).to_numpy(), index=report_ids.to_numpy())
+
 def build_import_clinical_observations(client, data: pd.DataFrame):
     """Map staging area data into the clinical observations table"""
-    clinical_observations = data[['report_id', 'solved', 'consanguinity']] \
+    clinical_observations = data[['report_id', 'solved', 'consanguinity', 'onset']] \
         .rename(columns={
             'report_id': 'individuals',
-            'solved': 'is solved'
+            'solved': 'is solved',
+            'onset': 'age group at onset'
         })
+    clinical_observations['id'] = clinical_observation_ids(clinical_observations['individuals'])
 
     # map solved field
     solved_dict = {
@@ -195,15 +237,37 @@ def build_import_clinical_observations(client, data: pd.DataFrame):
     clinical_observations['consanguinity'] = clinical_observations['consanguinity'].map(
         consanguinity_dict)
 
-    # upload
-    # first delete content of clinical observations
-    client.truncate(table='Phenotype observations', schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])
-    client.truncate(table='Disease history', schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])
-    client.truncate(table='Clinical observations', schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])    
-    
-    # then upload
-    client.save_schema(table='Clinical observations',
-                       data=clinical_observations)
+    # map age group at onset
+    # TODO: save the records that do not have a ontology term match. --> in the staging area tables save this information
+    # any record that does not map should be flagged --> go through it once a month or something
+    # TODO: use the mappings schema
+    onset_dict = {
+        'HP:0011463': 'Childhood onset',
+        'HP:0003577': 'Congenital onset',
+        'HP:0003621': 'Juvenile onset',
+        'HP:0011462': 'Young adult onset',
+        'HP:0003593': 'Infantile onset',
+        'HP:0003623': 'Neonatal onset',
+        'HP:0003584': 'Late onset',
+        'HP:0003581': 'Adult onset',
+        'HP:0003596': 'Middle age onset',
+        'Unknown': ''  # needs to be added to the ontology, TODO
+    }
+    clinical_observations['age group at onset'] = clinical_observations['age group at onset'].map(
+        onset_dict)
+
+    # upload the changes, the clinical observations of individuals that are no longer
+    # in the staging area (or that still have an auto generated ID) are removed together
+    # with their phenotypes and diseases
+    save_table_diff(client=client,
+                    table='Clinical observations',
+                    data=clinical_observations,
+                    keys=['id'],
+                    schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'],
+                    referenced_by={
+                        'Phenotype observations': 'part of clinical observation',
+                        'Disease history': 'part of clinical observation'
+                    })
 
 
 def build_import_consent(client, data: pd.DataFrame):
@@ -222,86 +286,111 @@ def build_import_consent(client, data: pd.DataFrame):
     indv_consent['allow recontacting'] = indv_consent['allow recontacting'].map(
         consent_dict)
 
-    # upload the data
-    # first truncate the consent table
-    client.truncate(table='Individual consent', schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])
-    # then upload
-    client.save_schema(table='Individual consent', data=indv_consent)
-
-def upload_non_matches(rd3_data: set, non_matches: set, mapping: dict, rd3_ontology_name: str):
-    """Upload the entries that have a mismatch between the name and/or code. """
-    # create df of the non-matches for the quality control schema
-    df_mismatches = pd.DataFrame(list(non_matches), columns=['name', 'code'])
-    # create a df of the rd3 names and codes
-    rd3_data_df = pd.DataFrame(list(rd3_data), columns=['name', 'code'])
-    # create a df of the non-matches merged with the rd3 names 
-    df_mismatch_names = pd.merge(df_mismatches, rd3_data_df, on='code', how='inner') # mismatched on name (same code)
-    df_mismatch_codes = pd.merge(df_mismatches, rd3_data_df, on='name', how='inner') # mismatched on code (same name)
-    
-    df_mismatch_names = df_mismatch_names.rename(columns= { # rename columns to correspond to schema
-        'name_x': 'GPAP name',
-        'code': 'GPAP code',
-        'name_y': 'RD3 name'
-    })
-    df_mismatch_names['RD3 code'] = df_mismatch_names['GPAP code'] # the codes are identical between GPAP and RD3
-    df_mismatch_names['type of mismatch'] = 'name' # the type of mismatch is on the name 
+    # upload the changes
+    save_table_diff(client=client,
+                    table='Individual consent',
+                    data=indv_consent,
+                    keys=['individuals'],
+                    schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])
+
+def get_term_matches(index: OntologyIndex, non_matches: set) -> pd.DataFrame:
+    """Match the GPAP entries without an exact RD3 match to the indexed RD3 ontology,
+    on the normalised code, the case-folded name, the synonyms and similar names
+
+    :param index: index of the RD3 ontology
+    :type index: OntologyIndex
+
+    :param non_matches: (name, code) pairs of GPAP without an exact RD3 match
+    :type non_matches: set
 
-    df_mismatch_codes = df_mismatch_codes.rename(columns= { # rename columns to correspond to schema
-        'name': 'GPAP name',
-        'code_x': 'GPAP code',
-        'code_y': 'RD3 code'
+    :returns: the best RD3 match of each entry in the format of the quality control
+        schema, with the type of mismatch and the confidence of the match
+    :rtype: pd.DataFrame
+    """
+    return index.match(non_matches).rename(columns={
+        'incoming name': 'GPAP name',
+        'incoming code': 'GPAP code',
+        'name': 'RD3 name',
+        'code': 'RD3 code',
+        'type': 'type of mismatch'
     })
-    df_mismatch_codes['RD3 name'] = df_mismatch_codes['GPAP name'] # the names are identical between GPAP and RD3
-    df_mismatch_codes['type of mismatch'] = 'code' # the type of mismatch is on the code
-
-    # upload the non-matches minus the mappings (for the mappings there is a correction)
-    quality_control_upload = pd.concat([df_mismatch_codes, df_mismatch_names])
-    quality_control_upload = quality_control_upload[~quality_control_upload[['GPAP name', 'GPAP code']] \
-    .apply(tuple, axis=1).isin(set(mapping))]
-
-    molgenis = Client(
-        environ['MOLGENIS_HOST'],
-        schema=environ['SCHEMA_QUALITY_CONTROL'],
-        token=environ['MOLGENIS_TOKEN']
-    )
+
+def get_quality_control_mismatches(matches: pd.DataFrame, mapping: dict) -> pd.DataFrame:
+    """Get the matches that need to be checked by a curator, i.e. the GPAP entries
+    that differ from RD3 in more than case, whitespace, punctuation or the prefix of
+    the code, excluding the entries that already have a correction (mapping)
+
+    :param matches: the RD3 matches of the GPAP entries (see get_term_matches)
+    :type matches: pd.DataFrame
+
+    :param mapping: corrections per (name, code) pair of GPAP
+    :type mapping: dict
+
+    :returns: the mismatches in the format of the quality control schema
+    :rtype: pd.DataFrame
+    """
+    mismatches = matches[matches['type of mismatch'] != 'normalised']
+    # remove the non-matches with a mapping (for the mappings there is a correction)
+    keys = pd.MultiIndex.from_frame(mismatches[['GPAP name', 'GPAP code']])
+    return mismatches[~keys.isin(list(mapping))]
+
+def upload_non_matches(matches: pd.DataFrame, mapping: dict, rd3_ontology_name: str):
+    """Upload the entries that have a mismatch between the name and/or code, with the
+    confidence of the RD3 match"""
+    quality_control_upload = get_quality_control_mismatches(matches=matches, mapping=mapping)
+
+    molgenis = molgenis_clients.get(schema=environ['SCHEMA_QUALITY_CONTROL'])
 
     # upload the mismatches
     molgenis.save_schema(data=quality_control_upload, table=rd3_ontology_name)
 
-def check_no_match(rd3_data: set, non_matches: set, rd3_ontology_name: str, mapping: dict):
-    """Check if there is no RD3 match for the data entry"""
-    # get the codes of the GPAP entries that do not have an RD3 match (i.e., this code is missing in the RD3 ontology)
-    missing_codes = set([i[1] for i in non_matches]) - set([i[1] for i in rd3_data])
+def get_missing_entries(rd3_codes: pd.Series, non_matches: set, new_value: pd.DataFrame) -> pd.DataFrame:
+    """Get the GPAP entries of which the code is missing in the RD3 ontology, excluding
+    the entries that already have a new value in the ontology mappings schema
 
-    # create a dictionary of the non-matches with the codes as keys
-    non_matches_dict = {y: x for x,y in non_matches}
+    :param rd3_codes: normalised codes of the RD3 ontology (see normalise_codes)
+    :type rd3_codes: pd.Series
 
-    # create a df of the missing entries (missing in RD3)
-    missing_df = pd.DataFrame({
-        'source': 'phenostore_service/api/participants_by_exp/features',
-        'incoming value': non_matches_dict.get(code),
-        'incoming code': code
-    }
-    for code in missing_codes)
+    :param non_matches: (name, code) pairs of GPAP without an exact RD3 match; a code
+        that differs from an RD3 code in its prefix or whitespace only (e.g. '0001250'
+        and 'HP:0001250') is not missing
+    :type non_matches: set
 
-    molgenis = Client(
-        environ['MOLGENIS_HOST'],
-        schema=environ['SCHEMA_ONTOLOGY_MAPPINGS'],
-        token=environ['MOLGENIS_TOKEN']
-    )
+    :param new_value: ontology mappings with a new value
+    :type new_value: pd.DataFrame
+
+    :returns: the missing entries in the format of the ontology mappings schema
+    :rtype: pd.DataFrame
+    """
+    source = 'phenostore_service/api/participants_by_exp/features'
+
+    # get the GPAP entries of which the code does not have an RD3 match (i.e., this code is missing in the RD3 ontology),
+    # one entry per code; codes are compared without their prefix, as in the ontology index
+    entries = pd.DataFrame(list(non_matches), columns=['incoming value', 'incoming code'], dtype=object)
+    missing = entries[~normalise_codes(entries['incoming code']).isin(rd3_codes)] \
+        .drop_duplicates(subset='incoming code')
+
+    # make sure the value(s) that have a new value are removed from the df, so the new value will not be overwritten
+    # (as objects, as the keys of pyarrow strings are compared much slower); only the entries of which
+    # the code has a new value are compared on both the name and the code
+    has_new_value = new_value.loc[new_value['source'] == source, ['incoming value', 'incoming code']].astype(object)
+    candidates = missing[missing['incoming code'].isin(has_new_value['incoming code'])]
+    keys = pd.MultiIndex.from_frame(candidates)
+    missing = missing.drop(index=candidates.index[keys.isin(pd.MultiIndex.from_frame(has_new_value))])
+
+    return missing.assign(source=source)[['source', 'incoming value', 'incoming code']].reset_index(drop=True)
+
+def check_no_match(rd3_codes: pd.Series, non_matches: set, rd3_ontology_name: str, mapping: dict):
+    """Check if there is no RD3 match for the data entry"""
+    molgenis = molgenis_clients.get(schema=environ['SCHEMA_ONTOLOGY_MAPPINGS'])
     # check if there are new values in the ontology mappings schema to prevent overwrite during upload 
-    ontology_mappings_data = molgenis.get(table=rd3_ontology_name, as_df=True)
+    ontology_mappings_data = ontology_cache.get(table=rd3_ontology_name,
+                                                schema=environ['SCHEMA_ONTOLOGY_MAPPINGS'])
     new_value = ontology_mappings_data[~ontology_mappings_data['new value'].isna()]
     # update the mapping dictionary with the new value 
     mapping.update(new_value.set_index(['incoming value', 'incoming code'])['new value'].to_dict())
 
-    # make sure the value(s) that have a new value are removed from the df, so the new value will not be overwritten
-    missing_df = (missing_df.merge(new_value[['source', 'incoming value', 'incoming code']].drop_duplicates(),
-                  on=['source', 'incoming value', 'incoming code'],
-                  how='left',
-                  indicator=True)
-                  .query("_merge == 'left_only'")
-                  .drop(columns='_merge'))
+    missing_df = get_missing_entries(rd3_codes=rd3_codes, non_matches=non_matches, new_value=new_value)
 
     # save the df
     molgenis.save_schema(data=missing_df, table=rd3_ontology_name)
@@ -316,14 +405,8 @@ def match_diseases(gpap_data: set):
 
 def match_ontologies(gpap_data: set, rd3_ontology_name: str, qc_correct: str):
     """Match GPAP ontologies to RD3 and find mismatches"""
-    molgenis = Client(
-        environ['MOLGENIS_HOST'],
-        schema=environ['SCHEMA_ONTOLOGIES'],
-        token=environ['MOLGENIS_TOKEN']
-    )
     # get the RD3 ontology
-    rd3_ontology = molgenis.get(
-        table=rd3_ontology_name, schema=environ['SCHEMA_ONTOLOGIES'], as_df=True)
+    rd3_ontology = ontology_cache.get(table=rd3_ontology_name, schema=environ['SCHEMA_ONTOLOGIES'])
 
     # create a set of the rd3 names and codes
     rd3_data = set(zip(rd3_ontology['name'], rd3_ontology['code']))
@@ -331,13 +414,8 @@ def match_ontologies(gpap_data: set, rd3_ontology_name: str, qc_correct: str):
     non_matches = gpap_data - rd3_data
 
     # check for which gpap cases quality control has taken place
-    molgenis = Client(
-        environ['MOLGENIS_HOST'],
-        schema=environ['SCHEMA_QUALITY_CONTROL'],
-        token=environ['MOLGENIS_TOKEN']
-    )
     # get the quality control information
-    qc_info = molgenis.get(table=rd3_ontology_name, as_df=True)
+    qc_info = ontology_cache.get(table=rd3_ontology_name, schema=environ['SCHEMA_QUALITY_CONTROL'])
     new_value = qc_info[~qc_info[qc_correct].isna()] # get the rows that have a correction
 
     ## case 1: there is a new entry, meaning the GPAP entry should be that
@@ -349,14 +427,22 @@ def match_ontologies(gpap_data: set, rd3_ontology_name: str, qc_correct: str):
     # for these cases, the RD3 name is the correct one
     mapping.update(is_correct.set_index(['GPAP name', 'GPAP code'])['RD3 name'].to_dict())
 
+    # match the non-matches to the normalised RD3 ontology
+    matches = get_term_matches(index=OntologyIndex(rd3_ontology), non_matches=non_matches)
+    # entries that only differ in case, whitespace, punctuation or the prefix of the code
+    # are mapped without quality control, unless there is a correction
+    normalised = matches[matches['type of mismatch'] == 'normalised']
+    normalised_keys = list(zip(normalised['GPAP name'], normalised['GPAP code']))
+    for key, rd3_name in zip(normalised_keys, normalised['RD3 name']):
+        mapping.setdefault(key, rd3_name)
+
     # upload the mismatches
-    upload_non_matches(rd3_data=rd3_data, 
-                       non_matches=non_matches, 
-                       mapping=mapping, 
+    upload_non_matches(matches=matches,
+                       mapping=mapping,
                        rd3_ontology_name=rd3_ontology_name)
     # upload the cases where there is no RD3 data
-    check_no_match(rd3_data=rd3_data, 
-                   non_matches = non_matches,
+    check_no_match(rd3_codes=normalise_codes(rd3_ontology['code']), 
+                   non_matches = non_matches - set(normalised_keys),
                    rd3_ontology_name=rd3_ontology_name,
                    mapping=mapping)
 
@@ -365,61 +451,52 @@ def match_ontologies(gpap_data: set, rd3_ontology_name: str, qc_correct: str):
 
     return non_matches, mapping
 
+def parse_disease_history(data: pd.DataFrame, id_map: pd.Series):
+    """Parse the GPAP diagnoses of each participant into disease history records.
+    The diagnoses are parsed once per participant and exploded into one row
+    per disease with an ORDO annotation.
+
+    :param data: staging area participants with the 'diagnosis' and 'report_id' columns
+    :type data: pd.DataFrame
+
+    :param id_map: clinical observation ID per individual (report_id)
+    :type id_map: pd.Series
+
+    :returns: the disease history and the set of (name, code) pairs as prevalent in GPAP
+    :rtype: tuple[pd.DataFrame, set]
+    """
+    columns = ['part of clinical observation', 'disease', 'disease status', 'disease code']
+
+    diseases = data[['diagnosis', 'report_id']]
+    diseases['diagnosis'] = diseases['diagnosis'].map(parse_entries)
+    diseases = diseases.explode('diagnosis')
+
+    # only keep the diseases with an ORDO annotation
+    ordo = diseases['diagnosis'].map(lambda x: x.get('ordo') if isinstance(x, dict) else None)
+    has_ordo = ordo.map(bool)
+    diseases, ordo = diseases[has_ordo], ordo[has_ordo]
+    if diseases.empty:
+        return pd.DataFrame(columns=columns), set()
+
+    names = ordo.map(lambda x: x.get('name'))
+    for report_id in diseases.loc[names.isna(), 'report_id']:
+        log.warning(f'Individual {report_id} has a disease without a name.')
+
+    disease_history = pd.DataFrame({
+        'part of clinical observation': diseases['report_id'].map(id_map).to_numpy(),
+        'disease': names.to_numpy(),
+        'disease status': diseases['diagnosis'].map(lambda x: x.get('status')).to_numpy(),  # e.g. confirmed, suspected
+        # remove prefix and whitespace
+        'disease code': ordo.map(lambda x: x.get('id').split(':')[1].strip()).to_numpy()
+    })
+
+    diseases_set = set(zip(disease_history['disease'], disease_history['disease code']))
+
+    return disease_history, diseases_set
+
 def build_import_disease_history(client, data: pd.DataFrame):
     """Map staging area data to disease history data"""
-    disease_history = data[['onset', 'diagnosis', 'report_id']] \
-        .rename(columns={
-            'onset': 'age group at onset',
-            'diagnosis': 'disease'
-        })
-
-    # the auto IDs are necessary from clinical observations
-    clinical_obs = client.get(schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'],
-                              table='Clinical observations',
-                              as_df=True)
-    # create a map of individual ID and the corresponding auto generated ID
-    id_map = clinical_obs.set_index('individuals')['id']
-
-    disease_history2 = []
-    diseases_set = set()
-    for _, disease_elem in disease_history.iterrows():
-        # get the P-ID
-        report_id = disease_elem['report_id']
-        # get the auto id generated for this individual
-        id = id_map.get(report_id)
-
-        # get the age group information
-        age_group = disease_history.loc[disease_history['report_id']
-                                        == report_id, 'age group at onset']
-        clinical_obs.loc[clinical_obs['individuals'] ==
-                         report_id, "age group at onset"] = age_group
-        
-        # get all diseases from this individual
-        diseases_all = parse_entries(disease_elem.get('disease'))
-
-        for disease in diseases_all:
-            disease_ordo = disease.get('ordo')
-            if not disease_ordo:
-                continue
-
-            name = disease_ordo.get('name')
-            code = disease_ordo.get('id').split(':')[1].strip() # remove prefix and whitespace
-            status = disease.get('status')
-
-            if name is None:
-                print(report_id)
-
-            disease_history2.append({
-                'part of clinical observation': id,
-                'disease': name,
-                'disease status': status,  # e.g. confirmed, suspected
-                'disease code': code
-            })
-
-            diseases_set.add((name, code))
-
-    # convert list to a dataframe
-    disease_history = pd.DataFrame(disease_history2)
+    disease_history, diseases_set = parse_disease_history(data=data, id_map=get_clinical_observation_ids(data))
 
     non_matches, mappings = match_diseases(diseases_set)
 
@@ -439,40 +516,48 @@ def build_import_disease_history(client, data: pd.DataFrame):
     disease_history['disease status'] = disease_history['disease status'].replace(
         status_dict)
 
-    # map age group at onset
-    # TODO: save the records that do not have a ontology term match. --> in the staging area tables save this information
-    # any record that does not map should be flagged --> go through it once a month or something
-    # TODO: use the mappings schema
-    onset_dict = {
-        'HP:0011463': 'Childhood onset',
-        'HP:0003577': 'Congenital onset',
-        'HP:0003621': 'Juvenile onset',
-        'HP:0011462': 'Young adult onset',
-        'HP:0003593': 'Infantile onset',
-        'HP:0003623': 'Neonatal onset',
-        'HP:0003584': 'Late onset',
-        'HP:0003581': 'Adult onset',
-        'HP:0003596': 'Middle age onset',
-        'Unknown': ''  # needs to be added to the ontology, TODO
-    }
-    clinical_obs['age group at onset'] = clinical_obs['age group at onset'].map(
-        onset_dict)
-    
-    # remove the disease code field 
-    disease_history = disease_history.drop(columns=['disease code'])
+    # remove the disease code and key fields
+    disease_history = disease_history.drop(columns=['disease code', 'key'])
+
+    # upload the changes
+    save_table_diff(client=client,
+                    table='Disease history',
+                    data=disease_history.drop_duplicates(),
+                    keys=['part of clinical observation', 'disease'],
+                    schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])
+
+@lru_cache(maxsize=2**16)
+def parse_entries_str(entries: str) -> tuple:
+    """Parse the string representation of GPAP entries. The entries are stored as
+    JSON in the staging area; rows imported before were stored as Python literals
+    and are parsed with ast.literal_eval instead. The results are cached by content,
+    as many participants share the same entries.
+
+    :param entries: JSON or Python literal representation of a list
+    :type entries: str
 
-    # upload the data
-    client.truncate(table='Clinical observations', schema=environ['MOLGENIS_HOST_SCHEMA_TARGET']) # first truncate in order to update (to prevent duplicates)
-    client.save_schema(table='Clinical observations', data=clinical_obs)
-    client.save_schema(table='Disease history', data=disease_history.drop_duplicates())
+    :returns: the parsed entries, or an empty tuple if the string is not a list
+    :rtype: tuple
+    """
+    try:
+        parsed = json.loads(entries)
+    except ValueError:
+        try:
+            parsed = ast.literal_eval(entries)
+        except Exception:
+            return ()
+
+    if isinstance(parsed, list):
+        return tuple(parsed)
+    return ()
 
 def parse_entries(entries):
     """
     Parse the GPAP entries (phenotypes and diseases) and convert to a list.
     Works for the following cases:
     - empty values (None, NaN) → []
-    - string representation of a list → []
-    - list → []
+    - string representation of a list (JSON or Python literal) → list
+    - list → list
     """
     # None of np.nan check
     if entries is None or (isinstance(entries, float) and np.isnan(entries)):
@@ -480,14 +565,7 @@ def parse_entries(entries):
 
     # if the entry is a string
     if isinstance(entries, str):
-        try:
-            parsed = ast.literal_eval(entries)
-            if isinstance(parsed, list):
-                return parsed
-            else:
-                return []
-        except Exception:
-            return []
+        return list(parse_entries_str(entries))
 
     # Numpy array → Python list
     if isinstance(entries, np.ndarray):
@@ -500,54 +578,62 @@ def parse_entries(entries):
     # in all other cases,  return list 
     return []
 
-def build_import_phenotype_observations(client, data: pd.DataFrame):
-    """Map staging area data to phenotype observations data"""
-    phen_observations = data[['features', 'report_id']]\
-        .rename(columns={
-            'features': 'type'
-        })
+def parse_phenotype_observations(data: pd.DataFrame, id_map: pd.Series):
+    """Parse the GPAP features of each participant into phenotype observations.
+    The features are parsed once per participant, exploded into one row per
+    feature and normalised into columns.
+
+    :param data: staging area participants with the 'features' and 'report_id' columns
+    :type data: pd.DataFrame
+
+    :param id_map: clinical observation ID per individual (report_id)
+    :type id_map: pd.Series
+
+    :returns: the phenotype observations and the set of (name, code) pairs as prevalent in GPAP
+    :rtype: tuple[pd.DataFrame, set]
+    """
+    columns = ['part of clinical observation', 'type', 'excluded', 'phenotype code']
 
-    # the auto IDs are necessary from clinical observations
-    clinical_obs = client.get(schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'],
-                              table='Clinical observations',
-                              as_df=True)
-    # create a map of individual ID and the corresponding auto generated ID
-    id_map = clinical_obs.set_index('individuals')['id']
-
-    pheno_observations2 = []
-    observations = set()
-    for _, pheno_obs in phen_observations.iterrows():
-        # get the automatically generated id for this individual
-        report_id = pheno_obs['report_id']
-        id = id_map.get(report_id)
-
-        # check if the individual has a clinical observations ID - otherwise the individual is present in the 
-        # GPAP staging area data but not in RD3
-        if pd.isna(id):
-            logging.warning(f'Individual {pheno_obs['report_id']} does not have a clinical observation ID. The \
+    phen_observations = data[['features', 'report_id']]
+    phen_observations['part of clinical observation'] = phen_observations['report_id'].map(id_map)
+
+    # check if the individual has a clinical observations ID - otherwise the individual is present in the 
+    # GPAP staging area data but not in RD3
+    no_clinical_obs = phen_observations['part of clinical observation'].isna()
+    for report_id in phen_observations.loc[no_clinical_obs, 'report_id']:
+        logging.warning(f'Individual {report_id} does not have a clinical observation ID. The \
     individual is not included in the Phenotype Observations.')
-            continue
-        
-        # get all observations of this individual
-        observations_all = parse_entries(pheno_obs.get('type'))
-        
-        # loop through the phenotypic observations of the individual
-        for observation in observations_all:
-            name = observation.get('name')
-            if name is None:
-                continue
-            
-            pheno_observations2.append({
-                'part of clinical observation': id,
-                'type': name,
-                'excluded': not observation.get('observed'),
-                'phenotype code': observation.get('id')
-            })
-            # save the phenotype names with code as prevalent in GPAP
-            observations.add((name, observation.get('id')))
-
-    # convert phenotypic observations list to df
-    phen_observations = pd.DataFrame(pheno_observations2)
+    phen_observations = phen_observations[~no_clinical_obs]
+
+    # one row per phenotypic observation of the individual
+    phen_observations['features'] = phen_observations['features'].map(parse_entries)
+    phen_observations = phen_observations.explode('features')
+    phen_observations = phen_observations[phen_observations['features'].map(lambda x: isinstance(x, dict))]
+    if phen_observations.empty:
+        return pd.DataFrame(columns=columns), set()
+
+    features = pd.DataFrame(phen_observations['features'].tolist(), columns=['name', 'observed', 'id'])
+    features['part of clinical observation'] = phen_observations['part of clinical observation'].to_numpy()
+    features = features[features['name'].notna()]
+    # features without an id have None as code, as in the (name, code) pairs of the matches
+    codes = features['id'].astype(object).where(features['id'].notna(), None)
+
+    phen_observations = pd.DataFrame({
+        'part of clinical observation': features['part of clinical observation'],
+        'type': features['name'],
+        'excluded': ~features['observed'].fillna(False).astype(bool),
+        'phenotype code': codes
+    }).reset_index(drop=True)
+
+    # save the phenotype names with code as prevalent in GPAP
+    observations = set(zip(features['name'], codes))
+
+    return phen_observations, observations
+
+def build_import_phenotype_observations(client, data: pd.DataFrame):
+    """Map staging area data to phenotype observations data"""
+    phen_observations, observations = parse_phenotype_observations(data=data,
+                                                                   id_map=get_clinical_observation_ids(data))
 
     # map the phenotypic features from GPAP format to RD3
     non_matches, mappings = match_phenotypes(observations)
@@ -576,37 +662,43 @@ def build_import_phenotype_observations(client, data: pd.DataFrame):
     # drop unneccessary columns
     phen_observations = phen_observations.drop(columns=['phenotype code', 'key'])
 
-    # upload
-    client.save_schema(table='Phenotype observations',
-                       data=phen_observations.drop_duplicates())
+    # upload the changes
+    save_table_diff(client=client,
+                    table='Phenotype observations',
+                    data=phen_observations.drop_duplicates(),
+                    keys=['part of clinical observation', 'type'],
+                    schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])
+
+def build_pipeline(client: Client, data: pd.DataFrame) -> Pipeline:
+    """Define the mapping of the participants to RD3 as stages with their dependencies"""
+    return Pipeline([
+        Stage('pedigree', lambda: build_import_pedigree_table(client, data)),
+        Stage('individuals', lambda: build_import_individuals_table(client, data)),
+        Stage('pedigree members', lambda: build_import_pedigree_members(client, data),
+              depends_on=['pedigree', 'individuals']),
+        Stage('clinical observations', lambda: build_import_clinical_observations(client, data),
+              depends_on=['individuals']),
+        Stage('consent', lambda: build_import_consent(client, data),
+              depends_on=['individuals']),
+        Stage('disease history', lambda: build_import_disease_history(client, data),
+              depends_on=['clinical observations']),
+        Stage('phenotype observations', lambda: build_import_phenotype_observations(client, data),
+              depends_on=['clinical observations'])
+    ])
 
 if __name__ == "__main__":
 
     participants = get_staging_area_participants()
 
-    db = Client(
-        environ['MOLGENIS_HOST'],
-        schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'],
-        token=environ['MOLGENIS_TOKEN']
-    )
-
-    # 1. Pedigree table mapping
-    build_import_pedigree_table(db, participants)
-
-    # 2. Individuals table mapping
-    build_import_individuals_table(db, participants)
-
-    # 3. Pegidgree Members mapping
-    build_import_pedigree_members(db, participants)
-
-    # 4. Clinical Observations mapping
-    build_import_clinical_observations(db, participants)
+    db = molgenis_clients.get(schema=environ['MOLGENIS_HOST_SCHEMA_TARGET'])
 
-    # 5. Individual Consent mappings
-    build_import_consent(db, participants)
+    # run all stages, or only the (comma separated) stages in MAPPING_STAGES
+    pipeline = build_pipeline(client=db, data=participants)
+    stages = environ.get('MAPPING_STAGES')
+    pipeline.run(only=stages.split(',') if stages else None,
+                 max_workers=int(environ.get('MAPPING_MAX_WORKERS', 4)))
 
-    # 6. Disease History mapping
-    build_import_disease_history(db, participants)
+    molgenis_clients.close()
 
-    # 7. Phenotype Observations mapping
-    build_import_phenotype_observations(db, participants)
\ No newline at end of file
+    if pipeline.failed:
+        sys.exit(f'The following stages did not succeed: {pipeline.failed}')
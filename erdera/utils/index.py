@@ -1,5 +1,11 @@
 """General utils"""
+import io
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Iterator, TextIO
 
 def date_today() -> str:
     """Today's date as yyyy-mm-dd"""
@@ -8,3 +14,67 @@ def date_today() -> str:
 def date_now() -> str:
     """Current time as Hour:Minutes"""
     return datetime.now().strftime("%H%M")
+
+class TokenBucket:
+    """Thread-safe token bucket for rate limiting API requests"""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        """Initialize the token bucket
+
+        :param rate: number of tokens (i.e., requests) added per second
+        :type rate: float
+
+        :param capacity: maximum number of tokens that can be stored (burst size)
+        :type capacity: int (default: 1)
+        """
+        self.rate: float = rate
+        self.capacity: int = capacity
+        self.tokens: float = capacity
+        self.updated_at: float = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and consume it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+@contextmanager
+def open_zip_csv(archive: zipfile.ZipFile, name: str) -> Iterator[TextIO]:
+    """Open a file inside a zip archive for writing text, so data can be
+    serialised straight into the compressed archive without a temporary file
+
+    :param archive: a zip archive opened in write mode
+    :type archive: zipfile.ZipFile
+
+    :param name: name of the file in the archive (e.g., Participants.csv)
+    :type name: str
+    """
+    with archive.open(name, mode='w', force_zip64=True) as member:
+        with io.TextIOWrapper(member, encoding='utf-8', newline='') as file:
+            yield file
+
+def write_zip_archive(frames: dict, file_path: str, compresslevel: int = 6):
+    """Serialise data frames as CSV files directly into a zip archive
+
+    :param frames: mapping of table names to pandas DataFrames; each frame is
+        written to <table name>.csv
+    :type frames: dict[str, pd.DataFrame]
+
+    :param file_path: location of the zip archive
+    :type file_path: str
+
+    :param compresslevel: deflate compression level, from 0 (no compression) to 9
+    :type compresslevel: int (default: 6)
+    """
+    with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+        for name, frame in frames.items():
+            with open_zip_csv(archive, f'{name}.csv') as file:
+                frame.to_csv(file, index=False)
@@ -0,0 +1,144 @@
+"""Assign pandas dtypes to staging area data based on the EMX2 model
+The column types in `model/<schema>/molgenis.csv` determine the dtype of each
+column: nullable integer, decimal and boolean dtypes, datetimes and strings.
+String columns with few distinct values (e.g. sex, solved, library_strategy,
+erns) are stored as categoricals, so each value is stored once.
+
+Dates are parsed per value (as their format and timezone differ between
+records) and converted to UTC without a timezone; values that cannot be parsed
+are logged and left empty.
+
+Values of categorical columns are replaced with Series.map (on the categories),
+as setting a value that is not a category raises a TypeError; map_categories
+applies a vectorised conversion (e.g. pd.to_numeric) to the categories only, so
+the mappings do not expand a categorical into a value per row.
+"""
+
+import logging
+import os
+from functools import lru_cache
+from typing import Callable
+
+import pandas as pd
+
+log = logging.getLogger("Model types")
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'model')
+
+# pandas dtype per EMX2 column type; columns of other types (e.g. arrays) are not converted
+DTYPES = {
+    'string': 'string',
+    'text': 'string',
+    'ref': 'string',
+    'int': 'Int64',
+    'long': 'Int64',
+    'decimal': 'Float64',
+    'bool': 'boolean',
+    'date': 'datetime64[ns]',
+    'datetime': 'datetime64[ns]'
+}
+
+# column types that are stored as categoricals if their values repeat
+CATEGORICAL_TYPES = ['string', 'ref']
+
+
+@lru_cache
+def get_column_types(schema: str, table: str, model_path: str = MODEL_PATH) -> dict[str, dict]:
+    """Read the column types of a table from the EMX2 model
+
+    :param schema: name of the model directory, e.g. 'staging_area_gpap'
+    :type schema: str
+
+    :param table: name of the table
+    :type table: str
+
+    :param model_path: directory with the models
+    :type model_path: str (default: the model directory of this repository)
+
+    :returns: the column type and whether the column is part of the key, per column
+    :rtype: dict[str, dict]
+    """
+    model = pd.read_csv(os.path.join(model_path, schema, 'molgenis.csv'), dtype=str, keep_default_na=False)
+    columns = model[(model['tableName'] == table) & (model['columnName'] != '')]
+    return {
+        column['columnName']: {
+            'type': column['columnType'] or 'string',  # EMX2 columns are strings by default
+            'key': column['key'] != ''
+        }
+        for column in columns.to_dict('records')
+        if column['columnType'] != 'section'
+    }
+
+
+def apply_model_dtypes(data: pd.DataFrame, schema: str, table: str, max_ratio: float = 0.1) -> pd.DataFrame:
+    """Convert the columns of a staging area table to the dtypes of their column type
+
+    :param data: the table data, e.g. as retrieved with the pyclient
+    :type data: pd.DataFrame
+
+    :param schema: name of the model directory, e.g. 'staging_area_gpap'
+    :type schema: str
+
+    :param table: name of the table
+    :type table: str
+
+    :param max_ratio: maximum ratio of distinct values to (non-empty) values of a
+        string column that is stored as a categorical; key columns are never
+        stored as categoricals (the codes and categories of a column of which most
+        values are distinct, e.g. family ids, take more memory than the strings)
+    :type max_ratio: float (default: 0.1)
+
+    :returns: the data with the converted columns
+    :rtype: pd.DataFrame
+    """
+    column_types = get_column_types(schema, table)
+    dtypes = {}
+    for name, column in data.items():
+        if name not in column_types:
+            continue
+        column_type = column_types[name]['type']
+        dtype = DTYPES.get(column_type)
+        if dtype is None:
+            continue
+
+        if dtype.startswith('datetime'):
+            if not pd.api.types.is_datetime64_any_dtype(column):
+                dates = pd.to_datetime(column, errors='coerce', format='mixed', utc=True).dt.tz_localize(None)
+                invalid = dates.isna() & (column.astype('string').str.strip().fillna('') != '')
+                if invalid.any():
+                    log.warning("Could not convert %d values of %s.%s to a date, e.g. %r",
+                                invalid.sum(), table, name, column[invalid].iloc[0])
+                dtypes[name] = dates
+            continue
+
+        values = column.count()
+        if (column_type in CATEGORICAL_TYPES and not column_types[name]['key']
+                and values and column.nunique() <= max_ratio * values):
+            dtype = pd.CategoricalDtype(pd.Index(column.dropna().unique(), dtype='string').sort_values())
+
+        if column.dtype != dtype:
+            try:
+                dtypes[name] = column.astype(dtype)
+            except (TypeError, ValueError) as err:
+                log.warning("Could not convert %s.%s to %s: %s", table, name, dtype, err)
+
+    return data.assign(**dtypes) if dtypes else data
+
+
+def map_categories(column: pd.Series, func: Callable[[pd.Series], pd.Series]) -> pd.Series:
+    """Apply a vectorised function to the values of a column. The function is applied
+    to the categories of a categorical column only, instead of to a value per row.
+
+    :param column: the column, e.g. a categorical of apply_model_dtypes
+    :type column: pd.Series
+
+    :param func: function that converts a Series of values
+    :type func: Callable[[pd.Series], pd.Series]
+
+    :returns: the converted values
+    :rtype: pd.Series
+    """
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        return func(column)
+    categories = column.cat.categories
+    return column.map(dict(zip(categories, func(pd.Series(categories)))))
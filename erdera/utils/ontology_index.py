@@ -0,0 +1,275 @@
+"""Match terms to an ontology table (e.g. Phenotypes, Diseases, Tissue type)
+The terms of the ontology are indexed once on their normalised code, their
+case-folded name, their synonyms and the trigrams of their names, so incoming
+(name, code) pairs that differ in case, whitespace, punctuation or the prefix of
+the code are resolved with a dictionary lookup, and near matches with a trigram
+search instead of a comparison to every term.
+"""
+
+import re
+import unicodedata
+from typing import Iterable, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+# confidence of each type of match, the confidence of a 'name' and 'similar name'
+# match also depends on the similarity of the names
+CONFIDENCE = {
+    'normalised': 1.0,  # same code and name after normalisation
+    'synonym': 0.95,  # same code, the name is a synonym of the term
+    'name': (0.5, 0.9),  # same code, different name
+    'code': 0.8,  # same name, different code
+    'synonym without code': 0.7,  # the name is a synonym, different code
+    'similar name': (0.0, 0.7)  # no code or name match, similar name
+}
+
+
+class TermMatch(NamedTuple):
+    """Best matching term of an incoming (name, code) pair"""
+    name: str
+    code: str | None
+    type: str
+    confidence: float
+
+
+def is_empty(value) -> bool:
+    """Check if a value is None, NaN or an empty string"""
+    if isinstance(value, str):
+        return value == ''
+    return value is None or bool(pd.isna(value))
+
+
+def normalise_name(name) -> str | None:
+    """Case-fold a name and remove its accents, punctuation and repeated whitespace,
+    e.g. 'Marfan-Syndrome ' -> 'marfan syndrome'
+
+    :param name: name of a term
+    :type name: str
+
+    :returns: the normalised name, or None if the name is empty
+    :rtype: str | None
+    """
+    if is_empty(name):
+        return None
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(character for character in name if not unicodedata.combining(character))
+    name = ' '.join(re.sub(r'[\W_]+', ' ', name.casefold()).split())
+    return name or None
+
+
+def normalise_code(code) -> str | None:
+    """Remove the prefix (code system) and whitespace of a code, e.g. 'ORPHA: 558',
+    'Orphanet_558' and '558' -> '558'
+
+    :param code: code of a term
+    :type code: str
+
+    :returns: the normalised code, or None if the code is empty
+    :rtype: str | None
+    """
+    if is_empty(code):
+        return None
+    code = ''.join(str(code).split()).upper()
+    return code.replace('_', ':').rsplit(':', 1)[-1] or None
+
+
+def normalise_codes(codes: pd.Series) -> pd.Series:
+    """Remove the prefix (code system) and whitespace of a column of codes, as
+    normalise_code does per code
+
+    :param codes: codes of terms
+    :type codes: pd.Series
+
+    :returns: the normalised codes, with None for the empty codes
+    :rtype: pd.Series
+    """
+    codes = codes.astype('string').str.replace(r'\s+', '', regex=True).str.upper()
+    codes = codes.str.replace(r'^.*[:_]', '', regex=True)
+    # as objects, which are compared (isin) much faster than the pyarrow strings
+    return codes.astype(object).where(codes.fillna('') != '', None)
+
+
+def trigrams(name: str | None) -> frozenset:
+    """Trigrams of a normalised name, padded so the start and end of the name count
+
+    :param name: normalised name
+    :type name: str
+
+    :returns: the trigrams of the name
+    :rtype: frozenset
+    """
+    if not name:
+        return frozenset()
+    padded = f'  {name} '
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def similarity(first: frozenset, second: frozenset) -> float:
+    """Dice coefficient of two sets of trigrams"""
+    if not first or not second:
+        return 0.0
+    return 2 * len(first & second) / (len(first) + len(second))
+
+
+class OntologyIndex:
+    """Index of the terms of an ontology table
+
+    :param ontology: the ontology table, with at least a 'name' column
+    :type ontology: pd.DataFrame
+
+    :param synonym_columns: columns with alternative names of the terms; columns
+        that are not in the table are ignored
+    :type synonym_columns: list[str] (default: ['label'])
+
+    :param synonyms: additional synonyms, as alternative name -> name of the term
+    :type synonyms: dict
+
+    :param min_similarity: minimum similarity of a near match
+    :type min_similarity: float (default: 0.6)
+    """
+
+    def __init__(self, ontology: pd.DataFrame, synonym_columns: list[str] = None,
+                 synonyms: dict = None, min_similarity: float = 0.6):
+        self.min_similarity = min_similarity
+
+        ontology = ontology[ontology['name'].notna()]
+        self.names: list[str] = ontology['name'].tolist()
+        self.codes: list = ontology['code'].tolist() if 'code' in ontology else [None] * len(self.names)
+        self._names = [normalise_name(name) for name in self.names]
+
+        self._by_code: dict[str, int] = {}
+        self._by_name: dict[str, int] = {}
+        for term, (name, code) in enumerate(zip(self._names, self.codes)):
+            if name is not None:
+                self._by_name.setdefault(name, term)
+            if (code := normalise_code(code)) is not None:
+                self._by_code.setdefault(code, term)
+
+        # names take precedence over synonyms
+        self._by_synonym: dict[str, int] = {}
+        for column in synonym_columns or ['label']:
+            if column not in ontology:
+                continue
+            for term, synonym in enumerate(ontology[column].map(normalise_name)):
+                if synonym is not None and synonym not in self._by_name:
+                    self._by_synonym.setdefault(synonym, term)
+        for synonym, name in (synonyms or {}).items():
+            synonym, term = normalise_name(synonym), self._by_name.get(normalise_name(name))
+            if synonym is not None and term is not None and synonym not in self._by_name:
+                self._by_synonym.setdefault(synonym, term)
+
+        # the names and synonyms are searched on their trigrams: for each trigram the
+        # entries (names and synonyms) that contain it
+        self._grams = [trigrams(name) for name in self._names]
+        entries = list(enumerate(self._grams)) + [(term, trigrams(synonym)) for synonym, term in self._by_synonym.items()]
+        self._entry_terms = np.array([term for term, _ in entries], dtype=np.int64)
+        self._entry_sizes = np.array([len(grams) for _, grams in entries], dtype=np.int64)
+        postings: dict[str, list[int]] = {}
+        for entry, (_, grams) in enumerate(entries):
+            for gram in grams:
+                postings.setdefault(gram, []).append(entry)
+        self._trigrams = {gram: np.array(entries, dtype=np.int64) for gram, entries in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _match(self, term: int, match_type: str, confidence: float) -> TermMatch:
+        return TermMatch(self.names[term], self.codes[term], match_type, round(confidence, 3))
+
+    def similar(self, name: str, limit: int = 1) -> list[tuple[int, float]]:
+        """Search the terms of which the name (or a synonym) is most similar to a name
+
+        :param name: the name to search
+        :type name: str
+
+        :param limit: maximum number of terms
+        :type limit: int (default: 1)
+
+        :returns: the terms and their similarity, most similar first, with a
+            similarity of at least min_similarity
+        :rtype: list[tuple[int, float]]
+        """
+        grams = trigrams(normalise_name(name))
+        postings = [self._trigrams[gram] for gram in grams if gram in self._trigrams]
+        if not postings:
+            return []
+
+        # the number of shared trigrams of all entries at once
+        shared = np.bincount(np.concatenate(postings), minlength=self._entry_terms.size)
+        scores = 2 * shared / (len(grams) + self._entry_sizes)
+        candidates = np.flatnonzero(scores >= self.min_similarity)
+
+        # the best scoring entry (name or synonym) of each term
+        best: dict[int, float] = {}
+        for entry in candidates[np.argsort(-scores[candidates], kind='stable')]:
+            term = int(self._entry_terms[entry])
+            if term not in best:
+                best[term] = float(scores[entry])
+                if len(best) == limit:
+                    break
+        return list(best.items())
+
+    def lookup(self, name, code=None) -> TermMatch | None:
+        """Find the best matching term of a (name, code) pair. The code is matched
+        first, then the name, the synonyms and finally similar names.
+
+        :param name: incoming name
+        :type name: str
+
+        :param code: incoming code, if any
+        :type code: str
+
+        :returns: the matching term, or None if there is no term with a similar name
+        :rtype: TermMatch | None
+        """
+        name, code = normalise_name(name), normalise_code(code)
+
+        term = self._by_code.get(code) if code is not None else None
+        if term is not None:
+            # a name without letters or digits (e.g. '---') is not the same name
+            if name is not None and self._names[term] == name:
+                return self._match(term, 'normalised', CONFIDENCE['normalised'])
+            if self._by_synonym.get(name) == term:
+                return self._match(term, 'synonym', CONFIDENCE['synonym'])
+            low, high = CONFIDENCE['name']
+            score = similarity(trigrams(name), self._grams[term])
+            return self._match(term, 'name', low + (high - low) * score)
+
+        if name is None:
+            return None
+
+        # without a code (e.g. tissue types), a matching name is sufficient
+        term = self._by_name.get(name)
+        if term is not None:
+            if code is None:
+                return self._match(term, 'normalised', CONFIDENCE['normalised'])
+            return self._match(term, 'code', CONFIDENCE['code'])
+
+        term = self._by_synonym.get(name)
+        if term is not None:
+            if code is None:
+                return self._match(term, 'synonym', CONFIDENCE['synonym'])
+            return self._match(term, 'synonym', CONFIDENCE['synonym without code'])
+
+        for term, score in self.similar(name):
+            low, high = CONFIDENCE['similar name']
+            return self._match(term, 'similar name', low + (high - low) * score)
+        return None
+
+    def match(self, terms: Iterable[tuple]) -> pd.DataFrame:
+        """Find the best matching term of each (name, code) pair
+
+        :param terms: incoming (name, code) pairs
+        :type terms: Iterable[tuple]
+
+        :returns: the incoming name and code with the name, code, type of match and
+            confidence of the matching term; pairs without a match are left out
+        :rtype: pd.DataFrame
+        """
+        rows = []
+        for name, code in terms:
+            match = self.lookup(name, code)
+            if match is not None:
+                rows.append((name, code, *match))
+        return pd.DataFrame(rows, columns=['incoming name', 'incoming code', 'name', 'code', 'type', 'confidence'])
@@ -0,0 +1,153 @@
+"""Run the steps of a mapping as a pipeline of stages
+Each stage declares the stages it depends on. A stage starts as soon as all of
+its dependencies have finished, so independent stages run concurrently.
+"""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Literal, TypedDict
+
+log = logging.getLogger("Pipeline")
+
+
+@dataclass
+class Stage:
+    """A step of the pipeline
+
+    :param name: unique name of the stage
+    :param func: callable without arguments that runs the stage
+    :param depends_on: names of the stages that must finish before this stage starts
+    """
+    name: str
+    func: Callable[[], Any]
+    depends_on: list[str] = field(default_factory=list)
+
+
+class StageResult(TypedDict):
+    """Outcome of a stage"""
+    status: Literal['success', 'failed', 'skipped']
+    duration: float
+    result: Any
+    error: str | None
+
+
+class Pipeline:
+    """Run stages in dependency order, with independent stages in parallel"""
+
+    def __init__(self, stages: list[Stage]):
+        self.stages: dict[str, Stage] = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Stage {stage.name!r} is defined more than once")
+            self.stages[stage.name] = stage
+
+        for stage in stages:
+            unknown = set(stage.depends_on) - set(self.stages)
+            if unknown:
+                raise ValueError(f"Stage {stage.name!r} depends on unknown stage(s) {sorted(unknown)}")
+        self._check_cycles()
+
+        self.results: dict[str, StageResult] = {}
+
+    def _check_cycles(self):
+        """Raise a ValueError if the dependencies contain a cycle"""
+        visited: set[str] = set()
+        visiting: set[str] = set()
+
+        def visit(name: str):
+            if name in visiting:
+                raise ValueError(f"Stage {name!r} is part of a dependency cycle")
+            if name in visited:
+                return
+            visiting.add(name)
+            for dependency in self.stages[name].depends_on:
+                visit(dependency)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    @property
+    def failed(self) -> list[str]:
+        """Names of the stages that failed or were skipped"""
+        return [name for name, result in self.results.items() if result['status'] != 'success']
+
+    def result(self, name: str) -> Any:
+        """Return value of a finished stage"""
+        return self.results[name]['result']
+
+    def _run_stage(self, stage: Stage) -> StageResult:
+        log.info("Starting stage %r", stage.name)
+        start = time.perf_counter()
+        try:
+            result = stage.func()
+        except Exception as err:
+            log.exception("Stage %r failed", stage.name)
+            return {'status': 'failed', 'duration': time.perf_counter() - start,
+                    'result': None, 'error': str(err)}
+        duration = time.perf_counter() - start
+        log.info("Finished stage %r in %.1fs", stage.name, duration)
+        return {'status': 'success', 'duration': duration, 'result': result, 'error': None}
+
+    def run(self, only: list[str] = None, max_workers: int = 4) -> dict[str, StageResult]:
+        """Run the stages. Stages of which a dependency failed are skipped.
+
+        :param only: names of the stages to run, e.g. to re-run a single stage; the
+            dependencies of these stages are assumed to have run before
+        :type only: list[str]
+
+        :param max_workers: maximum number of stages that run at the same time
+        :type max_workers: int (default: 4)
+
+        :returns: the outcome of each stage
+        :rtype: dict[str, StageResult]
+        """
+        selected = set(only) if only else set(self.stages)
+        unknown = selected - set(self.stages)
+        if unknown:
+            raise ValueError(f"Unknown stage(s) {sorted(unknown)}")
+
+        # dependencies outside of the selection are considered done
+        pending = {name: set(self.stages[name].depends_on) & selected for name in selected}
+        running: dict[Future, str] = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name in [name for name, dependencies in pending.items() if not dependencies]:
+                    del pending[name]
+                    running[executor.submit(self._run_stage, self.stages[name])] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.results[name] = future.result()
+                    if self.results[name]['status'] == 'success':
+                        for dependencies in pending.values():
+                            dependencies.discard(name)
+                    else:
+                        self._skip_dependents(name, pending)
+
+        self.log_timings()
+        return self.results
+
+    def _skip_dependents(self, name: str, pending: dict[str, set]):
+        """Mark the stages that (indirectly) depend on a failed stage as skipped"""
+        for dependent in [dependent for dependent in pending if name in self.stages[dependent].depends_on]:
+            if dependent not in pending:
+                continue
+            del pending[dependent]
+            log.warning("Skipping stage %r, as stage %r did not succeed", dependent, name)
+            self.results[dependent] = {'status': 'skipped', 'duration': 0.0, 'result': None,
+                                       'error': f'dependency {name!r} did not succeed'}
+            self._skip_dependents(dependent, pending)
+
+    def log_timings(self):
+        """Log the status and duration of each stage"""
+        for name, result in self.results.items():
+            log.info("%-30s %-8s %8.1fs", name, result['status'], result['duration'])
@@ -0,0 +1,174 @@
+"""Write only the changes of a table to MOLGENIS
+The mapped data is compared to the rows currently in the target table on a
+natural key (e.g. the individual), so the table is never emptied and only the
+inserted, updated and deleted rows are sent.
+"""
+
+import logging
+
+import pandas as pd
+from molgenis_emx2_pyclient.client import Client
+
+log = logging.getLogger("Table diff")
+
+
+def normalise_numbers(values: pd.Series) -> pd.Series:
+    """Convert integral floats to integers, e.g. an integer column that is read back
+    from MOLGENIS as float because it has empty values (1.0 -> 1)
+
+    :param values: values of a column
+    :type values: pd.Series
+
+    :returns: the values (as objects) with integral floats as integers
+    :rtype: pd.Series
+    """
+    if not (pd.api.types.is_float_dtype(values) or values.dtype == object):
+        return values.astype(object)
+    # not with Series.map, which would infer the float dtype again
+    return pd.Series([int(value) if isinstance(value, float) and value.is_integer() else value
+                      for value in values], index=values.index, dtype=object)
+
+
+def hash_rows(data: pd.DataFrame, columns: list[str]) -> pd.Series:
+    """Hash the values of each row, so rows can be compared in one pass. Values are
+    compared on their string representation, after integral floats are converted to
+    integers, as the types of the mapped data and of the data retrieved from MOLGENIS
+    may differ (e.g. 1 and 1.0).
+
+    :param data: rows to hash
+    :type data: pd.DataFrame
+
+    :param columns: columns to include in the hash
+    :type columns: list[str]
+
+    :returns: one hash per row
+    :rtype: pd.Series
+    """
+    values = pd.DataFrame({column: normalise_numbers(data[column]) for column in columns}, index=data.index)
+    values = values.where(values.notna(), '').astype(str)
+    return pd.util.hash_pandas_object(values, index=False)
+
+
+def diff_table(current: pd.DataFrame, data: pd.DataFrame, keys: list[str],
+               id_column: str = 'id') -> dict[str, pd.DataFrame]:
+    """Compare the mapped data to the current rows of a table.
+
+    :param current: rows currently in the table
+    :type current: pd.DataFrame
+
+    :param data: mapped rows
+    :type data: pd.DataFrame
+
+    :param keys: columns that identify a row in both the current and the mapped data
+    :type keys: list[str]
+
+    :param id_column: primary key of the table if it is generated by MOLGENIS (auto id);
+        it is copied from the current rows to the updated rows
+    :type id_column: str (default: 'id')
+
+    :returns: the rows to insert, to update and to delete
+    :rtype: dict[str, pd.DataFrame]
+    """
+    data = data.drop_duplicates(subset=keys, keep='last')
+    if current.empty or not set(keys).issubset(current.columns):
+        return {
+            'inserts': data.reset_index(drop=True),
+            'updates': data.iloc[0:0],
+            'deletes': current.iloc[0:0]
+        }
+
+    columns = [column for column in data.columns if column != id_column and column not in keys]
+    has_id = id_column in current.columns and id_column not in data.columns
+
+    # columns that are not in the current rows are compared as empty
+    current = current.assign(**{column: None for column in columns if column not in current.columns})
+
+    # rows with the same key are removed, only the first is kept and updated
+    duplicates = current[current.duplicated(subset=keys, keep='first')]
+    current = current.drop(index=duplicates.index)
+    current_keys = current[keys + ([id_column] if has_id else [])].copy()
+    current_keys['_hash'] = hash_rows(current, columns).to_numpy()
+
+    merged = data.merge(current_keys, on=keys, how='left', indicator=True)
+    merged['_changed'] = merged['_hash'].to_numpy() != hash_rows(merged, columns).to_numpy()
+
+    inserts = merged[merged['_merge'] == 'left_only']
+    updates = merged[(merged['_merge'] == 'both') & merged['_changed']]
+    inserts = inserts.drop(columns=['_merge', '_hash', '_changed'] + ([id_column] if has_id else []))
+    updates = updates.drop(columns=['_merge', '_hash', '_changed'])
+
+    new_keys = data[keys].drop_duplicates()
+    deletes = current.merge(new_keys, on=keys, how='left', indicator=True)
+    deletes = deletes[deletes['_merge'] == 'left_only'].drop(columns='_merge')
+    deletes = pd.concat([deletes, duplicates])
+
+    return {
+        'inserts': inserts.reset_index(drop=True),
+        'updates': updates.reset_index(drop=True),
+        'deletes': deletes.reset_index(drop=True)
+    }
+
+
+def save_table_diff(client: Client, table: str, data: pd.DataFrame, keys: list[str],
+                    schema: str = None, id_column: str = 'id', delete: bool = True,
+                    referenced_by: dict[str, str] = None) -> dict[str, int]:
+    """Insert, update and delete the rows of a table so it matches the mapped data.
+    Unlike truncating and reloading the table, readers never see an empty table
+    and the number of rows sent depends on what has changed.
+
+    :param client: an authenticated MOLGENIS client
+    :type client: Client
+
+    :param table: name of the table
+    :type table: str
+
+    :param data: mapped rows
+    :type data: pd.DataFrame
+
+    :param keys: columns that identify a row in both the current and the mapped data
+    :type keys: list[str]
+
+    :param schema: name of the schema (default: the default schema of the client)
+    :type schema: str
+
+    :param id_column: primary key of the table if it is generated by MOLGENIS (auto id)
+    :type id_column: str (default: 'id')
+
+    :param delete: if True, rows of the table that are not in the mapped data are deleted
+    :type delete: bool (default: True)
+
+    :param referenced_by: tables (and their reference column) that refer to this table;
+        rows of these tables that refer to a deleted row are deleted first, by their
+        id_column
+    :type referenced_by: dict[str, str]
+
+    :returns: the number of inserted, updated and deleted rows
+    :rtype: dict[str, int]
+    """
+    current = client.get(table=table, schema=schema, as_df=True)
+    diff = diff_table(current=current, data=data, keys=keys, id_column=id_column)
+
+    # delete first, so replaced rows do not conflict with their new version
+    if delete and not diff['deletes'].empty:
+        primary_key = [id_column] if id_column in diff['deletes'].columns else keys
+        for ref_table, ref_column in (referenced_by or {}).items():
+            references = client.get(table=ref_table, schema=schema, as_df=True)
+            if references.empty:
+                continue
+            references = references[references[ref_column].isin(diff['deletes'][primary_key[0]])]
+            if not references.empty:
+                client.delete_records(table=ref_table, schema=schema, data=references[[id_column]])
+        client.delete_records(table=table, schema=schema, data=diff['deletes'][primary_key])
+    if not diff['inserts'].empty:
+        client.save_table(table=table, schema=schema, data=diff['inserts'])
+    if not diff['updates'].empty:
+        client.save_table(table=table, schema=schema, data=diff['updates'])
+
+    counts = {
+        'inserts': diff['inserts'].shape[0],
+        'updates': diff['updates'].shape[0],
+        'deletes': diff['deletes'].shape[0] if delete else 0
+    }
+    log.info("%s: %d inserted, %d updated, %d deleted rows",
+             table, counts['inserts'], counts['updates'], counts['deletes'])
+    return counts
@@ -0,0 +1,70 @@
+"""Tests of the retrieval of EGA dataset endpoints"""
+import json
+
+import pytest
+import requests
+
+from erdera.clients.egaClient import EGASubmissionsClient, iter_json_array
+
+
+def make_client(responses: dict) -> EGASubmissionsClient:
+    """EGA client without authentication, of which each endpoint returns (or raises) a response"""
+    client = EGASubmissionsClient.__new__(EGASubmissionsClient)
+
+    def get_endpoint_dataset(provisional_id: str, endpoint: str = None, include_headers: bool = True):
+        response = responses[endpoint]
+        if isinstance(response, Exception):
+            raise response
+        return {'data': response, 'errors': [], 'errorCount': 0}
+
+    client.get_endpoint_dataset = get_endpoint_dataset
+    return client
+
+
+def test_get_endpoints_dataset_failed_endpoint():
+    """An endpoint that fails is reported as an error, the other endpoints are kept"""
+    client = make_client({
+        'studies': [{'accession_id': 'EGAS1'}],
+        'files': requests.exceptions.ConnectionError('connection reset'),
+        'samples': [{'accession_id': 'EGAN1'}, {'accession_id': 'EGAN2'}]
+    })
+
+    responses = client.get_endpoints_dataset(provisional_id='EGAD1', endpoints=['studies', 'files', 'samples'])
+
+    assert len(responses['studies']['data']) == 1
+    assert len(responses['samples']['data']) == 2
+    assert responses['files']['data'] == []
+    assert responses['files']['errorCount'] == 1
+    assert responses['files']['errors'][0]['type'] == 'ConnectionError'
+
+
+def test_iter_json_array_chunks():
+    """Items are parsed the same for any chunk size, also if an item spans chunks"""
+    items = [{'alias': 'x\\"y]},[', 'files': [1, 2, {'checksum': 'é'}], 'size': None},
+             12, 's,]', -1.5e-3, [], {}, True, None]
+    body = json.dumps(items, ensure_ascii=False).encode()
+
+    for chunk_size in range(1, len(body) + 1):
+        chunks = (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+        assert list(iter_json_array(chunks)) == items
+
+    assert list(iter_json_array([b'{"accession_id": ', b'"EGAD1"}'])) == [{'accession_id': 'EGAD1'}]
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'[{"accession_id": "EGAF1"}, {"acc']))
+
+
+def test_iter_endpoint_dataset_pages():
+    """A response is yielded in pages, a server that ignores skip is reported as an error"""
+    client = EGASubmissionsClient.__new__(EGASubmissionsClient)
+    client.api_url = 'https://ega'
+    records = [{'accession_id': f'EGAF{i}'} for i in range(5)]
+
+    def get(url: str = None, include_headers: bool = True, params: dict = None, stream: bool = False):
+        return {'data': iter(records[:params['limit']]), 'errors': [], 'errorCount': 0}
+
+    client.get = get
+    pages = list(client.iter_endpoint_dataset(provisional_id='EGAD1', endpoint='files', page_size=2))
+
+    assert [page['data'] for page in pages[:-1]] == [records[:2]]
+    assert pages[-1]['errorCount'] == 1
+    assert pages[-1]['errors'][0]['type'] == 'Pagination'
@@ -0,0 +1,43 @@
+"""Tests of the fingerprint of the cached ontology tables"""
+from types import SimpleNamespace
+
+from erdera.clients.ontology_cache import get_table_fingerprint
+
+
+class FakeResponse:
+    def __init__(self, body: dict):
+        self.ok = 'errors' not in body
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def make_client(body: dict):
+    """MOLGENIS client of which each GraphQL query returns the same body"""
+    table = SimpleNamespace(id='Phenotypes')
+    return SimpleNamespace(
+        url='https://example.org',
+        get_schema_metadata=lambda name: SimpleNamespace(get_table=lambda by, value: table),
+        session=SimpleNamespace(post=lambda url, json: FakeResponse(body))
+    )
+
+
+def test_table_fingerprint():
+    client = make_client({'data': {'Phenotypes_agg': {'count': 2},
+                                   'Phenotypes': [{'mg_updatedOn': '2024-01-01T10:00:00'}]}})
+    assert get_table_fingerprint(client=client, table='Phenotypes', schema='Ontologies') == \
+        {'count': 2, 'updatedOn': '2024-01-01T10:00:00'}
+
+    empty = make_client({'data': {'Phenotypes_agg': {'count': 0}, 'Phenotypes': None}})
+    assert get_table_fingerprint(client=empty, table='Phenotypes', schema='Ontologies') == \
+        {'count': 0, 'updatedOn': None}
+
+
+def test_table_fingerprint_without_modification_date():
+    """The row count does not change if a record is updated, so it is not a fingerprint"""
+    client = make_client({'errors': [{'message': 'Field mg_updatedOn is undefined'}]})
+    assert get_table_fingerprint(client=client, table='Phenotypes', schema='Ontologies') is None
+
+    client = make_client({'data': {'Phenotypes_agg': {'count': 2}, 'Phenotypes': [{'mg_updatedOn': None}]}})
+    assert get_table_fingerprint(client=client, table='Phenotypes', schema='Ontologies') is None
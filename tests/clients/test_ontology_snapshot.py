@@ -0,0 +1,57 @@
+"""Tests of the offline snapshot of the reference tables"""
+import pandas as pd
+import pytest
+
+from erdera.clients import ontology_cache as ontology_cache_module
+from erdera.clients.ontology_cache import OntologyCache
+from erdera.clients.ontology_snapshot import OntologySnapshot
+
+pytest.importorskip('pyarrow')
+
+
+@pytest.fixture
+def phenotypes():
+    return pd.DataFrame({
+        'name': ['Seizure', 'Abnormality of the eye'],
+        'code': ['HP:0001250', 'HP:0000478'],
+        'label': ['Epileptic seizure', None]
+    })
+
+
+def test_snapshot_round_trip(tmp_path, phenotypes):
+    OntologySnapshot(str(tmp_path)).write(table='Phenotypes', schema='CatalogueOntologies',
+                                          data=phenotypes, host='https://example.org')
+
+    snapshot = OntologySnapshot(str(tmp_path))
+    assert ('CatalogueOntologies', 'Phenotypes') in snapshot
+    assert snapshot.get(table='Diseases', schema='CatalogueOntologies') is None
+    pd.testing.assert_frame_equal(snapshot.get(table='Phenotypes', schema='CatalogueOntologies'),
+                                  phenotypes, check_dtype=False)
+
+
+def test_cache_loads_from_snapshot(tmp_path, monkeypatch, phenotypes):
+    OntologySnapshot(str(tmp_path)).write(table='Phenotypes', schema='CatalogueOntologies', data=phenotypes)
+    monkeypatch.setenv('SCHEMA_ONTOLOGIES', 'CatalogueOntologies')
+
+    def connect(*args, **kwargs):
+        raise AssertionError('MOLGENIS should not be contacted')
+    monkeypatch.setattr(ontology_cache_module.molgenis_clients, 'get', connect)
+
+    cache = OntologyCache(path=str(tmp_path / 'cache'), snapshot_path=str(tmp_path))
+    data = cache.get(table='Phenotypes', schema='CatalogueOntologies')
+    assert data['name'].tolist() == ['Seizure', 'Abnormality of the eye']
+
+
+def test_cache_ignores_snapshot_of_other_schemas(tmp_path, monkeypatch, phenotypes):
+    """Quality control tables are written by the mappings, so an older snapshot of them is not used"""
+    OntologySnapshot(str(tmp_path)).write(table='Phenotypes', schema='Quality control', data=phenotypes)
+    monkeypatch.setenv('SCHEMA_ONTOLOGIES', 'CatalogueOntologies')
+    monkeypatch.setenv('SCHEMA_QUALITY_CONTROL', 'Quality control')
+
+    def connect(*args, **kwargs):
+        raise ConnectionError('MOLGENIS is contacted')
+    monkeypatch.setattr(ontology_cache_module.molgenis_clients, 'get', connect)
+
+    cache = OntologyCache(path=str(tmp_path / 'cache'), snapshot_path=str(tmp_path))
+    with pytest.raises(ConnectionError):
+        cache.get(table='Phenotypes', schema='Quality control')
@@ -0,0 +1,49 @@
+"""Tests of the columnar cache of staging area tables"""
+import pandas as pd
+import pytest
+
+from erdera.clients import staging_cache as staging_cache_module
+from erdera.clients.staging_cache import StagingCache
+
+pytest.importorskip('pyarrow')
+
+
+class FakeClient:
+    """Count the downloads of a staging area table"""
+    def __init__(self, data: pd.DataFrame):
+        self.data = data
+        self.downloads = 0
+
+    def get(self, table, schema=None, as_df=True):
+        self.downloads += 1
+        return self.data.copy()
+
+
+@pytest.fixture
+def participants():
+    return pd.DataFrame({
+        'report_id': ['P0001', 'P0002', 'P0003'],
+        'solved': ['Solved', 'Unsolved', None],
+        'added by job': ['2025-01-01-run-1', '2025-01-01-run-1', '2025-02-01-run-1']
+    })
+
+
+def test_cache_is_refreshed_by_a_new_job(tmp_path, monkeypatch, participants):
+    jobs = {'2025-01-01-run-1': 2, '2025-02-01-run-1': 1}
+    monkeypatch.setattr(staging_cache_module, 'get_job_fingerprint', lambda **kwargs: dict(jobs))
+    client = FakeClient(participants)
+    cache = StagingCache(path=str(tmp_path))
+
+    first = cache.get(table='Participants', schema='GPAP staging', client=client)
+    second = cache.get(table='Participants', schema='GPAP staging', client=client)
+    assert client.downloads == 1
+    pd.testing.assert_frame_equal(first, second)
+    assert second['report_id'].tolist() == ['P0001', 'P0002', 'P0003']
+    assert second['solved'].isna().tolist() == [False, False, True]
+
+    # a new job adds records
+    jobs['2025-03-01-run-1'] = 1
+    cache.get(table='Participants', schema='GPAP staging', client=client)
+    assert client.downloads == 2
+    assert [path.name for path in (tmp_path / 'GPAP_staging' / 'Participants').iterdir()
+            if path.suffix == '.arrow'] == ['2025-03-01-run-1.arrow']
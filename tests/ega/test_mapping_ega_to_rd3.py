@@ -0,0 +1,44 @@
+"""Tests of the EGA staging area to RD3 mapping"""
+import pandas as pd
+import pytest
+
+from erdera.mapping.EGA import mapping_ega_to_rd3
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Record the accession IDs the files are mapped with instead of uploading them"""
+    staging_area = {
+        'dataset': pd.DataFrame({'accession_id': ['EGAD00000000001'], 'title': ['Dataset']}),
+        'studies': pd.DataFrame({'accession_id': ['EGAS00000000001'], 'title': ['Study']})
+    }
+    monkeypatch.setattr(mapping_ega_to_rd3, 'get_staging_area_data', lambda endpoint: staging_area[endpoint])
+    monkeypatch.setattr(mapping_ega_to_rd3, 'add_collections',
+                        lambda client: {'dataset_id': 'mapped dataset', 'study_id': 'mapped study'})
+
+    uploads = []
+
+    async def upload_files(client, accession_ids):
+        uploads.append(accession_ids)
+    monkeypatch.setattr(mapping_ega_to_rd3, 'upload_files', upload_files)
+    return uploads
+
+
+def test_files_use_mapped_collections(uploads):
+    pipeline = mapping_ega_to_rd3.build_pipeline(client=None)
+
+    pipeline.run()
+
+    assert pipeline.failed == []
+    assert uploads == [{'dataset_id': 'mapped dataset', 'study_id': 'mapped study'}]
+
+
+def test_rerun_files_only(uploads):
+    """The accession IDs are read from the staging area if the collections are not mapped"""
+    pipeline = mapping_ega_to_rd3.build_pipeline(client=None)
+
+    results = pipeline.run(only=['files'])
+
+    assert list(results) == ['files']
+    assert results['files']['status'] == 'success'
+    assert uploads == [{'dataset_id': 'EGAD00000000001', 'study_id': 'EGAS00000000001'}]
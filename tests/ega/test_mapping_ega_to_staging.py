@@ -0,0 +1,20 @@
+"""Tests of the EGA API to staging area import"""
+import pytest
+
+from erdera.mapping.EGA import mapping_ega_to_staging
+
+
+@pytest.mark.parametrize('variables, expected', [
+    ({'PROVISIONAL_ID': 'EGAD1'}, ['EGAD1']),
+    ({'PROVISIONAL_IDS': 'EGAD1, EGAD2,', 'PROVISIONAL_ID': 'EGAD3'}, ['EGAD1', 'EGAD2']),
+    ({'PROVISIONAL_IDS': ' , '}, []),
+    ({}, [])
+])
+def test_get_provisional_ids(monkeypatch, variables, expected):
+    monkeypatch.delenv('PROVISIONAL_IDS', raising=False)
+    monkeypatch.delenv('PROVISIONAL_ID', raising=False)
+    for name, value in variables.items():
+        monkeypatch.setenv(name, value)
+
+    assert mapping_ega_to_staging.get_provisional_ids() == expected
+
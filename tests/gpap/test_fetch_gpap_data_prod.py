@@ -0,0 +1,37 @@
+"""Tests of the incremental sync of the GPAP fetch script"""
+import pandas as pd
+
+from erdera.gpap.fetch_gpap_data_prod import filter_changed_records, init_job_output
+
+
+def test_filter_changed_records_superseded():
+    """Updated records are written with the current job and replace their previous version"""
+    page = pd.DataFrame({
+        'report_id': ['P1', 'P2', 'P3', 'P4'],
+        'last_modification_date': ['2024-01-01', '2024-03-01', '2024-03-01', '2024-03-01']
+    })
+    existing_ids = {'P1': 'run-1', 'P2': 'run-1', 'P4': 'run-2'}
+    output = init_job_output()
+
+    changed = filter_changed_records(page_df=page, meta_type='participants', output=output,
+                                     existing_ids=existing_ids,
+                                     modified_since=pd.Timestamp('2024-02-01', tz='UTC'),
+                                     incremental=True, job_id='run-2')
+
+    assert changed['report_id'].tolist() == ['P2', 'P3', 'P4']
+    assert (output['newCount'], output['updatedCount']) == (1, 2)
+    # P4 was added by the same (resumed) run, so it is upserted
+    assert output['superseded'] == [{'report_id': 'P2', 'added by job': 'run-1'}]
+
+
+def test_filter_changed_records_full():
+    """In a full sync all records are written and nothing is superseded"""
+    page = pd.DataFrame({'id': ['E1', 'E2']})
+    output = init_job_output()
+
+    changed = filter_changed_records(page_df=page, meta_type='experiments', output=output,
+                                     existing_ids={'E1': 'run-1'}, job_id='run-2')
+
+    assert changed['id'].tolist() == ['E1', 'E2']
+    assert (output['newCount'], output['updatedCount']) == (1, 0)
+    assert output['superseded'] == []
@@ -0,0 +1,307 @@
+"""Regression tests of the GPAP participants to RD3 mapping"""
+import pandas as pd
+import pytest
+
+from erdera.mapping.GPAP import mapping_cnag_to_rd3
+from erdera.utils.model_types import apply_model_dtypes, map_categories
+from erdera.utils.ontology_index import normalise_codes
+
+
+@pytest.fixture
+def participants():
+    """Staging area participants as retrieved from /<staging area>/Participants"""
+    return pd.DataFrame({
+        'report_id': ['P0001', 'P0002', 'P0003', 'P0004'],
+        'solved': ['Solved', 'Unsolved', None, 'Unsolved'],
+        'consanguinity': ['No', 'Yes', None, 'No'],
+        'onset': ['HP:0011463', 'HP:0003577', None, 'Unknown'],
+        'diagnosis': [
+            "[{'ordo': {'name': 'Marfan syndrome', 'id': 'ORPHA: 558'}, 'status': 'Confirmed'}, "
+            "{'ordo': {}, 'status': 'Suspected'}]",
+            "[{'ordo': {'name': 'Cystic fibrosis', 'id': 'ORPHA:586'}, 'status': 'Suspected'}, "
+            "{'omim': {'name': 'Not an ORDO term'}}]",
+            None,
+            "[{'ordo': {'name': 'Marfan syndrome', 'id': 'ORPHA:558'}, 'status': 'Confirmed'}]"
+        ]
+    })
+
+
+@pytest.fixture
+def rd3_tables():
+    """RD3 tables of a previous run, with an auto generated clinical observation ID"""
+    return {
+        'Clinical observations': pd.DataFrame({
+            'id': ['CO1', 'P0002-CO', 'P0001-CO'],
+            'individuals': ['P0004', 'P0002', 'P0001'],
+            'is solved': [False, False, True],
+            'consanguinity': [False, True, False],
+            'age group at onset': [None, 'Congenital onset', 'Childhood onset']
+        }),
+        'Phenotype observations': pd.DataFrame({
+            'id': ['PO1', 'PO2'],
+            'part of clinical observation': ['CO1', 'P0001-CO']
+        })
+    }
+
+
+class FakeClient:
+    """Record the uploads instead of sending them to MOLGENIS"""
+    def __init__(self, tables: dict):
+        self.tables = tables
+        self.saved = {}
+        self.deleted = {}
+
+    def get(self, table, as_df=True, **kwargs):
+        return self.tables.get(table, pd.DataFrame()).copy()
+
+    def save_table(self, table, data, **kwargs):
+        self.saved[table] = pd.concat([self.saved.get(table), data])
+
+    def save_schema(self, table, data, **kwargs):
+        self.save_table(table=table, data=data)
+
+    def delete_records(self, table, data, **kwargs):
+        self.deleted[table] = data
+
+
+def test_parse_disease_history(participants):
+    id_map = mapping_cnag_to_rd3.get_clinical_observation_ids(participants)
+    disease_history, diseases = mapping_cnag_to_rd3.parse_disease_history(data=participants, id_map=id_map)
+
+    expected = pd.DataFrame({
+        'part of clinical observation': ['P0001-CO', 'P0002-CO', 'P0004-CO'],
+        'disease': ['Marfan syndrome', 'Cystic fibrosis', 'Marfan syndrome'],
+        'disease status': ['Confirmed', 'Suspected', 'Confirmed'],
+        'disease code': ['558', '586', '558']
+    })
+    pd.testing.assert_frame_equal(disease_history, expected, check_dtype=False)
+    assert diseases == {('Marfan syndrome', '558'), ('Cystic fibrosis', '586')}
+
+
+def test_build_import_clinical_observations(monkeypatch, participants, rd3_tables):
+    monkeypatch.setenv('MOLGENIS_HOST_SCHEMA_TARGET', 'rd3')
+    client = FakeClient(rd3_tables)
+
+    mapping_cnag_to_rd3.build_import_clinical_observations(client=client, data=participants)
+
+    # the clinical observation with an auto generated ID is replaced, including its phenotypes
+    assert client.deleted['Phenotype observations']['id'].tolist() == ['PO1']
+    assert client.deleted['Clinical observations']['id'].tolist() == ['CO1']
+
+    clinical_obs = client.saved['Clinical observations'].set_index('id')
+    assert sorted(clinical_obs.index) == ['P0003-CO', 'P0004-CO']
+    assert clinical_obs.loc['P0004-CO', 'individuals'] == 'P0004'
+    assert clinical_obs.loc['P0004-CO', 'age group at onset'] == ''
+
+
+def test_build_import_disease_history(monkeypatch, participants):
+    monkeypatch.setenv('MOLGENIS_HOST_SCHEMA_TARGET', 'rd3')
+    monkeypatch.setattr(mapping_cnag_to_rd3, 'match_diseases',
+                        lambda diseases: ({('Cystic fibrosis', '586')}, {}))
+    client = FakeClient({})
+
+    mapping_cnag_to_rd3.build_import_disease_history(client=client, data=participants)
+
+    # the clinical observations are neither retrieved nor rewritten
+    assert 'Clinical observations' not in client.saved
+
+    disease_history = client.saved['Disease history'].reset_index(drop=True)
+    expected = pd.DataFrame({
+        'part of clinical observation': ['P0001-CO', 'P0004-CO'],
+        'disease': ['Marfan syndrome', 'Marfan syndrome'],
+        'disease status': ['Confirmed diagnosis', 'Confirmed diagnosis'],
+    })
+    pd.testing.assert_frame_equal(disease_history, expected, check_dtype=False)
+
+
+@pytest.fixture
+def typed_participants(participants):
+    """Participants with the dtypes of the staging area model, with every repeated
+    string stored as a categorical"""
+    participants = participants.assign(
+        id=['ID1', 'ID2', 'ID3', 'ID4'],
+        sex=['M', 'F', 'M', None],
+        lifeStatus=['Alive', 'Deceased', 'Alive', 'Deceased'],
+        report_date=['2024-01-01 10:00:00', None, '2024-02-01 10:00:00', '2024-03-01 10:00:00'],
+        last_modification_date=[None, None, None, None],
+        baselineage=['12', '40', None, '12']
+    ).astype('string')
+    return apply_model_dtypes(participants, schema='staging_area_gpap', table='Participants', max_ratio=1.0)
+
+
+def test_apply_model_dtypes(typed_participants):
+    assert isinstance(typed_participants['sex'].dtype, pd.CategoricalDtype)
+    assert isinstance(typed_participants['lifeStatus'].dtype, pd.CategoricalDtype)
+    # key and text columns are not stored as categoricals
+    assert typed_participants['report_id'].dtype == 'string'
+    assert typed_participants['diagnosis'].dtype == 'string'
+    assert pd.api.types.is_datetime64_any_dtype(typed_participants['report_date'])
+
+
+def test_apply_model_dtypes_dates(participants, caplog):
+    """Dates in different formats and timezones are converted to UTC"""
+    participants = participants.assign(
+        report_date=['2024-01-01 10:00:00', '2024-02-01T10:00:00+02:00', '2024-03-01', 'unknown'],
+        last_modification_date=['', None, '2024-01-01T00:00:00Z', '2024-01-01T00:00:00-05:00'])
+
+    typed = apply_model_dtypes(participants, schema='staging_area_gpap', table='Participants')
+
+    assert typed['report_date'].tolist()[:3] == [pd.Timestamp('2024-01-01 10:00'), pd.Timestamp('2024-02-01 08:00'),
+                                                 pd.Timestamp('2024-03-01')]
+    assert typed['last_modification_date'].tolist()[2:] == [pd.Timestamp('2024-01-01'),
+                                                            pd.Timestamp('2024-01-01 05:00')]
+    # only the value that could not be parsed is reported, not the empty ones
+    assert typed[['report_date', 'last_modification_date']].isna().sum().tolist() == [1, 2]
+    assert 'Could not convert 1 values of Participants.report_date' in caplog.text
+    assert 'last_modification_date' not in caplog.text
+
+
+def test_map_categories():
+    ages = pd.Series(['12', '40', None, '12', 'unknown'])
+
+    def to_duration(values):
+        return 'P' + pd.to_numeric(values, errors='coerce').astype('Int64').astype('string') + 'Y'
+
+    expected = ['P12Y', 'P40Y', None, 'P12Y', None]
+    for column in (ages, ages.astype('category')):
+        durations = map_categories(column, to_duration)
+        assert durations.astype(object).where(durations.notna(), None).tolist() == expected
+
+
+@pytest.mark.parametrize('typed', [False, True])
+def test_build_import_pedigree_table(typed):
+    participants = pd.DataFrame({
+        'famid': ['F1', 'F1', 'F2', 'F3', None, 'F4', 'F4'],
+        'family_id': ['FAM1b', 'FAM1a', None, 'FAM3', 'FAMX', 'FAM4', 'FAM4'],
+        'otheraffected': ['No', 'Yes', None, 'No', 'Yes', None, 'No']
+    }).astype('string')
+    if typed:
+        participants = participants.astype({'otheraffected': 'category'})
+    client = FakeClient({})
+
+    mapping_cnag_to_rd3.build_import_pedigree_table(client=client, data=participants)
+
+    pedigree = client.saved['Pedigree'].set_index('id')
+    assert pedigree.index.tolist() == ['F1', 'F2', 'F3', 'F4']
+    assert pedigree['alternate ids'].tolist()[::2] == ['FAM1a,FAM1b', 'FAM3']
+    assert pd.isna(pedigree.loc['F2', 'alternate ids'])
+    # True if any member has others affected, empty if no member has a value
+    assert pedigree['others affected'].tolist() == [True, None, False, False]
+
+
+def test_build_import_individuals_typed(typed_participants):
+    client = FakeClient({})
+
+    mapping_cnag_to_rd3.build_import_individuals_table(client=client, data=typed_participants)
+
+    individuals = client.saved['Individuals'].set_index('id')
+    assert individuals['individual status'].tolist() == ['Alive', 'Dead', 'Alive', 'Dead']
+    assert individuals['gender at birth'].tolist()[:2] == ['assigned male at birth', 'assigned female at birth']
+    assert individuals.loc['P0001', 'age at enrolment'] == 'P12Y'
+
+
+def test_build_import_clinical_observations_typed(monkeypatch, typed_participants):
+    monkeypatch.setenv('MOLGENIS_HOST_SCHEMA_TARGET', 'rd3')
+    client = FakeClient({})
+
+    mapping_cnag_to_rd3.build_import_clinical_observations(client=client, data=typed_participants)
+
+    clinical_obs = client.saved['Clinical observations'].set_index('id')
+    assert clinical_obs.loc['P0001-CO', 'is solved'] == True
+    assert clinical_obs.loc['P0002-CO', 'age group at onset'] == 'Congenital onset'
+
+
+@pytest.fixture
+def features():
+    """Participants with phenotypic features, one of them without an id"""
+    return pd.DataFrame({
+        'report_id': ['P0001', 'P0002', 'P0003'],
+        'features': [
+            "[{'name': 'Seizure', 'observed': True, 'id': 'HP:0001250'}, {'name': 'Foo', 'observed': True}]",
+            "[{'name': 'Seizures', 'observed': False, 'id': 'HP:0001250'}, {'observed': True, 'id': 'HP:0000478'}]",
+            None
+        ]
+    })
+
+
+def test_parse_phenotype_observations(features):
+    id_map = mapping_cnag_to_rd3.get_clinical_observation_ids(features)
+    phen_observations, observations = mapping_cnag_to_rd3.parse_phenotype_observations(data=features, id_map=id_map)
+
+    assert phen_observations.values.tolist() == [
+        ['P0001-CO', 'Seizure', False, 'HP:0001250'],
+        ['P0001-CO', 'Foo', False, None],
+        ['P0002-CO', 'Seizures', True, 'HP:0001250']
+    ]
+    assert observations == {('Seizure', 'HP:0001250'), ('Foo', None), ('Seizures', 'HP:0001250')}
+
+
+def test_build_import_phenotype_observations(monkeypatch, features):
+    """Corrections and non-matches apply to features without an id as well"""
+    monkeypatch.setenv('MOLGENIS_HOST_SCHEMA_TARGET', 'rd3')
+    monkeypatch.setattr(mapping_cnag_to_rd3, 'match_phenotypes',
+                        lambda observations: ({('Foo', None)}, {('Seizures', 'HP:0001250'): 'Seizure'}))
+    client = FakeClient({})
+
+    mapping_cnag_to_rd3.build_import_phenotype_observations(client=client, data=features)
+
+    phen_observations = client.saved['Phenotype observations']
+    assert phen_observations[['part of clinical observation', 'type', 'excluded']].values.tolist() == [
+        ['P0001-CO', 'Seizure', False],
+        ['P0002-CO', 'Seizure', True]
+    ]
+
+
+@pytest.fixture
+def new_value():
+    """Ontology mappings of which the new value is filled in by a curator"""
+    return pd.DataFrame({
+        'source': ['phenostore_service/api/participants_by_exp/features', 'another source'],
+        'incoming value': ['Corrected', 'Other source'],
+        'incoming code': ['HP:0000003', 'HP:0000004'],
+        'new value': ['Abnormality', 'Abnormality']
+    })
+
+
+def test_get_missing_entries(new_value):
+    rd3_codes = normalise_codes(pd.Series(['HP:0001250', 'HP:0000478']))
+    non_matches = {
+        ('Seizures', '0001250'),  # prefix only
+        ('Eye', ' hp_0000478 '),  # prefix and whitespace
+        ('Missing', 'HP:0000002'),
+        ('Corrected', 'HP:0000003'),  # has a new value
+        ('Other source', 'HP:0000004'),  # has a new value of another source
+        ('No code', None)
+    }
+
+    missing = mapping_cnag_to_rd3.get_missing_entries(rd3_codes=rd3_codes, non_matches=non_matches,
+                                                      new_value=new_value)
+
+    assert missing.columns.tolist() == ['source', 'incoming value', 'incoming code']
+    assert (missing['source'] == 'phenostore_service/api/participants_by_exp/features').all()
+    assert sorted(missing['incoming value']) == ['Missing', 'No code', 'Other source']
+
+
+def test_get_missing_entries_one_per_code(new_value):
+    missing = mapping_cnag_to_rd3.get_missing_entries(rd3_codes=normalise_codes(pd.Series(['HP:0001250'])),
+                                                      non_matches={('Missing', 'HP:0000002'), ('missing', 'HP:0000002')},
+                                                      new_value=new_value.iloc[:0])
+
+    assert missing['incoming code'].tolist() == ['HP:0000002']
+
+
+def test_get_quality_control_mismatches():
+    matches = pd.DataFrame({
+        'GPAP name': ['seizure', 'Seizures', 'Eye', 'Ear'],
+        'GPAP code': ['HP:0001250', '0001250', 'HP:0000478', None],
+        'RD3 name': ['Seizure', 'Seizure', 'Abnormality of the eye', 'Abnormality of the ear'],
+        'RD3 code': ['HP:0001250', 'HP:0001250', 'HP:0000478', 'HP:0000598'],
+        'type of mismatch': ['normalised', 'name', 'name', 'similar name'],
+        'confidence': [1.0, 0.8, 0.6, 0.7]
+    })
+
+    mismatches = mapping_cnag_to_rd3.get_quality_control_mismatches(
+        matches=matches, mapping={('Eye', 'HP:0000478'): 'Abnormality of the eye'})
+
+    # normalised entries and entries with a correction are not checked by a curator
+    assert mismatches['GPAP name'].tolist() == ['Seizures', 'Ear']
@@ -0,0 +1,76 @@
+"""Tests of matching terms to an ontology table"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from erdera.utils.ontology_index import OntologyIndex, normalise_code, normalise_codes, normalise_name
+
+
+@pytest.fixture
+def index():
+    phenotypes = pd.DataFrame({
+        'name': ['Seizure', 'Abnormality of the eye', 'Epileptic spasm', None],
+        'code': ['HP:0001250', 'HP:0000478', 'HP:0011097', 'HP:0000001'],
+        # 'epileptic spasm' is a synonym of seizure as well as the name of a term
+        'label': ['Epileptic seizure', 'Eye abnormality', None, 'All']
+    })
+    return OntologyIndex(phenotypes, synonyms={'Fits': 'Seizure', 'Epileptic spasm': 'Seizure'})
+
+
+@pytest.mark.parametrize('code', ['HP:0001250', 'hp:0001250', 'HP: 0001250', 'HP_0001250', '0001250', ' 0001250 '])
+def test_lookup_code_prefix_and_whitespace(index, code):
+    match = index.lookup(' SEIZURE ', code)
+    assert (match.name, match.code, match.type, match.confidence) == ('Seizure', 'HP:0001250', 'normalised', 1.0)
+
+
+def test_lookup_code_with_different_name(index):
+    match = index.lookup('Seizures', '0001250')
+    assert (match.name, match.type) == ('Seizure', 'name')
+    assert 0.5 < match.confidence < 0.9
+
+
+def test_lookup_synonyms(index):
+    assert index.lookup('Epileptic-Seizure', 'HP:0001250')[2:] == ('synonym', 0.95)
+    assert index.lookup('fits', None)[:3] == ('Seizure', 'HP:0001250', 'synonym')
+    # a synonym with a different code
+    assert index.lookup('Eye abnormality', 'HP:9999999')[2:] == ('synonym', 0.7)
+
+
+def test_lookup_name_before_synonym(index):
+    """A name of a term takes precedence over the same synonym of another term"""
+    assert index.lookup('Epileptic spasm', None)[:3] == ('Epileptic spasm', 'HP:0011097', 'normalised')
+    assert index.lookup('Epileptic spasm', 'HP:9999999')[:3] == ('Epileptic spasm', 'HP:0011097', 'code')
+
+
+@pytest.mark.parametrize('name, code', [(None, None), ('', ''), (np.nan, np.nan), (pd.NA, None), ('---', None)])
+def test_lookup_empty(index, name, code):
+    assert index.lookup(name, code) is None
+
+
+@pytest.mark.parametrize('name', [None, '', np.nan, '---'])
+def test_lookup_empty_name_with_code(index, name):
+    """An empty name (or one without letters or digits) is not the name of the term"""
+    match = index.lookup(name, 'HP:0001250')
+    assert (match.name, match.type) == ('Seizure', 'name')
+    assert match.confidence == 0.5
+
+
+def test_lookup_similar_name(index):
+    match = index.lookup('Abnormalities of the eye', None)
+    assert (match.name, match.type) == ('Abnormality of the eye', 'similar name')
+    assert index.lookup('Short stature', None) is None
+
+
+def test_normalise():
+    assert normalise_name('Marfan-Syndrome ') == 'marfan syndrome'
+    assert normalise_name('Café') == 'cafe'
+    assert normalise_name('---') is None
+    codes = ['ORPHA: 558', 'Orphanet_558', '558', ' hp: 0001250 ', '', None, np.nan]
+    assert [normalise_code(code) for code in codes] == ['558', '558', '558', '0001250', None, None, None]
+    assert normalise_codes(pd.Series(codes)).tolist() == [normalise_code(code) for code in codes]
+
+
+def test_match(index):
+    matches = index.match([('seizure', 'HP:0001250'), ('Short stature', None)])
+    assert matches.columns.tolist() == ['incoming name', 'incoming code', 'name', 'code', 'type', 'confidence']
+    assert matches[['incoming name', 'name', 'type']].values.tolist() == [['seizure', 'Seizure', 'normalised']]
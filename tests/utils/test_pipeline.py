@@ -0,0 +1,93 @@
+"""Tests of running the stages of a mapping as a pipeline"""
+import threading
+
+import pytest
+
+from erdera.utils.pipeline import Pipeline, Stage
+
+
+def fail():
+    raise RuntimeError('upload failed')
+
+
+def test_run_in_dependency_order():
+    order = []
+    pipeline = Pipeline([
+        Stage('members', lambda: order.append('members'), depends_on=['pedigree', 'individuals']),
+        Stage('pedigree', lambda: order.append('pedigree')),
+        Stage('individuals', lambda: order.append('individuals') or 'ids', depends_on=['pedigree'])
+    ])
+
+    results = pipeline.run()
+
+    assert order == ['pedigree', 'individuals', 'members']
+    assert {name: result['status'] for name, result in results.items()} == \
+        {'pedigree': 'success', 'individuals': 'success', 'members': 'success'}
+    assert pipeline.result('individuals') == 'ids'
+    assert pipeline.failed == []
+
+
+def test_run_independent_stages_concurrently():
+    # each stage waits until the other one has started, which fails if they run one after the other
+    barrier = threading.Barrier(2, timeout=5)
+    pipeline = Pipeline([Stage('consent', barrier.wait), Stage('disease history', barrier.wait)])
+
+    results = pipeline.run(max_workers=2)
+
+    assert [result['status'] for result in results.values()] == ['success', 'success']
+
+
+def test_skip_dependents_of_failed_stage():
+    pipeline = Pipeline([
+        Stage('individuals', fail),
+        Stage('clinical observations', lambda: None, depends_on=['individuals']),
+        Stage('phenotype observations', lambda: None, depends_on=['clinical observations']),
+        Stage('pedigree', lambda: None)
+    ])
+
+    results = pipeline.run()
+
+    assert results['individuals']['status'] == 'failed'
+    assert results['individuals']['error'] == 'upload failed'
+    # dependents are skipped, including the indirect ones
+    assert results['clinical observations']['status'] == 'skipped'
+    assert results['phenotype observations']['status'] == 'skipped'
+    assert results['pedigree']['status'] == 'success'
+    assert sorted(pipeline.failed) == ['clinical observations', 'individuals', 'phenotype observations']
+
+
+def test_run_only_selected_stage():
+    ran = []
+    pipeline = Pipeline([
+        Stage('individuals', lambda: ran.append('individuals')),
+        Stage('consent', lambda: ran.append('consent'), depends_on=['individuals'])
+    ])
+
+    results = pipeline.run(only=['consent'])
+
+    # the dependencies of the selected stages are assumed to have run before
+    assert ran == ['consent']
+    assert list(results) == ['consent']
+
+
+def test_reject_unknown_stage():
+    pipeline = Pipeline([Stage('individuals', lambda: None)])
+    with pytest.raises(ValueError, match='Unknown stage'):
+        pipeline.run(only=['individual'])
+
+    with pytest.raises(ValueError, match='unknown stage'):
+        Pipeline([Stage('consent', lambda: None, depends_on=['individual'])])
+
+
+def test_reject_duplicate_stage():
+    with pytest.raises(ValueError, match='more than once'):
+        Pipeline([Stage('individuals', lambda: None), Stage('individuals', lambda: None)])
+
+
+def test_reject_cycle():
+    with pytest.raises(ValueError, match='cycle'):
+        Pipeline([
+            Stage('pedigree', lambda: None, depends_on=['members']),
+            Stage('individuals', lambda: None, depends_on=['pedigree']),
+            Stage('members', lambda: None, depends_on=['individuals'])
+        ])
@@ -0,0 +1,26 @@
+"""Tests of the comparison of mapped rows to the rows of a table"""
+import pandas as pd
+
+from erdera.utils.table_diff import diff_table, hash_rows
+
+
+def test_hash_rows_numbers():
+    """Integers read back from MOLGENIS as floats hash the same as the mapped integers"""
+    mapped = pd.DataFrame({'year of birth': pd.array([1990, None, 2001], dtype='Int64'),
+                           'age': [1.5, 2.0, None]})
+    current = pd.DataFrame({'year of birth': [1990.0, None, 2001.0], 'age': ['1.5', 2, None]},
+                           index=[10, 11, 12])
+
+    assert (hash_rows(mapped, ['year of birth', 'age']).to_numpy()
+            == hash_rows(current, ['year of birth', 'age']).to_numpy()).all()
+
+
+def test_diff_table_numbers():
+    current = pd.DataFrame({'id': ['a', 'b'], 'individual': ['P1', 'P2'], 'year of birth': [1990.0, 2000.0]})
+    data = pd.DataFrame({'individual': ['P1', 'P2', 'P3'], 'year of birth': [1990, 2001, 1985]})
+
+    diff = diff_table(current=current, data=data, keys=['individual'])
+
+    assert diff['inserts']['individual'].tolist() == ['P3']
+    assert diff['updates'][['id', 'individual']].values.tolist() == [['b', 'P2']]
+    assert diff['deletes'].empty